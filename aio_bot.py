@@ -0,0 +1,9 @@
+from telebot import asyncio_filters, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from bot import config
+
+if config.has_option('TG', 'api_url'):
+    asyncio_helper.API_URL = config.get('TG', 'api_url')
+bot = AsyncTeleBot(config.get('TG', 'token'))
+bot.add_custom_filter(asyncio_filters.StateFilter(bot))
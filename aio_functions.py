@@ -0,0 +1,99 @@
+import asyncio
+import logging
+
+from telebot.asyncio_helper import ApiTelegramException
+
+from aio_bot import bot
+from bot import config
+from chart_cache import chart_cache
+from dispatcher import notify_dispatcher
+from functions import NOTIFY_CLAIM_BATCH, claim_notifications, notification_sent
+from ingest import AsyncIngestBuffer
+from metrics import timed
+from render import render_engine, RenderError
+from scheduler import current_epoch_minute, seconds_until, minutes_to_run
+import views
+
+# Bot API side of the asyncio runtime (main.py --mode async). Queries go through functions.py and the shared storage
+# in worker threads, so both runtimes run the same SQL against either backend.
+
+ingest_buffer = AsyncIngestBuffer(
+    flush_interval=config.getint('INGEST', 'flush_interval_ms', fallback=50) / 1000,
+    max_batch=config.getint('INGEST', 'max_batch', fallback=500),
+    timeout=config.getfloat('INGEST', 'timeout', fallback=10),
+)
+_background = set()
+
+
+def _spawn(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+async def send_chart(chat_id, reply):
+    # Same steps as functions.send_chart; the queries in reply.build() run in a worker thread.
+    if reply.cached is not None and await send_cached_chart(chat_id, reply):
+        return
+    args = reply.args or await asyncio.to_thread(reply.build)
+    if args is None:
+        await bot.send_message(chat_id, views.NO_DATA_FOR_DATE)
+        return
+    try:
+        png = await render_engine.render_async(reply.chart, *args)
+    except RenderError:
+        await bot.send_message(chat_id, views.CHART_UNAVAILABLE)
+        return
+    message = await bot.send_photo(chat_id=chat_id, photo=png)
+    if message.photo:
+        chart_cache.put(chat_id, reply.scope, reply.version, file_id=message.photo[-1].file_id)
+
+
+async def send_cached_chart(chat_id, reply):
+    file_id, png = reply.cached
+    try:
+        message = await bot.send_photo(chat_id=chat_id, photo=file_id or png)
+    except ApiTelegramException:
+        logging.warning(f"Cached chart {reply.scope} for {chat_id} was rejected, rendering again.")
+        chart_cache.discard(chat_id, reply.scope, reply.version)
+        return False
+    if not file_id and message.photo:
+        chart_cache.put(chat_id, reply.scope, reply.version, file_id=message.photo[-1].file_id)
+    return True
+
+
+async def add_reading(user_id, systolic, diastolic, pulse):
+    await ingest_buffer.add(user_id, systolic, diastolic, pulse)
+    chart_cache.forget(user_id)
+
+
+async def send_notification(user_id):
+    await bot.send_message(user_id, views.NOTIFICATION)
+
+
+@timed('notify', 'tick')
+async def notify_loop(epoch_minute):
+    while True:
+        claimed = dict(await asyncio.to_thread(claim_notifications, epoch_minute, NOTIFY_CLAIM_BATCH))
+        _spawn(notify_dispatcher.dispatch_async(
+            list(claimed), send_notification,
+            lambda user_id, claimed=claimed: asyncio.to_thread(notification_sent, user_id, claimed[user_id])))
+        if len(claimed) < NOTIFY_CLAIM_BATCH:
+            return
+
+
+async def run_notify_loop():
+    # Same minute-aligned ticks as scheduler.run_every_minute, as a task on the bot's event loop.
+    last = current_epoch_minute()
+    while True:
+        await asyncio.sleep(seconds_until(last + 1))
+        current = current_epoch_minute()
+        if current <= last:
+            continue
+        for minute in minutes_to_run(last, current):
+            try:
+                await notify_loop(minute)
+            except Exception:
+                logging.exception("Notification tick failed.")
+        last = current
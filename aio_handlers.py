@@ -0,0 +1,145 @@
+import asyncio
+import functools
+import logging
+
+from telebot import types
+from telebot.asyncio_handler_backends import State, StatesGroup
+
+from aio_bot import bot
+from aio_functions import send_chart, add_reading
+from ingest import IngestError, IngestPending
+from metrics import timed
+from profiling import profiler
+from router import RouteError
+from throttle import throttle, async_coalescer
+import replies
+import views
+from views import Ask, Chart, Document
+
+# The asyncio counterpart of handlers.py, registered on aio_bot.bot for main.py --mode async. The bodies are the
+# same replies.py functions; they block on the database, so each runs in a worker thread.
+
+
+class NotifyStates(StatesGroup):
+    # Replaces register_next_step_handler, which AsyncTeleBot does not have.
+    time = State()
+
+
+class ImportStates(StatesGroup):
+    file = State()
+
+
+STATES = {replies.NOTIFY_TIME: NotifyStates.time, replies.IMPORT_FILE: ImportStates.file}
+
+
+def chat_of(update):
+    return update.message.chat.id if isinstance(update, types.CallbackQuery) else update.chat.id
+
+
+async def deliver(update, reply_list):
+    # Sends what a replies.py body returned, in order.
+    chat_id = chat_of(update)
+    for reply in reply_list:
+        if isinstance(reply, Chart):
+            await send_chart(chat_id, reply)
+        elif isinstance(reply, Document):
+            with reply.file:
+                await bot.send_document(chat_id, reply.file, visible_file_name=reply.name, caption=reply.caption)
+        elif isinstance(reply, Ask):
+            await bot.set_state(update.from_user.id, STATES[reply.step], chat_id)
+        else:
+            await bot.send_message(chat_id, reply.text, reply_markup=reply.reply_markup, parse_mode=reply.parse_mode)
+
+
+async def respond(body, update, *args):
+    await deliver(update, await asyncio.to_thread(body, update, *args))
+
+
+def throttled(fn):
+    # Same per-user limit as handlers.throttled; the state handlers (import, notification time) are not limited.
+    @functools.wraps(fn)
+    async def wrapper(update):
+        allowed, notify = throttle.admit(update.from_user.id)
+        if allowed:
+            return await fn(update)
+        if not notify:
+            return
+        if isinstance(update, types.CallbackQuery):
+            await bot.answer_callback_query(update.id, views.SLOW_DOWN)
+        else:
+            await bot.send_message(update.chat.id, views.SLOW_DOWN)
+    return wrapper
+
+
+def command(body, *commands, **kwargs):
+    bot.message_handler(commands=list(commands), **kwargs)(throttled(functools.partial(respond, body)))
+
+
+@bot.message_handler(commands=['reset'])
+@throttled
+async def reset(message):
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    await respond(replies.reset, message)
+
+
+command(replies.start, 'start')
+command(replies.delete, 'delete')
+command(replies.help_message, 'help')
+command(replies.export_handler, 'export')
+command(replies.import_handler, 'import')
+command(replies.get_command_handler, 'get')
+command(replies.graph_command_handler, 'graph')
+command(replies.stats_handler, 'stats')
+command(replies.profile_handler, 'profile', func=lambda message: message.from_user.id in profiler.admins)
+command(replies.notify_handler, 'notify')
+
+
+@bot.message_handler(state=ImportStates.file, content_types=['document', 'text', 'photo', 'sticker'])
+async def import_step(message):
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    refused = replies.import_refused(message)
+    if refused:
+        await deliver(message, refused)
+        return
+    file = await bot.get_file(message.document.file_id)
+    await respond(replies.import_file_handler, message, await bot.download_file(file.file_path))
+
+
+@bot.message_handler(state=NotifyStates.time)
+async def notify_time_step(message):
+    # An invalid time asks again, which sets the state back.
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    await respond(replies.notify_time_handler, message)
+
+
+@bot.message_handler(func=lambda message: message.text and not message.text.startswith('/'))
+@throttled
+@timed('handler')
+async def handle_text(message):
+    values, error = views.parse_reading(message.text)
+    if error:
+        await bot.send_message(message.chat.id, error)
+        return
+    try:
+        await add_reading(message.from_user.id, *values)
+        await bot.send_message(message.chat.id, views.SAVED)
+    except IngestPending:
+        await bot.send_message(message.chat.id, views.SAVE_PENDING)
+    except IngestError:
+        await bot.send_message(message.chat.id, views.NOT_SAVED)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+@throttled
+async def handle_callback(call):
+    # Every inline button goes through replies.callback_router; callback_data is parsed once, here.
+    try:
+        handler, args = replies.callback_router.resolve(call.data)
+    except RouteError as e:
+        logging.warning(f"Unroutable callback from {call.from_user.id}: {e}")
+        await bot.answer_callback_query(call.id, views.OUTDATED_BUTTON)
+        return
+    if replies.callback_router.coalesces(handler):
+        await async_coalescer.run((call.from_user.id, call.data), respond, handler, call, *args)
+    else:
+        await respond(handler, call, *args)
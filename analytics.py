@@ -0,0 +1,81 @@
+import numpy as np
+
+# Summary statistics for /stats. Everything works on whole columns: systolic, diastolic and pulse as given, and
+# local_seconds, the local wall-clock time of each reading as seconds since the epoch, sorted ascending.
+
+DAY_SECONDS = 86400
+# Local hours [start, end) counted as morning and evening readings for home monitoring.
+MORNING = (4, 12)
+EVENING = (18, 24)
+# 2017 ACC/AHA categories; a reading belongs to the highest one its systolic or diastolic value reaches.
+CATEGORIES = ('Normal', 'Elevated', 'Stage 1', 'Stage 2', 'Crisis')
+
+
+def columns(systolic, diastolic, pulse, local_seconds):
+    return (np.asarray(systolic, dtype=float), np.asarray(diastolic, dtype=float), np.asarray(pulse, dtype=float),
+            np.asarray(local_seconds, dtype=float))
+
+
+def rolling_means(days, values, window):
+    # Mean of the readings in the trailing `window` days, for every day from the first reading to the last.
+    # Days without readings inside the window come out as NaN.
+    offsets = (days - days[0]).astype(np.int64)
+    sums = np.concatenate(([0.0], np.cumsum(np.bincount(offsets, weights=values))))
+    counts = np.concatenate(([0], np.cumsum(np.bincount(offsets))))
+    end = np.arange(1, len(sums))
+    start = np.maximum(end - window, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[end] - sums[start]) / (counts[end] - counts[start])
+
+
+def categories(systolic, diastolic):
+    index = np.select([(systolic > 180) | (diastolic > 120), (systolic >= 140) | (diastolic >= 90),
+                       (systolic >= 130) | (diastolic >= 80), systolic >= 120], [4, 3, 2, 1], 0)
+    return np.bincount(index, minlength=len(CATEGORIES)) / len(index)
+
+
+def slope(days, values):
+    # Least-squares trend in units per day; None when every reading has the same timestamp.
+    spread = days - days.mean()
+    variance = np.dot(spread, spread)
+    if not variance:
+        return None
+    return float(np.dot(spread, values - values.mean()) / variance)
+
+
+def _mean(values):
+    return float(values.mean()) if len(values) else None
+
+
+def _window(hours, window):
+    return (hours >= window[0]) & (hours < window[1])
+
+
+def summarize(systolic, diastolic, pulse, local_seconds):
+    systolic, diastolic, pulse, local_seconds = columns(systolic, diastolic, pulse, local_seconds)
+    count = len(systolic)
+    if not count:
+        return None
+    days = np.floor(local_seconds / DAY_SECONDS)
+    hours = local_seconds % DAY_SECONDS / 3600
+    morning, evening = _window(hours, MORNING), _window(hours, EVENING)
+    stats = {
+        'count': count,
+        'mean': tuple(_mean(values) for values in (systolic, diastolic, pulse)),
+        'pulse_pressure': _mean(systolic - diastolic),
+        'morning': (_mean(systolic[morning]), _mean(diastolic[morning]), int(morning.sum())),
+        'evening': (_mean(systolic[evening]), _mean(diastolic[evening]), int(evening.sum())),
+        'categories': dict(zip(CATEGORIES, categories(systolic, diastolic).tolist())),
+    }
+    for window in (7, 30):
+        # The trailing window ends on the day of the last reading, so it always holds at least one reading.
+        stats[f'rolling_{window}'] = tuple(float(rolling_means(days, values, window)[-1])
+                                           for values in (systolic, diastolic, pulse))
+    if count > 1:
+        stats['sd'] = (float(systolic.std(ddof=1)), float(diastolic.std(ddof=1)))
+        # Average real variability: mean absolute change between consecutive readings.
+        stats['arv'] = (float(np.abs(np.diff(systolic)).mean()), float(np.abs(np.diff(diastolic)).mean()))
+    trend = slope(local_seconds / DAY_SECONDS, systolic), slope(local_seconds / DAY_SECONDS, diastolic)
+    if trend[0] is not None:
+        stats['slope'] = trend
+    return stats
@@ -0,0 +1,140 @@
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Local stand-in for the Telegram Bot API. Point telebot at it with
+# telebot.apihelper.API_URL = server.api_url (or [TG] api_url in config.ini for a full bot process).
+
+_MULTIPART_FIELD = re.compile(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n')
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+
+
+class FakeBotApi:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._updates = []
+        self._updates_ready = threading.Condition(self._lock)
+        self._next_update_id = 1
+        self.calls = {}
+        self.sent = []
+
+    @property
+    def api_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot{{0}}/{{1}}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_updates(self, updates):
+        # Queues update bodies (dicts without update_id) for getUpdates; returns the assigned ids.
+        with self._updates_ready:
+            ids = []
+            for update in updates:
+                update = dict(update, update_id=self._next_update_id)
+                self._next_update_id += 1
+                self._updates.append(update)
+                ids.append(update['update_id'])
+            self._updates_ready.notify_all()
+        return ids
+
+    def sent_since(self, started, text=None):
+        with self._lock:
+            return [entry for entry in self.sent if entry[0] >= started and (text is None or entry[3] == text)]
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.sent.clear()
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or 100)
+        with self._updates_ready:
+            # An offset acknowledges everything before it, exactly like the real API.
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def _message(self, chat_id, **extra):
+        return dict({'message_id': next(self._ids), 'date': int(time.time()), 'from': BOT_USER,
+                     'chat': {'id': chat_id, 'type': 'private'}}, **extra)
+
+    def _call(self, method, params):
+        chat_id = int(params['chat_id']) if params.get('chat_id', '').lstrip('-').isdigit() else 0
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method.startswith('send'):
+                self.sent.append((time.time(), method, chat_id, params.get('text')))
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return self._message(chat_id, text=params.get('text', ''))
+        if method == 'sendPhoto':
+            file_id = f'photo-{next(self._ids)}'
+            return self._message(chat_id, photo=[{'file_id': file_id, 'file_unique_id': file_id,
+                                                  'width': 640, 'height': 480}])
+        if method == 'sendDocument':
+            file_id = f'document-{next(self._ids)}'
+            return self._message(chat_id, document={'file_id': file_id, 'file_unique_id': file_id})
+        if method == 'getFile':
+            return {'file_id': params.get('file_id'), 'file_unique_id': params.get('file_id'), 'file_path': 'file'}
+        return True
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _params(self):
+                params = dict(parse_qsl(urlsplit(self.path).query))
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/form-data'):
+                    params.update((name.decode(), value.decode('utf-8', 'replace'))
+                                  for name, value in _MULTIPART_FIELD.findall(body))
+                elif content_type.startswith('application/json'):
+                    params.update((key, str(value)) for key, value in json.loads(body or b'{}').items())
+                elif body:
+                    params.update(parse_qsl(body.decode()))
+                return params
+
+            def _handle(self):
+                parts = urlsplit(self.path).path.strip('/').split('/')
+                if len(parts) != 2 or not parts[0].startswith('bot'):
+                    self.send_error(404)
+                    return
+                params = self._params()
+                if api.latency:
+                    time.sleep(api.latency)
+                payload = json.dumps({'ok': True, 'result': api._call(parts[1], params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import signal
+import time
+from collections import Counter
+
+from benchmark import target
+from benchmark.fake_api import FakeBotApi
+from benchmark.seed import BASE_USER_ID, user_ids
+
+# Runs the same notification tick in several processes against one database and checks that every reminder
+# was sent exactly once. Run from the repository root: python -m benchmark.notify_cluster --instances 4
+# With --async the instances run the asyncio runtime's tick (aio_functions.notify_loop) instead.
+# --kill N kills N instances with SIGKILL in the middle of their dispatch, holding leases on reminders they have not
+# sent; the others tick again once those leases have expired and send them. A reminder that was sent but not yet
+# recorded when its instance died is sent again, so up to [NOTIFY] workers duplicates per killed instance are
+# expected.
+
+# Short, so the check does not wait the default two minutes for the killed instances' leases, but long enough for
+# a live instance to send its share through the fake API before its own leases expire.
+LEASE_SECONDS = 30
+
+
+async def _async_tick(epoch_minute):
+    from aio_bot import bot
+    import aio_functions
+    try:
+        await aio_functions.notify_loop(epoch_minute)
+        # The sends run as background tasks; the tick only waits for the claims.
+        while aio_functions._background:
+            await asyncio.gather(*aio_functions._background)
+    finally:
+        await bot.close_session()
+
+
+def _killed_after(sends, send):
+    count = itertools.count(1)
+
+    def wrapper(user_id):
+        if next(count) > sends:
+            os.kill(os.getpid(), signal.SIGKILL)
+        return send(user_id)
+    return wrapper
+
+
+def _instance(api_url, overrides, epoch_minute, start_at, kill_after, use_async):
+    target.apply(overrides)
+    import telebot
+    from telebot import asyncio_helper
+    telebot.apihelper.API_URL = api_url
+    asyncio_helper.API_URL = api_url
+    import aio_functions
+    import functions
+    from dispatcher import notify_dispatcher
+    if kill_after is not None:
+        functions.send_notification = _killed_after(kill_after, functions.send_notification)
+        aio_functions.send_notification = _killed_after(kill_after, aio_functions.send_notification)
+    for minute, at in ((epoch_minute, start_at), (epoch_minute + 1, start_at + LEASE_SECONDS + 1)):
+        # The second tick is a minute later for the reminders, and after the leases of the killed instances.
+        time.sleep(max(0.0, at - time.time()))
+        if use_async:
+            asyncio.run(_async_tick(minute))
+        else:
+            functions.notify_loop(minute)
+    notify_dispatcher.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check exactly-once reminders across several bot processes.")
+    parser.add_argument('--instances', type=int, default=4)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--kill', type=int, default=0, help="instances killed in the middle of their dispatch")
+    parser.add_argument('--kill-after', type=int, default=50, help="reminders a killed instance sends before it dies")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="run the asyncio runtime's tick")
+    target.add_arguments(parser)
+    args = parser.parse_args()
+    overrides = target.overrides(parser, args, ['postgres'])
+    overrides['NOTIFY'] = {'lease_seconds': str(LEASE_SECONDS), 'global_rate': '1000'}
+    target.apply(overrides)
+
+    from database import db
+    from migrations import bootstrap_schema
+    from scheduler import current_epoch_minute, local_minute
+    import views
+    bootstrap_schema()
+    api = FakeBotApi().start()
+    minute = current_epoch_minute()
+    ids = user_ids(args.users, BASE_USER_ID)
+    with db.cursor() as cursor:
+        cursor.execute("INSERT INTO notifications (user_id, notify_time, enabled) "
+                       "SELECT generate_series(%s, %s), %s, TRUE ON CONFLICT (user_id) "
+                       "DO UPDATE SET notify_time = EXCLUDED.notify_time, enabled = TRUE, last_sent = NULL, "
+                       "claimed_at = NULL, claimed_by = NULL",
+                       (ids.start, ids.stop - 1, local_minute(minute).time()))
+    context = multiprocessing.get_context('spawn')
+    start_at = time.time() + 3
+    processes = [context.Process(target=_instance, args=(api.api_url, overrides, minute, start_at,
+                                                         args.kill_after if i < args.kill else None, args.use_async))
+                 for i in range(args.instances)]
+    started = time.time()
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        sent = Counter(chat_id for _, _, chat_id, _ in api.sent_since(started, views.NOTIFICATION))
+        with db.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM notifications WHERE user_id >= %s AND user_id < %s "
+                           "AND last_sent IS NULL", (ids.start, ids.stop))
+            unsent = cursor.fetchone()[0]
+    finally:
+        with db.cursor() as cursor:
+            cursor.execute("DELETE FROM notifications WHERE user_id >= %s AND user_id < %s", (ids.start, ids.stop))
+        api.stop()
+    duplicates = sum(1 for count in sent.values() if count > 1)
+    missing = sum(1 for user_id in ids if user_id not in sent)
+    print(f"{len(sent)} users notified by {args.instances} instances ({args.kill} killed), "
+          f"{duplicates} duplicates, {missing} missing, {unsent} not recorded as sent")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import telebot
+from telebot import types
+
+from benchmark import target
+from benchmark.fake_api import FakeBotApi
+from benchmark.seed import BASE_USER_ID, seed, user_ids
+
+# Replays a mix of updates against the real handlers, database and render pool, with the Bot API replaced by
+# FakeBotApi. Run from the repository root: python -m benchmark.run --users 1000 --updates 5000
+
+DEFAULT_MIX = 'text=40,get=10,nav=30,graph=20'
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summary(values):
+    return {'count': len(values), 'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99),
+            'max': max(values) if values else None}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, weight = part.split('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def _message(user_id, text):
+    return {'message': {'message_id': 1, 'date': int(time.time()), 'text': text,
+                        'chat': {'id': user_id, 'type': 'private'},
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+                        if text.startswith('/') else []}}
+
+
+def _callback(user_id, data):
+    return {'callback_query': {'id': str(user_id), 'data': data, 'chat_instance': str(user_id),
+                               'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+                               'message': {'message_id': 1, 'date': int(time.time()),
+                                           'chat': {'id': user_id, 'type': 'private'}}}}
+
+
+def make_update(kind, user_id, day, rng):
+    if kind == 'text':
+        return _message(user_id, f'{rng.randint(100, 160)} {rng.randint(60, 100)} {rng.randint(50, 110)}')
+    if kind == 'get':
+        return _message(user_id, '/get')
+    if kind == 'nav':
+        return _callback(user_id, rng.choice([f'year_text_{day.year}', f'month_text_{day:%m-%Y}',
+                                              f'text_{day:%d-%m-%Y}']))
+    if kind == 'graph':
+        return _callback(user_id, rng.choice([f'pict_{day:%d-%m-%Y}', f'draw_month_{day:%m-%Y}',
+                                              f'graph_sum_{day.year}']))
+    raise ValueError(f"Unknown update kind: {kind}")
+
+
+def build_updates(count, users, days, mix, rng, base_user_id=BASE_USER_ID):
+    ids = user_ids(users, base_user_id)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    today = date.today()
+    updates = []
+    for kind in rng.choices(kinds, weights, k=count):
+        day = today - timedelta(days=rng.randrange(days))
+        updates.append((kind, make_update(kind, rng.choice(ids), day, rng)))
+    return updates
+
+
+def replay(updates, concurrency):
+    from bot import bot
+    from storage import storage
+    import handlers  # register the handlers, do not remove!
+    # Handlers run on the replay threads so each measured duration covers the whole update.
+    bot.threaded = False
+    latencies = {}
+    errors = []
+
+    def process(item):
+        kind, body = item
+        update = types.Update.de_json(dict(body, update_id=1))
+        started = time.perf_counter()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            errors.append(f"{kind}: {e}")
+        return kind, time.perf_counter() - started
+
+    def count_queries():
+        return storage.stats()['queries']
+
+    queries = count_queries()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for kind, seconds in executor.map(process, updates):
+            latencies.setdefault(kind, []).append(seconds)
+    elapsed = time.perf_counter() - started
+    queries = count_queries() - queries
+    every = [seconds for values in latencies.values() for seconds in values]
+    return {
+        'updates': len(updates),
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'throughput': len(updates) / elapsed if elapsed else None,
+        'latency': dict(summary(every), by_kind={kind: summary(values) for kind, values in latencies.items()}),
+        'db_queries_per_update': queries / len(updates) if updates else None,
+        'errors': len(errors),
+        'error_samples': errors[:5],
+    }
+
+
+def notification_lag(api, users, count, timeout, base_user_id=BASE_USER_ID):
+    # Schedules `count` users on the current minute and measures when each reminder reaches the fake API.
+    from functions import notify_loop, set_notify_time_db, set_notify_value
+    from scheduler import current_epoch_minute, local_minute
+    import views
+    minute = current_epoch_minute()
+    ids = list(user_ids(users, base_user_id))[:count]
+    for user_id in ids:
+        set_notify_time_db(user_id, local_minute(minute).time())
+    started = time.time()
+    notify_loop(minute)
+    deadline = time.monotonic() + timeout
+    # Other seeded users due in the last [NOTIFY] late_minutes are sent their reminders by the same tick.
+    scheduled = set(ids)
+
+    def delivered():
+        return [sent_at - started for sent_at, _, chat_id, _ in api.sent_since(started, views.NOTIFICATION)
+                if chat_id in scheduled]
+    while time.monotonic() < deadline and len(delivered()) < len(ids):
+        time.sleep(0.05)
+    lags = delivered()
+    for user_id in ids:
+        set_notify_value(user_id, False)
+    return dict(summary(lags), scheduled=len(ids), delivered=len(lags))
+
+
+def compare(results, baseline):
+    # Results from before the storage option have no backend; they ran on Postgres.
+    backends = [run.get('storage', {}).get('backend', 'postgres') for run in (results, baseline)]
+    print(f"{'storage':>18}: {backends[0]} vs {backends[1]}")
+    rows = [
+        ('throughput', results['replay']['throughput'], baseline['replay']['throughput']),
+        ('latency p50', results['replay']['latency']['p50'], baseline['replay']['latency']['p50']),
+        ('latency p99', results['replay']['latency']['p99'], baseline['replay']['latency']['p99']),
+        ('db queries/update', results['replay']['db_queries_per_update'],
+         baseline['replay']['db_queries_per_update']),
+        ('render avg', results['render']['render_seconds_avg'], baseline['render']['render_seconds_avg']),
+        ('notify lag p99', results['notify']['p99'], baseline['notify']['p99']),
+    ]
+    for name, current, previous in rows:
+        if current is None or not previous:
+            print(f"{name:>18}: {current}")
+        else:
+            print(f"{name:>18}: {current:.4f} vs {previous:.4f} ({(current - previous) / previous:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the bot against a fake Bot API.")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--readings-per-day', type=int, default=2)
+    parser.add_argument('--notify-share', type=float, default=0.5)
+    parser.add_argument('--skip-seed', action='store_true', help="reuse rows from a previous run")
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"update kinds and weights, default {DEFAULT_MIX}")
+    parser.add_argument('--notify-users', type=int, default=100)
+    parser.add_argument('--notify-timeout', type=float, default=60)
+    parser.add_argument('--api-latency', type=float, default=0.0, help="seconds added to every fake API call")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="results file, default benchmark/results/<time>.json")
+    parser.add_argument('--compare', default=None, help="previous results file to compare against")
+    parser.add_argument('--storage', choices=['postgres', 'sqlite'], default=None,
+                        help="storage backend, default [STORAGE] backend")
+    parser.add_argument('--sqlite-path', default=None, help="database file for --storage sqlite")
+    target.add_arguments(parser)
+    args = parser.parse_args()
+    # Before anything imports storage, which creates the backend on import.
+    from bot import config
+    if args.storage:
+        config.read_dict({'STORAGE': {'backend': args.storage}})
+    target.apply(target.overrides(parser, args, [config.get('STORAGE', 'backend', fallback='postgres')],
+                                  args.sqlite_path))
+
+    api = FakeBotApi(latency=args.api_latency).start()
+    telebot.apihelper.API_URL = api.api_url
+    from main import bootstrap
+    from chart_cache import chart_cache
+    from dispatcher import notify_dispatcher
+    from ingest import ingest_buffer
+    from render import render_engine
+    from storage import storage
+    from throttle import throttle
+    bootstrap()
+
+    rng = random.Random(args.seed)
+    results = {'started_at': datetime.now().astimezone().isoformat(), 'args': vars(args)}
+    if not args.skip_seed:
+        started = time.perf_counter()
+        results['seed'] = dict(seed(args.users, args.days, args.readings_per_day, args.notify_share,
+                                    random_seed=args.seed), seconds=time.perf_counter() - started)
+    try:
+        results['replay'] = replay(build_updates(args.updates, args.users, args.days, parse_mix(args.mix), rng),
+                                   args.concurrency)
+        results['notify'] = notification_lag(api, args.users, min(args.notify_users, args.users),
+                                             args.notify_timeout)
+        results['render'] = render_engine.stats()
+        results['cache'] = chart_cache.stats()
+        results['storage'] = dict(storage.stats(), backend=storage.name)
+        results['ingest'] = {'flushes': ingest_buffer.flushes, 'rows': ingest_buffer.rows}
+        results['throttle'] = throttle.stats()
+        results['api_calls'] = dict(api.calls)
+    finally:
+        ingest_buffer.close()
+        notify_dispatcher.shutdown()
+        render_engine.shutdown()
+        storage.close()
+        api.stop()
+
+    output = args.output or os.path.join('benchmark', 'results', f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2, default=str)
+    replayed = results['replay']
+    print(f"{storage.name}: {replayed['updates']} updates in {replayed['seconds']:.1f}s, {replayed['throughput']:.1f}/s, "
+          f"p50 {replayed['latency']['p50'] * 1000:.1f}ms, p99 {replayed['latency']['p99'] * 1000:.1f}ms, "
+          f"{replayed['db_queries_per_update']:.2f} queries/update, {replayed['errors']} errors")
+    print(f"Notifications: {results['notify']['delivered']}/{results['notify']['scheduled']} delivered, "
+          f"lag p99 {results['notify']['p99']}")
+    print(f"Results saved to {output}")
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import itertools
+import random
+from datetime import datetime, timedelta
+
+from benchmark import target
+
+# Synthetic users get negative ids from BASE_USER_ID up. Telegram user ids are positive, so even a run against a
+# database with real users in it never seeds, notifies or deletes one of them.
+BASE_USER_ID = -2000000000
+
+
+def user_ids(users, base_user_id=BASE_USER_ID):
+    if base_user_id + users > 0:
+        raise ValueError(f"Synthetic user ids must stay negative, {base_user_id} + {users} users does not")
+    return range(base_user_id, base_user_id + users)
+
+
+def clear(users, base_user_id=BASE_USER_ID):
+    # Imported here so benchmark.run can pick the backend before the storage is created.
+    from storage import storage
+    ids = user_ids(users, base_user_id)
+    storage.delete_users(ids.start, ids.stop)
+
+
+def _readings(ids, days, readings_per_day, rng):
+    today = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+    for user_id in ids:
+        baseline = rng.randint(105, 150)
+        for day in range(days):
+            start = today - timedelta(days=day)
+            for _ in range(readings_per_day):
+                systolic = max(70, int(rng.gauss(baseline, 12)))
+                diastolic = max(40, int(systolic * rng.uniform(0.55, 0.7)))
+                measured_at = start + timedelta(minutes=rng.randint(6 * 60, 23 * 60))
+                yield user_id, systolic, diastolic, rng.randint(50, 110), measured_at
+
+
+def seed(users, days, readings_per_day, notify_share, base_user_id=BASE_USER_ID, random_seed=0, chunk=10000):
+    # Loads readings through the configured storage in batches of `chunk` rows, one commit per batch.
+    from storage import storage
+    rng = random.Random(random_seed)
+    ids = user_ids(users, base_user_id)
+    clear(users, base_user_id)
+    if storage.name == 'postgres':
+        from partitions import partition_maintenance
+        today = datetime.now().astimezone()
+        partition_maintenance.ensure(today - timedelta(days=days), today)
+    rows = 0
+    pending = _readings(ids, days, readings_per_day, rng)
+    while True:
+        batch = list(itertools.islice(pending, chunk))
+        if not batch:
+            break
+        storage.add_readings(batch)
+        rows += len(batch)
+    notified = [(user_id, f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}")
+                for user_id in ids if rng.random() < notify_share]
+    for user_id, notify_time in notified:
+        storage.set_notify(user_id, notify_time, True)
+    return {'users': users, 'days': days, 'readings': rows, 'notifications': len(notified)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed synthetic users, readings and notifications.")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--readings-per-day', type=int, default=2)
+    parser.add_argument('--notify-share', type=float, default=0.5)
+    parser.add_argument('--base-user-id', type=int, default=BASE_USER_ID)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--clear', action='store_true', help="only remove previously seeded rows")
+    parser.add_argument('--sqlite-path', default=None, help="database file, when [STORAGE] backend is sqlite")
+    target.add_arguments(parser)
+    args = parser.parse_args()
+    from bot import config
+    backend = config.get('STORAGE', 'backend', fallback='postgres')
+    target.apply(target.overrides(parser, args, [backend], args.sqlite_path))
+    from storage import storage
+    storage.bootstrap()
+    if args.clear:
+        clear(args.users, args.base_user_id)
+        return
+    print(seed(args.users, args.days, args.readings_per_day, args.notify_share, args.base_user_id, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import argparse
+import io
+import os
+import tempfile
+import threading
+import time
+from datetime import date, datetime, time as day_time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# Runs the same checks against each storage backend, then times the calls the handlers make most, so the
+# backends can be compared without the Bot API and the render pool in the way.
+# Run from the repository root: python -m benchmark.storage_check --storage postgres sqlite
+
+from benchmark import target
+from benchmark.seed import BASE_USER_ID
+
+# Negative like the seeded users, and below them, so the two never touch each other's rows.
+CHECK_USER_ID = BASE_USER_ID - 1000
+
+
+def backend(name, sqlite_path):
+    from bot import config
+    from storage import PostgresStorage
+    if name == 'postgres':
+        return PostgresStorage()
+    from sqlite_storage import SqliteStorage
+    return SqliteStorage(path=sqlite_path,
+                         timezone=config.get('DB', 'timezone', fallback=os.environ.get('TZ', 'UTC')),
+                         max_batch=config.getint('STORAGE', 'max_batch', fallback=500),
+                         busy_timeout_ms=config.getint('STORAGE', 'busy_timeout_ms', fallback=5000),
+                         write_timeout=config.getint('DB', 'statement_timeout_ms', fallback=15000) / 1000,
+                         max_readers=config.getint('STORAGE', 'max_readers', fallback=8))
+
+
+class Checks:
+    def __init__(self, storage, zone):
+        self.storage = storage
+        self.zone = zone
+        self.failures = []
+        self.passed = 0
+
+    def expect(self, name, actual, expected):
+        if actual == expected:
+            self.passed += 1
+        else:
+            self.failures.append(f"{name}: expected {expected!r}, got {actual!r}")
+
+    def local(self, *args):
+        return datetime(*args, tzinfo=self.zone)
+
+    def run(self):
+        storage, user, other = self.storage, CHECK_USER_ID, CHECK_USER_ID + 1
+        storage.bootstrap()
+        for user_id in (user, other):
+            storage.delete_user(user_id)
+
+        self.expect('empty has_readings', storage.has_readings(user), False)
+        self.expect('empty years', storage.years(user), [])
+        self.expect('empty span', tuple(storage.span(user)), (None, None))
+        self.expect('empty notify_setting', storage.notify_setting(user), None)
+        self.expect('empty columns', storage.reading_columns(user, datetime(2000, 1, 1), datetime(2100, 1, 1)),
+                    [[], [], [], []])
+
+        # A Wednesday and a Friday of one week, the next month, and a year earlier. One reading comes in UTC
+        # and one naive, which both mean the same local wall-clock time.
+        wednesday = self.local(2024, 3, 6, 8, 15)
+        rows = [
+            (user, 120, 80, 60, wednesday),
+            (user, 140, 90, 70, self.local(2024, 3, 6, 21, 45).astimezone(timezone.utc)),
+            (user, 130, 85, 65, self.local(2024, 3, 8, 9, 0).replace(tzinfo=None)),
+            (user, 150, 95, 75, self.local(2024, 4, 1, 7, 30)),
+            (user, 110, 70, 55, self.local(2023, 12, 31, 23, 59)),
+            (other, 100, 60, 50, wednesday),
+        ]
+        version = storage.data_version(user)
+        storage.add_readings(rows)
+        self.expect('data_version raised by a write', storage.data_version(user) > version, True)
+        self.expect('has_readings', storage.has_readings(user), True)
+        self.expect('years', storage.years(user), [2023, 2024])
+        self.expect('months', storage.months(user, 2024), [3, 4])
+        self.expect('days', storage.days(user, date(2024, 3, 1), date(2024, 4, 1)),
+                    [date(2024, 3, 6), date(2024, 3, 8)])
+        self.expect('span', tuple(storage.span(user)), (date(2023, 12, 31), date(2024, 4, 1)))
+        self.expect('span of a year', tuple(storage.span(user, 2024)), (date(2024, 3, 6), date(2024, 4, 1)))
+
+        day = storage.readings(user, datetime(2024, 3, 6), datetime(2024, 3, 7))
+        self.expect('readings values', [row[:3] for row in day], [(120, 80, 60), (140, 90, 70)])
+        self.expect('readings instants', [row[3] for row in day], [wednesday, self.local(2024, 3, 6, 21, 45)])
+        self.expect('readings local time', [f"{row[3]:%H:%M}" for row in day], ['08:15', '21:45'])
+        columns = storage.reading_columns(user, datetime(2024, 3, 6), datetime(2024, 3, 9))
+        self.expect('columns', columns[:3], [[120, 140, 130], [80, 90, 85], [60, 70, 65]])
+        self.expect('columns epoch', [round(value) for value in columns[3]],
+                    [round((datetime(2024, 3, 6, 8, 15) - datetime(1970, 1, 1)).total_seconds()),
+                     round((datetime(2024, 3, 6, 21, 45) - datetime(1970, 1, 1)).total_seconds()),
+                     round((datetime(2024, 3, 8, 9, 0) - datetime(1970, 1, 1)).total_seconds())])
+
+        def buckets(bucket, first_day=date(2023, 12, 1), last_day=date(2024, 4, 30)):
+            return [(row[0].replace(tzinfo=None), *(round(value, 2) for value in row[1:]))
+                    for row in storage.aggregated(user, bucket, first_day, last_day)]
+        self.expect('aggregated day', buckets('day', date(2024, 3, 6), date(2024, 3, 6)),
+                    [(datetime(2024, 3, 6), 120, 130, 140, 10, 80, 85, 90, 5, 60, 65, 70, 5, 2)])
+        self.expect('aggregated week', [row[0] for row in buckets('week')],
+                    [datetime(2023, 12, 25), datetime(2024, 3, 4), datetime(2024, 4, 1)])
+        self.expect('aggregated month', buckets('month'), [
+            (datetime(2023, 12, 1), 110, 110, 110, 0, 70, 70, 70, 0, 55, 55, 55, 0, 1),
+            (datetime(2024, 3, 1), 120, 130, 140, 8.16, 80, 85, 90, 4.08, 60, 65, 70, 4.08, 3),
+            (datetime(2024, 4, 1), 150, 150, 150, 0, 95, 95, 95, 0, 75, 75, 75, 0, 1),
+        ])
+
+        # The last reading is the 150 in April; its day goes away and the month's maximum with it.
+        version = storage.data_version(user)
+        storage.delete_last_reading(user)
+        self.expect('data_version raised by a delete', storage.data_version(user) > version, True)
+        self.expect('delete_last days', storage.days(user, date(2024, 4, 1), date(2024, 5, 1)), [])
+        self.expect('delete_last span', tuple(storage.span(user)), (date(2023, 12, 31), date(2024, 3, 8)))
+        # Same within a day: a later reading on the 8th holds that day's maximum until it is deleted.
+        storage.add_readings([(user, 160, 100, 90, self.local(2024, 3, 8, 22, 0))])
+        storage.delete_last_reading(user)
+        self.expect('calendar after delete', buckets('day', date(2024, 3, 6), date(2024, 3, 8)), [
+            (datetime(2024, 3, 6), 120, 130, 140, 10, 80, 85, 90, 5, 60, 65, 70, 5, 2),
+            (datetime(2024, 3, 8), 130, 130, 130, 0, 85, 85, 85, 0, 65, 65, 65, 0, 1),
+        ])
+
+        # A failing import leaves nothing behind.
+        before = len(storage.readings(user, datetime(2000, 1, 1), datetime(2100, 1, 1)))
+        try:
+            storage.import_readings(user, [(self.local(2022, 6, 1, 8, 0), 120, 80, 60),
+                                           (None, 120, 80, 60)])
+            self.expect('import with a bad row raises', False, True)
+        except Exception:
+            self.passed += 1
+        self.expect('import is all or nothing', len(storage.readings(user, datetime(2000, 1, 1),
+                                                                    datetime(2100, 1, 1))), before)
+        storage.import_readings(user, [(self.local(2022, 6, 1, 8, 0), 120, 80, 60),
+                                       (datetime(2022, 6, 2, 8, 0), 125, 82, 61)])
+        self.expect('import', storage.years(user), [2022, 2023, 2024])
+
+        from views import parse_readings_csv
+        export = io.BytesIO()
+        count = storage.export_csv(user, export)
+        exported, error = parse_readings_csv(export.getvalue())
+        everything = storage.readings(user, datetime(2000, 1, 1), datetime(2100, 1, 1))
+        self.expect('export count', count, len(everything))
+        self.expect('export parses', error, None)
+        self.expect('export round trip', [(row[0].astimezone(self.zone), *row[1:]) for row in exported or []],
+                    [(row[3], *row[:3]) for row in everything])
+        self.expect('export of nothing', storage.export_csv(CHECK_USER_ID + 2, io.BytesIO()), 0)
+
+        storage.set_notify(user, None, False)
+        self.expect('notify off', storage.notify_setting(user), (None, False))
+        storage.set_notify(user, '03:17', True)
+        self.expect('notify on', tuple(storage.notify_setting(user)), (day_time(3, 17), True))
+        storage.set_notify(other, '03:17', False)
+        # A minute long gone, so no reminder of a seeded user is due at it.
+        due_at = datetime(2001, 2, 3, 3, 17).astimezone()
+        claimed = storage.claim_notifications([due_at], 'check', 3600, 100000)
+        self.expect('claim', [row for row in claimed if row[0] in (user, other)], [(user, due_at)])
+        self.expect('claim leased', user in dict(storage.claim_notifications([due_at], 'other', 3600, 100000)), False)
+        self.expect('claim expired lease', dict(storage.claim_notifications([due_at], 'other', 0, 100000)).get(user),
+                    due_at)
+        storage.notification_sent(user, due_at)
+        self.expect('claim once sent', user in dict(storage.claim_notifications([due_at], 'other', 0, 100000)), False)
+        self.expect('claim a late minute', dict(storage.claim_notifications(
+            [due_at + timedelta(days=1, minutes=5), due_at + timedelta(days=1)], 'check', 3600, 100000)).get(user),
+            due_at + timedelta(days=1))
+
+        self.expect('active_users', [user_id for user_id in storage.active_users(date(2024, 3, 1))
+                                     if user_id in (user, other)], [user, other])
+        self.expect('claim_digests', storage.claim_digests(date(2001, 1, 1), [user, other]), [user])
+        self.expect('claim_digests once', storage.claim_digests(date(2001, 1, 1), [user, other]), [])
+
+        # Concurrent writers, as from the ingest buffer and handlers at once.
+        storage.delete_readings(user)
+        self.expect('delete_readings', storage.has_readings(user), False)
+        self.expect('delete_readings keeps notify', tuple(storage.notify_setting(user)), (day_time(3, 17), True))
+        threads = [threading.Thread(target=lambda base: [
+            storage.add_readings([(user, 120, 80, 60, self.local(2024, 5, 1 + base, 8, minute))])
+            for minute in range(50)], args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.expect('concurrent writes', len(storage.readings(user, datetime(2024, 5, 1), datetime(2024, 6, 1))), 400)
+        self.expect('concurrent calendar', sum(row[-1] for row in storage.aggregated(
+            user, 'month', date(2024, 5, 1), date(2024, 5, 31))), 400)
+
+        storage.delete_user(user)
+        self.expect('delete_user', (storage.has_readings(user), storage.notify_setting(user)), (False, None))
+        self.expect('delete_user keeps others', storage.has_readings(other), True)
+        storage.delete_users(other, other + 1)
+        self.expect('delete_users', (storage.has_readings(other), storage.notify_setting(other)), (False, None))
+
+
+def timings(storage, zone, repeat, concurrency):
+    # Mean seconds per call, sequential, and writes per second from `concurrency` threads.
+    user = CHECK_USER_ID
+    start = datetime.now(zone).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=90)
+    storage.delete_user(user)
+    storage.add_readings([(user, 120, 80, 60, start + timedelta(hours=12 * i)) for i in range(180)])
+    today = start.date() + timedelta(days=45)
+    calls = {
+        'add_readings': lambda i: storage.add_readings([(user, 120, 80, 60, start + timedelta(minutes=i))]),
+        'years': lambda i: storage.years(user),
+        'days': lambda i: storage.days(user, today.replace(day=1), today.replace(day=1) + timedelta(days=31)),
+        'readings': lambda i: storage.readings(user, datetime(today.year, today.month, today.day),
+                                               datetime(today.year, today.month, today.day) + timedelta(days=1)),
+        'aggregated': lambda i: storage.aggregated(user, 'week', start.date(), today + timedelta(days=45)),
+        'reading_columns': lambda i: storage.reading_columns(user, start.replace(tzinfo=None),
+                                                             datetime.now()),
+        'notify_setting': lambda i: storage.notify_setting(user),
+    }
+    results = {}
+    for name, call in calls.items():
+        started = time.perf_counter()
+        for i in range(repeat):
+            call(i)
+        results[name] = (time.perf_counter() - started) / repeat
+
+    def writer(thread):
+        for i in range(repeat):
+            storage.add_readings([(user, 120, 80, 60, start + timedelta(seconds=thread * repeat + i))])
+    threads = [threading.Thread(target=writer, args=(thread,)) for thread in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results['concurrent writes/s'] = concurrency * repeat / (time.perf_counter() - started)
+    storage.delete_user(user)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the storage backends.")
+    parser.add_argument('--storage', nargs='+', choices=['postgres', 'sqlite'], default=['postgres', 'sqlite'])
+    parser.add_argument('--sqlite-path', default=None, help="database file, default a temporary one")
+    parser.add_argument('--repeat', type=int, default=200, help="calls per timed operation, 0 to skip timing")
+    parser.add_argument('--concurrency', type=int, default=8)
+    target.add_arguments(parser)
+    args = parser.parse_args()
+    # Without --sqlite-path the SQLite checks run on a temporary file, which is always a database of their own.
+    checked = [name for name in args.storage if name == 'postgres' or args.sqlite_path]
+    target.apply(target.overrides(parser, args, checked, args.sqlite_path))
+    from bot import config
+    zone = ZoneInfo(config.get('DB', 'timezone', fallback=os.environ.get('TZ', 'UTC')))
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.storage:
+            storage = backend(name, args.sqlite_path or os.path.join(directory, 'check.sqlite3'))
+            try:
+                checks = Checks(storage, zone)
+                checks.run()
+                print(f"{name}: {checks.passed} checks passed, {len(checks.failures)} failed")
+                for failure in checks.failures:
+                    print(f"  {failure}")
+                failed = failed or bool(checks.failures)
+                if args.repeat:
+                    for operation, value in timings(storage, zone, args.repeat, args.concurrency).items():
+                        if operation.endswith('/s'):
+                            print(f"  {operation:>20}: {value:.0f}")
+                        else:
+                            print(f"  {operation:>20}: {value * 1000:.3f}ms")
+            finally:
+                storage.close()
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
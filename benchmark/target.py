@@ -0,0 +1,45 @@
+import os
+
+# The harness seeds readings, turns reminders on and range-deletes users wherever it is pointed, so it refuses to
+# run against the database in config.ini unless told to: a config.ini with real users in it must never be one
+# missing flag away from a benchmark run.
+
+
+def add_arguments(parser):
+    parser.add_argument('--database', default=None,
+                        help="Postgres database of its own to run against instead of [DB] database, "
+                             "created on first use")
+    parser.add_argument('--allow-configured-database', action='store_true',
+                        help="run against [DB] database / [STORAGE] path as configured; only for one without "
+                             "real users")
+
+
+def overrides(parser, args, backends, sqlite_path=None):
+    # Config overrides (for apply) that point each of `backends` at a database of the benchmark's own. Exits with a
+    # usage error when one of them would be the configured database and --allow-configured-database is not given.
+    from bot import config
+    result = {}
+    if 'postgres' in backends:
+        if args.database and args.database != config.get('DB', 'database'):
+            result['DB'] = {'database': args.database}
+        elif not args.allow_configured_database:
+            parser.error(f"refusing to write to the configured database {config.get('DB', 'database')!r}; "
+                         f"pass --database <benchmark database> or --allow-configured-database")
+    if 'sqlite' in backends:
+        configured = os.path.abspath(config.get('STORAGE', 'path', fallback='bot.sqlite3'))
+        if sqlite_path and os.path.abspath(sqlite_path) != configured:
+            result['STORAGE'] = {'path': sqlite_path}
+        elif not args.allow_configured_database:
+            parser.error(f"refusing to write to the configured database {configured!r}; "
+                         f"pass --sqlite-path <benchmark file> or --allow-configured-database")
+    return result
+
+
+def apply(overrides):
+    # Before anything imports database or storage, which connect to whatever config says at import time. Spawned
+    # processes read config.ini again and have to apply the same overrides.
+    from bot import config
+    config.read_dict(overrides)
+    if 'DB' in overrides:
+        # A configured replica streams from the configured database, not this one.
+        config.remove_section('DB_REPLICA')
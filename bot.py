@@ -1,18 +1,9 @@
 import configparser
-import psycopg2
 import telebot
-from psycopg2 import pool
 
 config = configparser.ConfigParser()
 config.read('config.ini')
+if config.has_option('TG', 'api_url'):
+    # e.g. http://localhost:8081/bot{0}/{1} to run against a local or fake Bot API server
+    telebot.apihelper.API_URL = config.get('TG', 'api_url')
 bot = telebot.TeleBot(config.get('TG', 'token'))
-
-connection_pool = psycopg2.pool.SimpleConnectionPool(
-    minconn=config.get('DB', 'minconn'),
-    maxconn=config.get('DB', 'maxconn'),
-    host=config.get('DB', 'host'),
-    port=config.get('DB', 'port'),
-    database=config.get('DB', 'database'),
-    user=config.get('DB', 'user'),
-    password=config.get('DB', 'password')
-)
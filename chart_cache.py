@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+from bot import config
+from metrics import metrics
+from storage import storage
+
+
+class ChartCache:
+    # LRU of rendered charts keyed by (user_id, scope, data version). An entry holds the Telegram file_id
+    # of an earlier upload and/or the PNG bytes. The version is the user's counter in the database, raised by
+    # the triggers on every write to their readings, so a write through any instance makes all their entries stale.
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._user_keys = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def version(self, user_id):
+        return storage.data_version(user_id)
+
+    def forget(self, user_id):
+        # Frees this process's entries after a write through it; entries elsewhere just age out of their LRU.
+        with self._lock:
+            for key in self._user_keys.pop(user_id, ()):
+                self._drop(key)
+
+    def get(self, user_id, scope, version):
+        with self._lock:
+            entry = self._entries.get((user_id, scope, version))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((user_id, scope, version))
+            self.hits += 1
+            return entry
+
+    def contains(self, user_id, scope, version):
+        # Like get() without counting a hit or a miss, for background work checking what is already cached.
+        with self._lock:
+            return (user_id, scope, version) in self._entries
+
+    def put(self, user_id, scope, version, file_id=None, png=None):
+        # Pass the version read before fetching the data, so a chart built from rows that changed
+        # mid-render is stored under an already stale key.
+        with self._lock:
+            key = (user_id, scope, version)
+            old = self._entries.get(key)
+            if old is not None:
+                file_id = file_id or old[0]
+                png = png if png is not None else old[1]
+                self._drop(key)
+            self._entries[key] = (file_id, png)
+            self._user_keys.setdefault(user_id, set()).add(key)
+            self._bytes += self._size(file_id, png)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+
+    def discard(self, user_id, scope, version):
+        with self._lock:
+            self._drop((user_id, scope, version))
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def _size(file_id, png):
+        return len(file_id or '') + len(png or b'')
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= self._size(*entry)
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+
+
+chart_cache = ChartCache(
+    max_entries=config.getint('CACHE', 'max_entries', fallback=10000),
+    max_bytes=config.getint('CACHE', 'max_bytes', fallback=64 * 1024 * 1024),
+)
+metrics.gauge('bot_chart_cache', "Chart cache size and hit counts.", chart_cache.stats)
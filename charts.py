@@ -0,0 +1,61 @@
+from io import BytesIO
+
+# Runs inside the render worker processes. Each worker also imports the main script as __mp_main__ when it starts
+# (its `if __name__ == '__main__'` block does not run), so main.py and everything it imports must not open
+# connections or start threads at import time. matplotlib is only imported inside the functions, so the bot process
+# never loads it.
+
+
+def init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def warm_up():
+    # Draws a throwaway chart so the font cache and the Agg backend are loaded before the first real request.
+    return len(line_chart('', '', [0, 1], [('warm-up', 'b', [0, 1])]))
+
+
+def live_figures():
+    # Figures still alive in this worker. Figure objects are not registered anywhere, so the GC is asked.
+    import gc
+    import os
+    from matplotlib.figure import Figure
+    gc.collect()
+    return os.getpid(), sum(isinstance(obj, Figure) for obj in gc.get_objects())
+
+
+def line_chart(title, xlabel, x, series):
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
+    for label, color, values in series:
+        ax.plot(x, values, color=color, label=label)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel('Values')
+    ax.set_title(title)
+    ax.legend()
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def range_chart(title, xlabel, x, series):
+    # Long-range view: one mean line per metric, a darker band one standard deviation either side of it and the
+    # min..max band shaded behind both.
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
+    for label, color, low, mean, high, deviation in series:
+        ax.fill_between(x, low, high, color=color, alpha=0.15, linewidth=0)
+        ax.fill_between(x, [m - d for m, d in zip(mean, deviation)], [m + d for m, d in zip(mean, deviation)],
+                        color=color, alpha=0.25, linewidth=0)
+        ax.plot(x, mean, color=color, label=label)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel('Values')
+    ax.set_title(title)
+    ax.legend()
+    fig.autofmt_xdate()
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
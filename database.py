@@ -0,0 +1,250 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, cursor as base_cursor
+
+from bot import config
+from metrics import metrics
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Database:
+    # Thread-safe connection pool. psycopg2's ThreadedConnectionPool raises as soon as it is exhausted, so
+    # checkouts first wait on a semaphore sized to maxconn; that is also where the waiting/latency stats come from.
+    def __init__(self, minconn, maxconn, checkout_timeout, health_check_interval, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._connect_kwargs = dict(connect_kwargs, cursor_factory=self._counting_cursor())
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.in_use = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.discarded = 0
+        self.checkout_seconds = 0.0
+        self.checkout_seconds_max = 0.0
+        self.queries = 0
+        self._query_lock = threading.Lock()
+
+    def _counting_cursor(self):
+        database = self
+
+        class CountingCursor(base_cursor):
+            # Counts statements sent to the server, so "queries per update" can be measured under load.
+            def execute(self, query, vars=None):
+                database._count_query()
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                database._count_query()
+                return super().executemany(query, vars_list)
+
+            def copy_expert(self, sql, file, size=8192):
+                database._count_query()
+                return super().copy_expert(sql, file, size)
+
+        return CountingCursor
+
+    def _count_query(self):
+        with self._query_lock:
+            self.queries += 1
+
+    def _get_pool(self):
+        # Created on first use, so importing this module never opens a connection.
+        with self._lock:
+            if self._pool is None:
+                self._pool = pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self._connect_kwargs)
+            return self._pool
+
+    def getconn(self):
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        acquired = self._slots.acquire(timeout=self.checkout_timeout)
+        with self._lock:
+            self.waiting -= 1
+            if not acquired:
+                self.timeouts += 1
+        if not acquired:
+            raise PoolTimeout(f"No database connection available after {self.checkout_timeout}s.")
+        try:
+            conn = self._healthy(self._get_pool().getconn())
+        except Exception:
+            self._slots.release()
+            raise
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.checkout_seconds += elapsed
+            self.checkout_seconds_max = max(self.checkout_seconds_max, elapsed)
+        return conn
+
+    def _healthy(self, conn):
+        # Connections idle for longer than health_check_interval are pinged before being handed out.
+        idle = time.monotonic() - self._last_used.get(id(conn), 0.0)
+        if not conn.closed and idle < self.health_check_interval:
+            return conn
+        try:
+            if not conn.closed:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+                return conn
+        except psycopg2.Error:
+            logging.warning("Discarding broken database connection.")
+        self._pool.putconn(conn, close=True)
+        with self._lock:
+            self.discarded += 1
+        return self._pool.getconn()
+
+    def putconn(self, conn, close=False):
+        try:
+            if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        close = close or bool(conn.closed)
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    @contextmanager
+    def connection(self, autocommit=False):
+        conn = self.getconn()
+        broken = False
+        try:
+            if autocommit:
+                conn.autocommit = True
+            yield conn
+            if not autocommit:
+                conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if autocommit and not conn.closed:
+                conn.autocommit = False
+            self.putconn(conn, close=broken)
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
+
+    def stats(self):
+        with self._lock:
+            return {
+                'maxconn': self.maxconn,
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+                'checkout_seconds_avg': self.checkout_seconds / self.checkouts if self.checkouts else 0.0,
+                'checkout_seconds_max': self.checkout_seconds_max,
+                'queries': self.queries,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+class ReadRouter:
+    # Sends a user's reads to the replica, except within `window` seconds of that user's own last write: those go to
+    # the primary, so a reading that was just saved (or a notification that was just changed) is never missing
+    # because the replica has not replayed it yet. Without a replica everything goes to the primary.
+    def __init__(self, primary, replica, window):
+        self.primary = primary
+        self.replica = replica
+        self.window = window
+        # user_id -> time of the last write, oldest first, so expired entries are pruned from the front.
+        self._written = OrderedDict()
+        self._lock = threading.Lock()
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def wrote(self, user_id):
+        if self.replica is None:
+            return
+        with self._lock:
+            self._written[user_id] = time.monotonic()
+            self._written.move_to_end(user_id)
+
+    def for_user(self, user_id):
+        if self.replica is None:
+            return self.primary
+        now = time.monotonic()
+        with self._lock:
+            while self._written and now - next(iter(self._written.values())) >= self.window:
+                self._written.popitem(last=False)
+            if user_id in self._written:
+                self.primary_reads += 1
+                return self.primary
+            self.replica_reads += 1
+            return self.replica
+
+    def stats(self):
+        with self._lock:
+            return {'replica': self.replica_reads, 'primary': self.primary_reads, 'recent_writers': len(self._written)}
+
+
+def config_option(section, option, fallback=None):
+    # [DB_REPLICA] only needs the settings that differ from [DB].
+    return config.get(section, option, fallback=config.get('DB', option, fallback=fallback))
+
+
+def database_from_config(section, options=''):
+    return Database(
+        minconn=int(config_option(section, 'minconn')),
+        maxconn=int(config_option(section, 'maxconn')),
+        checkout_timeout=float(config_option(section, 'checkout_timeout', fallback=10)),
+        health_check_interval=float(config_option(section, 'health_check_interval', fallback=30)),
+        host=config_option(section, 'host'),
+        port=config_option(section, 'port'),
+        database=config_option(section, 'database'),
+        user=config_option(section, 'user'),
+        password=config_option(section, 'password'),
+        # Day and month boundaries are computed in this zone, both in Python and in SQL.
+        options='-c timezone={} -c statement_timeout={}{}'.format(
+            config.get('DB', 'timezone', fallback=os.environ.get('TZ', 'UTC')),
+            int(config_option(section, 'statement_timeout_ms', fallback=15000)), options),
+    )
+
+
+db = database_from_config('DB')
+# Optional read replica; sessions on it are read-only, so a write routed there by mistake fails loudly.
+replica = (database_from_config('DB_REPLICA', ' -c default_transaction_read_only=on')
+           if config.has_section('DB_REPLICA') else None)
+reads = ReadRouter(db, replica, config.getfloat('DB_REPLICA', 'read_your_writes_seconds', fallback=5))
+metrics.gauge('bot_db_pool', "Database connection pool usage.",
+              lambda: {key: value for key, value in db.stats().items() if not key.startswith('checkout_seconds')})
+if replica is not None:
+    metrics.gauge('bot_db_replica_pool', "Read replica connection pool usage.",
+                  lambda: {key: value for key, value in replica.stats().items()
+                           if not key.startswith('checkout_seconds')})
+    metrics.gauge('bot_db_reads', "Reads routed to the replica and, after a user's own write, to the primary.",
+                  reads.stats)
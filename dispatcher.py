@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import asyncio_helper
+from telebot.apihelper import ApiTelegramException
+
+from bot import config
+from metrics import metrics
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        return self.reserve() == 0.0
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.reserve()
+            if wait == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def reserve(self):
+        # Takes a token and returns 0.0, or returns how long to wait before trying again.
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+
+class NotifyDispatcher:
+    def __init__(self, workers, global_rate, per_chat_rate, max_retries, max_pending, max_chats=10000):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notify")
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._global = TokenBucket(global_rate)
+        self._per_chat_rate = per_chat_rate
+        self._chats = OrderedDict()
+        self._max_chats = max_chats
+        self._chats_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.workers = workers
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self.last_report = None
+
+    def _chat_bucket(self, chat_id):
+        with self._chats_lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = self._chats[chat_id] = TokenBucket(self._per_chat_rate, 1)
+                if len(self._chats) > self._max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_id)
+            return bucket
+
+    def _retry_after(self, e, chat_id, attempt):
+        # Returns the back-off for a retryable 429, or None when the error should be raised.
+        if e.error_code != 429 or attempt == self.max_retries:
+            return None
+        retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+        logging.warning(f"Rate limited while notifying {chat_id}, retrying in {retry_after}s.")
+        # A 429 means the bot as a whole is over the limit, so every worker backs off.
+        self._global.pause(retry_after)
+        return retry_after
+
+    def _deliver(self, send, chat_id):
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            self._global.acquire()
+            bucket.acquire()
+            try:
+                send(chat_id)
+                return
+            except ApiTelegramException as e:
+                if self._retry_after(e, chat_id, attempt) is None:
+                    raise
+
+    def dispatch(self, chat_ids, send, done=None):
+        # Sends run on the worker pool; the caller only blocks when max_pending sends are already queued.
+        # done(chat_id) is called once a send is settled: delivered, or refused by Telegram. After any other error
+        # (e.g. the network) it is not, and the caller's claim is left to expire and be retried.
+        if not chat_ids:
+            return
+        tick = _Tick(len(chat_ids), self)
+        for chat_id in chat_ids:
+            self._pending.acquire()
+            with self._in_flight_lock:
+                self.in_flight += 1
+            self._executor.submit(self._run, tick, send, chat_id, done)
+
+    def _run(self, tick, send, chat_id, done):
+        try:
+            if self._settle(tick, send, chat_id) and done is not None:
+                done(chat_id)
+        except Exception:
+            logging.exception(f"Failed to record the notification for user {chat_id}.")
+        finally:
+            with self._in_flight_lock:
+                self.in_flight -= 1
+            self._pending.release()
+
+    def _settle(self, tick, send, chat_id):
+        # True once the send is settled, see dispatch().
+        try:
+            self._deliver(send, chat_id)
+            tick.done(True)
+            return True
+        except ApiTelegramException:
+            logging.exception(f"Telegram refused the notification for user {chat_id}.")
+            tick.done(False)
+            return True
+        except Exception:
+            logging.exception(f"Failed to notify user {chat_id}.")
+            tick.done(False)
+            return False
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    async def _acquire_async(self, bucket):
+        while (wait := bucket.reserve()) > 0.0:
+            await asyncio.sleep(wait)
+
+    async def _deliver_async(self, send, chat_id):
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_async(self._global)
+            await self._acquire_async(bucket)
+            try:
+                await send(chat_id)
+                return
+            except asyncio_helper.ApiTelegramException as e:
+                if self._retry_after(e, chat_id, attempt) is None:
+                    raise
+
+    async def _settle_async(self, tick, send, chat_id):
+        try:
+            await self._deliver_async(send, chat_id)
+            tick.done(True)
+            return True
+        except asyncio_helper.ApiTelegramException:
+            logging.exception(f"Telegram refused the notification for user {chat_id}.")
+            tick.done(False)
+            return True
+        except Exception:
+            logging.exception(f"Failed to notify user {chat_id}.")
+            tick.done(False)
+            return False
+
+    async def dispatch_async(self, chat_ids, send, done=None):
+        # Same limits and done() as dispatch(), for the asyncio runtime: `workers` bounds concurrent sends, and
+        # done is a coroutine function.
+        if not chat_ids:
+            return
+        tick = _Tick(len(chat_ids), self)
+        workers = asyncio.Semaphore(self.workers)
+
+        async def run(chat_id):
+            async with workers:
+                self.in_flight += 1
+                try:
+                    if await self._settle_async(tick, send, chat_id) and done is not None:
+                        await done(chat_id)
+                except Exception:
+                    logging.exception(f"Failed to record the notification for user {chat_id}.")
+                finally:
+                    self.in_flight -= 1
+
+        await asyncio.gather(*(run(chat_id) for chat_id in chat_ids))
+
+
+class _Tick:
+    def __init__(self, total, dispatcher):
+        self.started = time.monotonic()
+        self.total = total
+        self.latencies = []
+        self.failed = 0
+        self._dispatcher = dispatcher
+        self._lock = threading.Lock()
+
+    def done(self, delivered):
+        latency = time.monotonic() - self.started
+        if delivered:
+            metrics.observe('notify', 'delivery', latency)
+        else:
+            metrics.error('notify', 'delivery')
+        with self._lock:
+            if delivered:
+                self.latencies.append(latency)
+            else:
+                self.failed += 1
+            if len(self.latencies) + self.failed < self.total:
+                return
+        latencies = sorted(self.latencies) or [0.0]
+        report = {
+            'total': self.total,
+            'delivered': len(self.latencies),
+            'failed': self.failed,
+            'p50': latencies[len(latencies) // 2],
+            'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+            'max': latencies[-1],
+        }
+        self._dispatcher.last_report = report
+        logging.info("Notification tick: {delivered}/{total} delivered, {failed} failed, "
+                     "latency p50={p50:.2f}s p99={p99:.2f}s max={max:.2f}s".format(**report))
+
+
+notify_dispatcher = NotifyDispatcher(
+    workers=config.getint('NOTIFY', 'workers', fallback=8),
+    global_rate=config.getfloat('NOTIFY', 'global_rate', fallback=30),
+    per_chat_rate=config.getfloat('NOTIFY', 'per_chat_rate', fallback=1),
+    max_retries=config.getint('NOTIFY', 'max_retries', fallback=3),
+    max_pending=config.getint('NOTIFY', 'max_pending', fallback=1000),
+)
+metrics.gauge('bot_notify_queue', "Reminder sends queued or in progress.",
+              lambda: {'in_flight': notify_dispatcher.in_flight, 'max_pending': notify_dispatcher.max_pending})
@@ -1,251 +1,227 @@
 import logging
-import time
-from datetime import datetime
-from io import BytesIO
-import psycopg2
-from matplotlib import pyplot as plt
-from psycopg2 import sql
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from telebot import types
-from bot import bot, config, connection_pool
-
-
-def start_app(message):
-    bot.send_message(message.chat.id,
-                     "Arterial Pressure Monitoring.\nTo start please enter three values separated by spaces. "
-                     "\nSystolic | Diastolic | Pulse. "
-                     "\nExample: \"120 80 60\" \n--- "
-                     "\nAvailable commands:"
-                     "\n/help -- view help information"
-                     "\n/get -- get information by date"
-                     "\n/graph -- get graph based on your information"
-                     "\n/notify -- configure notification"
-                     "\n/reset -- click this "
-                     "if you need to reload keyboard buttons"
-                     "\n/delete -- clear your data")
-    set_notify_value(message.chat.id, False)
-    logging.debug(f"User {message.chat.id} activated bot.")
-    reload(message)
-
-
-def reload(message):
-    btn_get = types.KeyboardButton('/get')
-    btn_graph = types.KeyboardButton('/graph')
-    btn_ntf = types.KeyboardButton('/notify')
-    btn_del = types.KeyboardButton('/delete')
-    keyboard = types.ReplyKeyboardMarkup(row_width=2)
-    keyboard.add(btn_ntf, btn_del, btn_get, btn_graph)
-    bot.send_message(message.chat.id, "Input information or click on buttons.", reply_markup=keyboard)
-
-
-def select_user_data_by_id(user_id):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM user_input WHERE user_id=%s", (user_id,))
-    rows = cursor.fetchall()
-    if len(rows) != 0:
-        date = [row[4] for row in rows]
-        systolic = [row[1] for row in rows]
-        diastolic = [row[2] for row in rows]
-        pulse = [row[3] for row in rows]
-        plt.figure()
-        plt.plot(date, systolic, color='red', label='Systolic')
-        plt.plot(date, diastolic, color='blue', label='Diastolic')
-        plt.plot(date, pulse, color='green', label='pulse')
-        plt.xlabel('Time')
-        plt.ylabel('Values')
-        plt.title('Arterial Pressure Summary')
-        plt.legend()
-        buffer = BytesIO()
-        plt.savefig(buffer, format='png')
-        buffer.seek(0)
-        bot.send_photo(chat_id=user_id, photo=buffer)
-        buffer.close()
-        plt.close()
-        cursor.close()
-        conn.close()
-    else:
-        bot.send_message(user_id, "No data found for the selected date.")
+import os
+import socket
+from datetime import datetime, timedelta
+from telebot.apihelper import ApiTelegramException
+from bot import bot, config
+from chart_cache import chart_cache
+from dispatcher import notify_dispatcher
+from ingest import ingest_buffer
+from metrics import timed
+from render import render_engine, RenderError
+from scheduler import local_minute, run_every_minute
+from storage import storage
+import views
+
+# Queries and chart arguments shared by both runtimes (replies.py runs them for the asyncio bot too), and the Bot API
+# side of the threaded bot.
+
+
+def send_chart(chat_id, reply):
+    # reply is a views.Chart.
+    if reply.cached is not None and send_cached_chart(chat_id, reply):
+        return
+    args = reply.args or reply.build()
+    if args is None:
+        bot.send_message(chat_id, views.NO_DATA_FOR_DATE)
+        return
+    try:
+        png = render_engine.render(reply.chart, *args)
+    except RenderError:
+        bot.send_message(chat_id, views.CHART_UNAVAILABLE)
+        return
+    message = bot.send_photo(chat_id=chat_id, photo=png)
+    if message.photo:
+        chart_cache.put(chat_id, reply.scope, reply.version, file_id=message.photo[-1].file_id)
+
+
+def send_cached_chart(chat_id, reply):
+    file_id, png = reply.cached
+    try:
+        message = bot.send_photo(chat_id=chat_id, photo=file_id or png)
+    except ApiTelegramException:
+        logging.warning(f"Cached chart {reply.scope} for {chat_id} was rejected, rendering again.")
+        chart_cache.discard(chat_id, reply.scope, reply.version)
+        return False
+    if not file_id and message.photo:
+        chart_cache.put(chat_id, reply.scope, reply.version, file_id=message.photo[-1].file_id)
+    return True
+
+
+def summary_chart(user_id, year=None):
+    # range_chart arguments for the all-time or yearly chart, or None when there is nothing to draw.
+    first_day, last_day = get_data_span(user_id, year)
+    if first_day is None:
+        return None
+    bucket = views.pick_bucket(first_day, last_day)
+    rows = get_aggregated_data(user_id, bucket, first_day, last_day)
+    # Buckets come back in the session timezone; plot them as local wall-clock dates.
+    x = [row[0].replace(tzinfo=None) for row in rows]
+    title = 'Arterial Pressure Summary' if year is None else f'Arterial Pressure {year}'
+    return title, bucket.capitalize(), x, views.range_series(rows)
+
+
+def month_chart(user_id, year, month):
+    # line_chart arguments for one month of readings, or None when there are none.
+    data = get_saved_month_data(user_id, year, month)
+    if not data:
+        return None
+    x = [row[3].strftime('%d') for row in data]
+    return 'Arterial Pressure', 'Date', x, views.reading_series(data)
+
+
+def day_chart(user_id, day):
+    # line_chart arguments for one day of readings, or None when there are none.
+    data = get_saved_data(user_id, day)
+    if not data:
+        return None
+    x = [row[3].strftime('%H:%M') for row in data]
+    return 'Arterial Pressure', 'Time', x, views.reading_series(data)
 
 
+def add_reading(user_id, systolic, diastolic, pulse):
+    ingest_buffer.add(user_id, systolic, diastolic, pulse)
+    chart_cache.forget(user_id)
+
+
+@timed('query')
 def delete_data_by_user_id(user_id):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM user_input WHERE user_id = %s', (user_id,))
-    conn.commit()
-    connection_pool.putconn(conn)
+    storage.delete_readings(user_id)
+    chart_cache.forget(user_id)
 
 
+@timed('query')
 def delete_last_data_by_user_id(user_id):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    query = """
-        DELETE FROM user_input
-        WHERE id = (
-            SELECT MAX(id)
-            FROM user_input
-            WHERE user_id = %s
-        ) AND user_id = %s;
-    """
-    cursor.execute(query, (user_id, user_id))
-    conn.commit()
-    connection_pool.putconn(conn)
-
-
-def get_saved_dates(user_id):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT date FROM user_input WHERE user_id = %s', (user_id,))
-    dates = [row[0] for row in cursor.fetchall()]
-    connection_pool.putconn(conn)
-    return dates
-
-
-def get_saved_days(user_id, month):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT date FROM user_input WHERE user_id = %s AND date LIKE %s", (user_id, month))
-    days = [row[0] for row in cursor.fetchall()]
-    connection_pool.putconn(conn)
-    return days
+    storage.delete_last_reading(user_id)
+    chart_cache.forget(user_id)
+
+
+def day_range(day):
+    start = datetime(day.year, day.month, day.day)
+    return start, start + timedelta(days=1)
+
+
+def month_range(year, month):
+    start = datetime(year, month, 1)
+    return start, datetime(year + month // 12, month % 12 + 1, 1)
+
+
+@timed('query')
+def has_saved_data(user_id):
+    return storage.has_readings(user_id)
+
+
+@timed('query')
+def get_saved_years(user_id):
+    return storage.years(user_id)
+
+
+@timed('query')
+def get_saved_months(user_id, year):
+    return storage.months(user_id, year)
 
 
+@timed('query')
+def get_saved_days(user_id, year, month):
+    start, end = month_range(year, month)
+    return storage.days(user_id, start.date(), end.date())
+
+
+@timed('query')
+def get_data_span(user_id, year=None):
+    return storage.span(user_id, year)
+
+
+@timed('query')
+def get_aggregated_data(user_id, bucket, first_day, last_day):
+    # bucket is one of 'day', 'week', 'month'.
+    return storage.aggregated(user_id, bucket, first_day, last_day)
+
+
+@timed('query')
 def get_saved_data(user_id, selected_date):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT systolic, diastolic, pulse, time FROM user_input WHERE user_id = %s AND date = %s',
-                   (user_id, selected_date))
-    data = cursor.fetchall()
-    connection_pool.putconn(conn)
-    return data
-
-
-def get_saved_month_data(user_id, selected_date):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT systolic, diastolic, pulse, date FROM user_input WHERE user_id = %s AND date like %s',
-                   (user_id, selected_date))
-    data = cursor.fetchall()
-    connection_pool.putconn(conn)
-    return data
-
-
-def set_notify_time(message):
-    try:
-        notify_time = datetime.strptime(message.text, "%H:%M").time()
-        set_notify_time_db(message.chat.id, notify_time)
-        bot.send_message(message.chat.id, "Notifications enabled at: " + message.text)
-    except ValueError:
-        bot.send_message(message.chat.id, "Incorrect time format, try again.")
-        bot.register_next_step_handler(message, set_notify_time)
+    return storage.readings(user_id, *day_range(selected_date))
+
+
+@timed('query')
+def get_saved_month_data(user_id, year, month):
+    return storage.readings(user_id, *month_range(year, month))
+
+
+@timed('query')
+def get_reading_columns(user_id, start, end):
+    # measured_at comes back as local wall-clock epoch seconds.
+    return storage.reading_columns(user_id, start, end)
+
 
+@timed('query')
+def export_readings(chat_id, file):
+    # Writes the user's readings to `file` as CSV and returns how many there were.
+    return storage.export_csv(chat_id, file)
 
-def send_notification(user_id, notify_time):
-    current_time = str(datetime.now().time())
-    if current_time[:5] == notify_time[:5]:
-        bot.send_message(user_id, "Check your arterial pressure!")
 
+@timed('query')
+def import_readings(chat_id, rows):
+    # Either the whole file is imported or nothing is.
+    storage.import_readings(chat_id, rows)
+    chart_cache.forget(chat_id)
 
+
+def send_notification(user_id):
+    bot.send_message(user_id, views.NOTIFICATION)
+
+
+@timed('query')
 def get_notify_value(user_id):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT notify_time, enabled FROM notifications WHERE user_id=%s", (user_id,))
-    result = cursor.fetchone()
-    connection_pool.putconn(conn)
-    if result[1]:
+    result = storage.notify_setting(user_id)
+    if result and result[1]:
         return result[0]
     else:
         return False
 
 
+@timed('query')
 def set_notify_value(user_id, value):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO notifications (user_id, notify_time, enabled) VALUES (%s, %s, %s) ON CONFLICT (user_id) "
-        "DO UPDATE SET notify_time = EXCLUDED.notify_time, enabled = EXCLUDED.enabled", (user_id, None, value))
-    conn.commit()
-    connection_pool.putconn(conn)
+    storage.set_notify(user_id, None, value)
 
 
+@timed('query')
 def set_notify_time_db(user_id, notify_time):
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO notifications (user_id, notify_time, enabled) VALUES (%s, %s, %s) "
-                   "ON CONFLICT (user_id) DO UPDATE SET notify_time = EXCLUDED.notify_time, enabled = EXCLUDED.enabled",
-                   (user_id, notify_time.strftime("%H:%M"), True))
-    conn.commit()
-    connection_pool.putconn(conn)
-
-
-def connect_to_db():
-    database = config.get('DB', 'database')
-    conn = psycopg2.connect(dbname='postgres', user='postgres', password='postgres', host=config.get('DB', 'host'),
-                            port=config.get('DB', 'port'))
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-
-    cursor = conn.cursor()
-    # Check if database exists and create it if not
-    cursor.execute("SELECT datname FROM pg_database;")
-    list_database = [item[0] for item in cursor.fetchall()]
-    if database not in list_database:
-        cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(database)))
-        logging.debug("Creating DB.")
-    else:
-        logging.debug("DB already created.")
-    cursor.close()
-    conn.close()
+    storage.set_notify(user_id, notify_time.strftime("%H:%M"), True)
+
+
+NOTIFY_CLAIM_BATCH = config.getint('NOTIFY', 'claim_batch', fallback=500)
+# A claim is a lease: reminders an instance has claimed but not sent within lease_seconds (it died, or is stuck)
+# are claimed by the next tick of any instance, for up to late_minutes after they were due. The lease has to
+# outlast a busy minute's dispatch, or a slow instance and the one taking over both send.
+NOTIFY_LEASE_SECONDS = config.getint('NOTIFY', 'lease_seconds', fallback=120)
+NOTIFY_LATE_MINUTES = config.getint('NOTIFY', 'late_minutes', fallback=10)
+NOTIFY_OWNER = f"{socket.gethostname()}:{os.getpid()}"
 
-    # Reconnecting to the new database
-    conn = psycopg2.connect(host=config.get('DB', 'host'),
-                            port=config.get('DB', 'port'),
-                            dbname=config.get('DB', 'database'),
-                            user=config.get('DB', 'user'),
-                            password=config.get('DB', 'password'))
-    return conn
+
+@timed('query')
+def claim_notifications(epoch_minute, limit):
+    # Leases up to `limit` reminders due at this minute, or unsent from the last late_minutes, and returns their
+    # (user_id, due_at).
+    due_ats = [local_minute(epoch_minute - late) for late in range(NOTIFY_LATE_MINUTES + 1)]
+    return storage.claim_notifications(due_ats, NOTIFY_OWNER, NOTIFY_LEASE_SECONDS, limit)
+
+
+@timed('query')
+def notification_sent(user_id, due_at):
+    storage.notification_sent(user_id, due_at)
 
 
 def run_notify_loop():
+    run_every_minute(notify_loop)
+
+
+@timed('notify', 'tick')
+def notify_loop(epoch_minute):
+    # Claims go in batches so that instances ticking at the same time split a busy minute between them.
     while True:
-        notify_loop()
-        time.sleep(60)
-
-
-def create_table():
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS user_input(
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER, 
-        systolic INTEGER, 
-        diastolic INTEGER, 
-        pulse INTEGER, 
-        date TEXT, 
-        time TEXT)''')
-    conn.commit()
-    connection_pool.putconn(conn)
-
-
-def create_notification_table():
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute("""CREATE TABLE IF NOT EXISTS notifications (
-                user_id INTEGER NOT NULL,
-                notify_time TIME,
-                enabled BOOLEAN NOT NULL,
-                CONSTRAINT user_id_unique UNIQUE (user_id))""")
-    conn.commit()
-    connection_pool.putconn(conn)
-
-
-def notify_loop():
-    conn = connection_pool.getconn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, notify_time FROM notifications WHERE enabled=True")
-    results = cursor.fetchall()
-    for result in results:
-        user_id, notify_time = result
-        notify_time = datetime.strptime(str(notify_time)[:5], "%H:%M").time()
-        notify_time = str(notify_time)[:5]
-        send_notification(user_id, notify_time)
-    connection_pool.putconn(conn)
+        claimed = dict(claim_notifications(epoch_minute, NOTIFY_CLAIM_BATCH))
+        notify_dispatcher.dispatch(list(claimed), send_notification,
+                                   lambda user_id, claimed=claimed: notification_sent(user_id, claimed[user_id]))
+        if len(claimed) < NOTIFY_CLAIM_BATCH:
+            return
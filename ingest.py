@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from datetime import datetime
+
+from bot import config
+from metrics import metrics
+from storage import storage
+
+
+class IngestError(Exception):
+    pass
+
+
+class IngestPending(IngestError):
+    # Timed out after the reading was taken into a batch: that batch may still commit or fail, so whether the
+    # reading was stored is not known yet.
+    pass
+
+
+class IngestBuffer:
+    # Write-behind buffer for readings: callers block until the multi-row insert holding their row has
+    # committed, so one round-trip and one fsync are shared by every reading that arrives within a flush window.
+    def __init__(self, flush_interval, max_batch, timeout):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self.flushes = 0
+        self.rows = 0
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ingest", daemon=True)
+            self._thread.start()
+
+    def submit(self, user_id, systolic, diastolic, pulse):
+        future = Future()
+        row = (user_id, systolic, diastolic, pulse, datetime.now().astimezone())
+        with self._cond:
+            if self._closed:
+                raise IngestError("Ingest buffer is closed.")
+            self._start()
+            self._pending.append((row, future))
+            # Wake the flush thread when it is idle (first reading of a batch) or when the batch is full.
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    def add(self, user_id, systolic, diastolic, pulse):
+        future = self.submit(user_id, systolic, diastolic, pulse)
+        try:
+            future.result(timeout=self.timeout)
+        except TimeoutError:
+            if self._withdraw(future):
+                raise IngestError("Reading was not committed in time.")
+            raise IngestPending("Reading is still being committed.")
+
+    def _withdraw(self, future):
+        # Takes a reading back out of the queue if no flush has picked it up yet, so a retry cannot duplicate it.
+        with self._cond:
+            for index, (_, pending) in enumerate(self._pending):
+                if pending is future:
+                    del self._pending[index]
+                    return True
+        return False
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._pending and len(self._pending) < self.max_batch and not self._closed:
+                    # The first reading of a batch waits at most one flush interval for company.
+                    self._cond.wait(self.flush_interval)
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                if not batch and self._closed:
+                    return
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            storage.add_readings([row for row, _ in batch])
+        except Exception as e:
+            logging.exception(f"Failed to flush {len(batch)} readings.")
+            metrics.error('query', 'ingest_flush')
+            for _, future in batch:
+                future.set_exception(IngestError(str(e)))
+            return
+        self.flushes += 1
+        self.rows += len(batch)
+        for _, future in batch:
+            future.set_result(None)
+        metrics.observe('query', 'ingest_flush', time.monotonic() - started)
+        logging.debug(f"Flushed {len(batch)} readings in {time.monotonic() - started:.3f}s.")
+
+    def queued(self):
+        return len(self._pending)
+
+    def close(self):
+        # Flushes whatever is still buffered, then stops the flush thread.
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+class AsyncIngestBuffer:
+    # IngestBuffer for the asyncio runtime: batches on the event loop and flushes through the shared storage in a
+    # worker thread.
+    def __init__(self, flush_interval, max_batch, timeout):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._pending = []
+        self._timer = None
+        self._flushing = set()
+        self.flushes = 0
+        self.rows = 0
+
+    async def add(self, user_id, systolic, diastolic, pulse):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(((user_id, systolic, diastolic, pulse, datetime.now().astimezone()), future))
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            # Same as IngestBuffer.add: only a reading no flush has picked up yet is withdrawn and reported unsaved.
+            for index, (_, pending) in enumerate(self._pending):
+                if pending is future:
+                    del self._pending[index]
+                    future.cancel()
+                    raise IngestError("Reading was not committed in time.")
+            raise IngestPending("Reading is still being committed.")
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._flush(batch))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+
+    @metrics.timed('query', 'ingest_flush')
+    async def _flush(self, batch):
+        try:
+            await asyncio.to_thread(storage.add_readings, [row for row, _ in batch])
+        except Exception as e:
+            logging.exception(f"Failed to flush {len(batch)} readings.")
+            metrics.error('query', 'ingest_flush')
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(IngestError(str(e)))
+            return
+        self.flushes += 1
+        self.rows += len(batch)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    def queued(self):
+        return len(self._pending)
+
+    async def close(self):
+        self._start_flush()
+        if self._flushing:
+            await asyncio.gather(*self._flushing)
+
+
+ingest_buffer = IngestBuffer(
+    flush_interval=config.getint('INGEST', 'flush_interval_ms', fallback=50) / 1000,
+    max_batch=config.getint('INGEST', 'max_batch', fallback=500),
+    timeout=config.getfloat('INGEST', 'timeout', fallback=10),
+)
+metrics.gauge('bot_ingest', "Readings waiting for the next group commit and totals written.",
+              lambda: {'queued': ingest_buffer.queued(), 'flushes': ingest_buffer.flushes,
+                       'rows': ingest_buffer.rows})
@@ -1,17 +1,97 @@
+import argparse
+import asyncio
 import threading
 
 import bot
-from functions import connect_to_db, create_table, create_notification_table, run_notify_loop
-import handlers  # register the handlers, do not remove!
+from bot import config
+from functions import run_notify_loop
+from ingest import ingest_buffer
+from metrics import metrics, start_metrics_server
+from migrations import rebuild_calendar
+from partitions import partition_maintenance
+from precompute import precompute
+from profiling import profiler
+from render import render_engine
+from storage import storage
 
 
-def main():
-    connect_to_db()
-    create_table()
-    create_notification_table()
+def bootstrap():
+    storage.bootstrap()
+    metrics.startup('bootstrap')
+
+
+def run_polling():
+    import handlers  # register the handlers, do not remove!
+    thread = threading.Thread(target=run_notify_loop)
+    thread.start()
+    try:
+        bot.bot.polling()
+    finally:
+        ingest_buffer.close()
+
+
+def run_webhook():
+    import handlers  # register the handlers, do not remove!
+    from webhook import webhook_server, register_webhook
     thread = threading.Thread(target=run_notify_loop)
     thread.start()
-    bot.bot.polling()
+    webhook_server.start()
+    register_webhook()
+    try:
+        webhook_server.serve_forever()
+    finally:
+        webhook_server.shutdown()
+        ingest_buffer.close()
+
+
+async def run_async():
+    import aio_handlers  # register the handlers, do not remove!
+    from aio_bot import bot as async_bot
+    from aio_functions import ingest_buffer as async_ingest_buffer, run_notify_loop as run_async_notify_loop
+    notify_task = asyncio.create_task(run_async_notify_loop())
+    try:
+        await async_bot.polling(non_stop=True)
+    finally:
+        notify_task.cancel()
+        await async_ingest_buffer.close()
+        await async_bot.close_session()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'async'],
+                        default=config.get('BOT', 'mode', fallback='polling'))
+    parser.add_argument('--rebuild-aggregates', action='store_true',
+                        help="recompute user_calendar from user_input, report mismatches and exit")
+    args = parser.parse_args()
+    if storage.name != 'postgres' and args.rebuild_aggregates:
+        parser.error(f"--rebuild-aggregates needs [STORAGE] backend = postgres, not {storage.name}.")
+    if args.mode == 'webhook':
+        from webhook import webhook_server
+        if not webhook_server.has_secret():
+            parser.error("--mode webhook needs [WEBHOOK] secret_token, 1-256 characters of A-Z, a-z, 0-9, _ and -. "
+                         "Updates without it in the X-Telegram-Bot-Api-Secret-Token header are refused.")
+    if args.rebuild_aggregates:
+        storage.bootstrap()
+        print(f"{rebuild_calendar()} mismatched days rebuilt.")
+        return
+    start_metrics_server()
+    if config.getboolean('PROFILE', 'enabled', fallback=False):
+        profiler.enable()
+    if config.getboolean('RENDER', 'warm_up', fallback=True):
+        render_engine.warm_up()
+    bootstrap()
+    if storage.name == 'postgres':
+        threading.Thread(target=partition_maintenance.run, name="partitions", daemon=True).start()
+    # Off-peak chart precomputation; a no-op unless [PRECOMPUTE] enabled is set.
+    threading.Thread(target=precompute.run_loop, name="precompute", daemon=True).start()
+    if args.mode == 'async':
+        asyncio.run(run_async())
+    elif args.mode == 'webhook':
+        run_webhook()
+    else:
+        run_polling()
+    storage.close()
     print("Ready.")
 
 
@@ -0,0 +1,183 @@
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bot import config
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Metrics:
+    # Latency histograms and error counters keyed by (kind, name), plus gauges read at scrape time.
+    # kind is one of handler, query, render, notify; name is the instrumented function.
+    def __init__(self, slow_seconds=None):
+        self.slow_seconds = slow_seconds
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._errors = {}
+        self._gauges = {}
+        self._server = None
+        # Startup phases are measured from here, which is as soon as the config has been read.
+        self.started = time.monotonic()
+        self._startup = {}
+        # Set by profiling while it is on: called as profile(label, fn, *args, **kwargs) in place of a sync handler.
+        self.profile = None
+
+    def observe(self, kind, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get((kind, name))
+            if histogram is None:
+                histogram = self._histograms[(kind, name)] = _Histogram()
+            histogram.observe(seconds)
+        if kind == 'handler' and 'first_update' not in self._startup:
+            self.startup('first_update')
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            logging.warning(f"Slow {kind} {name}: {seconds * 1000:.0f}ms.")
+
+    def error(self, kind, name):
+        with self._lock:
+            self._errors[(kind, name)] = self._errors.get((kind, name), 0) + 1
+
+    def startup(self, phase):
+        # Records the seconds from process start to phase, once.
+        with self._lock:
+            if phase in self._startup:
+                return
+            seconds = self._startup[phase] = time.monotonic() - self.started
+        logging.info(f"Startup: {phase} after {seconds:.2f}s.")
+
+    def startup_times(self):
+        with self._lock:
+            return dict(self._startup)
+
+    def gauge(self, name, help_text, read):
+        # read() returns a number, or a dict of label value -> number exported under a "name" label.
+        self._gauges[name] = (help_text, read)
+
+    def timed(self, kind, name=None):
+        def decorator(fn):
+            label = name or fn.__name__
+
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await fn(*args, **kwargs)
+                    except Exception:
+                        self.error(kind, label)
+                        raise
+                    finally:
+                        self.observe(kind, label, time.perf_counter() - started)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    if kind == 'handler' and self.profile is not None:
+                        return self.profile(label, fn, *args, **kwargs)
+                    return fn(*args, **kwargs)
+                except Exception:
+                    self.error(kind, label)
+                    raise
+                finally:
+                    self.observe(kind, label, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            errors = sorted(self._errors.items())
+            snapshot = [(key, list(h.counts), h.sum, h.count) for key, h in histograms]
+        for kind in sorted({key[0] for key, _, _, _ in snapshot}):
+            metric = f'bot_{kind}_seconds'
+            lines += [f'# HELP {metric} Latency of {kind} operations.', f'# TYPE {metric} histogram']
+            for (_, name), counts, total, count in (item for item in snapshot if item[0][0] == kind):
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + ('+Inf',), counts):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{name="{name}"}} {total}')
+                lines.append(f'{metric}_count{{name="{name}"}} {count}')
+        lines += ['# HELP bot_errors_total Operations that raised.', '# TYPE bot_errors_total counter']
+        lines += [f'bot_errors_total{{kind="{kind}",name="{name}"}} {count}' for (kind, name), count in errors]
+        for metric, help_text, value in self.read_gauges():
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge']
+            if isinstance(value, dict):
+                lines += [f'{metric}{{name="{label}"}} {number}' for label, number in sorted(value.items())]
+            else:
+                lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def read_gauges(self):
+        # (name, help, value) for every gauge that could be read, sorted by name.
+        values = []
+        for metric, (help_text, read) in sorted(self._gauges.items()):
+            try:
+                values.append((metric, help_text, read()))
+            except Exception:
+                logging.exception(f"Failed to read gauge {metric}.")
+        return values
+
+    def serve(self, host, port):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"Metrics on http://{host}:{port}/metrics")
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+metrics = Metrics(
+    slow_seconds=config.getfloat('METRICS', 'slow_ms') / 1000 if config.has_option('METRICS', 'slow_ms') else None,
+)
+timed = metrics.timed
+metrics.gauge('bot_startup_seconds', "Seconds from process start to each startup phase, first_update included.",
+              metrics.startup_times)
+
+
+def start_metrics_server():
+    # Port 0 or a missing [METRICS] section keeps the endpoint off; instrumentation is recorded either way.
+    port = config.getint('METRICS', 'port', fallback=0)
+    if port:
+        metrics.serve(config.get('METRICS', 'host', fallback='127.0.0.1'), port)
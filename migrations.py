@@ -0,0 +1,471 @@
+import logging
+
+import psycopg2
+from psycopg2 import errors, sql
+
+from bot import config
+from database import db
+
+# pg_advisory_lock key held while the schema is being upgraded, so concurrent instances migrate one at a time.
+SCHEMA_LOCK = 0x62700001
+# Serializes creating user_input partitions between imports, maintenance and other instances.
+PARTITION_LOCK = 0x62700002
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute("SELECT 1 FROM information_schema.columns "
+                   "WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s", (table, column))
+    return cursor.fetchone() is not None
+
+
+def _create_index_concurrently(cursor, name, definition):
+    # A failed CONCURRENTLY build leaves an invalid index behind that IF NOT EXISTS would happily skip.
+    cursor.execute("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                   "WHERE c.relname = %s", (name,))
+    row = cursor.fetchone()
+    if row is not None and not row[0]:
+        cursor.execute(f"DROP INDEX CONCURRENTLY {name}")
+    cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+
+def migrate_measured_at(batch_size=None):
+    # Moves user_input from the legacy TEXT date/time columns to measured_at TIMESTAMPTZ while the bot keeps
+    # running: every statement commits on its own, the backfill walks the primary key in small id ranges,
+    # and DDL that needs a strong lock gives up after lock_timeout instead of queueing writers behind it.
+    batch_size = batch_size or config.getint('DB', 'migration_batch_size', fallback=5000)
+    with db.connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SET lock_timeout = '5s'")
+        cursor.execute("SET statement_timeout = 0")
+        try:
+            _migrate_measured_at(cursor, batch_size)
+        finally:
+            cursor.execute("RESET lock_timeout")
+            cursor.execute("RESET statement_timeout")
+
+
+def _migrate_measured_at(cursor, batch_size):
+    legacy = _column_exists(cursor, 'user_input', 'date')
+    if legacy:
+        # Added without a default first: a default here would be stamped onto every existing row.
+        cursor.execute("ALTER TABLE user_input ADD COLUMN IF NOT EXISTS measured_at TIMESTAMPTZ")
+        cursor.execute("ALTER TABLE user_input ALTER COLUMN measured_at SET DEFAULT now()")
+        cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM user_input "
+                       "WHERE measured_at IS NULL")
+        low, high = cursor.fetchone()
+        logging.info(f"Backfilling measured_at for ids {low}..{high}.")
+        for start in range(low, high + 1, batch_size):
+            cursor.execute("UPDATE user_input SET measured_at = to_timestamp(date || ' ' || time, "
+                           "'DD-MM-YYYY HH24:MI') WHERE id >= %s AND id < %s AND measured_at IS NULL",
+                           (start, start + batch_size))
+    _create_index_concurrently(cursor, 'user_input_user_id_measured_at_idx', 'user_input (user_id, measured_at)')
+    if legacy:
+        # SET NOT NULL skips its full-table scan when a validated CHECK already proves it, and VALIDATE
+        # only takes a lock that lets reads and writes continue.
+        cursor.execute("ALTER TABLE user_input DROP CONSTRAINT IF EXISTS user_input_measured_at_not_null")
+        cursor.execute("ALTER TABLE user_input ADD CONSTRAINT user_input_measured_at_not_null "
+                       "CHECK (measured_at IS NOT NULL) NOT VALID")
+        cursor.execute("ALTER TABLE user_input VALIDATE CONSTRAINT user_input_measured_at_not_null")
+        cursor.execute("ALTER TABLE user_input ALTER COLUMN measured_at SET NOT NULL")
+        cursor.execute("ALTER TABLE user_input DROP CONSTRAINT user_input_measured_at_not_null")
+        cursor.execute("ALTER TABLE user_input DROP COLUMN date, DROP COLUMN time")
+        logging.info("user_input migrated to measured_at.")
+
+
+def create_table():
+    with db.cursor() as cursor:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS user_input(
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER, 
+            systolic INTEGER, 
+            diastolic INTEGER, 
+            pulse INTEGER, 
+            measured_at TIMESTAMPTZ NOT NULL DEFAULT now())''')
+
+
+def create_notification_table():
+    with db.cursor() as cursor:
+        cursor.execute("""CREATE TABLE IF NOT EXISTS notifications (
+                    user_id INTEGER NOT NULL,
+                    notify_time TIME,
+                    enabled BOOLEAN NOT NULL,
+                    CONSTRAINT user_id_unique UNIQUE (user_id))""")
+
+
+def create_calendar_table():
+    # user_calendar holds one row per (user, day) with readings, so the year/month/day menus never touch
+    # user_input. Statement-level triggers keep it current for every write path, including bulk ones.
+    with db.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('user_calendar') IS NULL")
+        created = cursor.fetchone()[0]
+        cursor.execute("""CREATE TABLE IF NOT EXISTS user_calendar (
+                    user_id INTEGER NOT NULL,
+                    day DATE NOT NULL,
+                    reading_count INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, day))""")
+        cursor.execute("""CREATE OR REPLACE FUNCTION user_calendar_insert() RETURNS trigger AS $$
+                    BEGIN
+                        INSERT INTO user_calendar (user_id, day, reading_count)
+                        SELECT user_id, measured_at::date, count(*) FROM new_rows GROUP BY 1, 2
+                        ON CONFLICT (user_id, day)
+                        DO UPDATE SET reading_count = user_calendar.reading_count + EXCLUDED.reading_count;
+                        RETURN NULL;
+                    END $$ LANGUAGE plpgsql""")
+        cursor.execute("""CREATE OR REPLACE FUNCTION user_calendar_delete() RETURNS trigger AS $$
+                    BEGIN
+                        UPDATE user_calendar c SET reading_count = c.reading_count - d.n
+                        FROM (SELECT user_id, measured_at::date AS day, count(*) AS n FROM old_rows GROUP BY 1, 2) d
+                        WHERE c.user_id = d.user_id AND c.day = d.day;
+                        DELETE FROM user_calendar c USING (SELECT DISTINCT user_id FROM old_rows) d
+                        WHERE c.user_id = d.user_id AND c.reading_count <= 0;
+                        RETURN NULL;
+                    END $$ LANGUAGE plpgsql""")
+        cursor.execute("CREATE OR REPLACE TRIGGER user_calendar_insert AFTER INSERT ON user_input "
+                       "REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION user_calendar_insert()")
+        cursor.execute("CREATE OR REPLACE TRIGGER user_calendar_delete AFTER DELETE ON user_input "
+                       "REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION user_calendar_delete()")
+        if created:
+            # Same transaction as the triggers, so no insert can slip in between the backfill and the triggers.
+            cursor.execute("INSERT INTO user_calendar (user_id, day, reading_count) "
+                           "SELECT user_id, measured_at::date, count(*) FROM user_input GROUP BY 1, 2")
+            logging.debug("Calendar summary backfilled.")
+
+
+# Per-day aggregates kept in user_calendar next to reading_count, as (column, type, expression over readings).
+CALENDAR_AGGREGATES = [
+    ('reading_count', 'INTEGER', 'count(*)'),
+    ('systolic_sum', 'BIGINT', 'sum(systolic)'),
+    ('diastolic_sum', 'BIGINT', 'sum(diastolic)'),
+    ('pulse_sum', 'BIGINT', 'sum(pulse)'),
+    ('systolic_squares', 'BIGINT', 'sum(systolic::bigint * systolic)'),
+    ('diastolic_squares', 'BIGINT', 'sum(diastolic::bigint * diastolic)'),
+    ('pulse_squares', 'BIGINT', 'sum(pulse::bigint * pulse)'),
+    ('systolic_min', 'INTEGER', 'min(systolic)'),
+    ('systolic_max', 'INTEGER', 'max(systolic)'),
+    ('diastolic_min', 'INTEGER', 'min(diastolic)'),
+    ('diastolic_max', 'INTEGER', 'max(diastolic)'),
+    ('pulse_min', 'INTEGER', 'min(pulse)'),
+    ('pulse_max', 'INTEGER', 'max(pulse)'),
+]
+_CALENDAR_COLUMNS = ', '.join(column for column, _, _ in CALENDAR_AGGREGATES)
+_CALENDAR_SELECT = ', '.join(f"{expression} AS {column}" for column, _, expression in CALENDAR_AGGREGATES)
+
+
+def _merge(column):
+    # How a batch of new readings is folded into an existing day.
+    if column.endswith('_min'):
+        return f"{column} = least(user_calendar.{column}, EXCLUDED.{column})"
+    if column.endswith('_max'):
+        return f"{column} = greatest(user_calendar.{column}, EXCLUDED.{column})"
+    return f"{column} = user_calendar.{column} + EXCLUDED.{column}"
+
+
+def add_calendar_aggregates():
+    # Inserts fold into the day in O(1); deletes recompute only the days they touched, since a min or max
+    # cannot be taken back out of a running value.
+    with db.cursor() as cursor:
+        for column, kind, _ in CALENDAR_AGGREGATES[1:]:
+            cursor.execute(f"ALTER TABLE user_calendar ADD COLUMN IF NOT EXISTS {column} {kind}")
+        cursor.execute(f"""CREATE OR REPLACE FUNCTION user_calendar_insert() RETURNS trigger AS $$
+                    BEGIN
+                        INSERT INTO user_calendar (user_id, day, {_CALENDAR_COLUMNS})
+                        SELECT user_id, measured_at::date, {_CALENDAR_SELECT} FROM new_rows GROUP BY 1, 2
+                        ON CONFLICT (user_id, day)
+                        DO UPDATE SET {', '.join(_merge(column) for column, _, _ in CALENDAR_AGGREGATES)};
+                        RETURN NULL;
+                    END $$ LANGUAGE plpgsql""")
+        cursor.execute(f"""CREATE OR REPLACE FUNCTION user_calendar_delete() RETURNS trigger AS $$
+                    BEGIN
+                        DELETE FROM user_calendar c
+                        USING (SELECT DISTINCT user_id, measured_at::date AS day FROM old_rows) d
+                        WHERE c.user_id = d.user_id AND c.day = d.day;
+                        INSERT INTO user_calendar (user_id, day, {_CALENDAR_COLUMNS})
+                        SELECT u.user_id, u.measured_at::date, {_CALENDAR_SELECT} FROM user_input u
+                        JOIN (SELECT DISTINCT user_id, measured_at::date AS day FROM old_rows) d
+                        ON u.user_id = d.user_id AND u.measured_at >= d.day AND u.measured_at < d.day + 1
+                        GROUP BY 1, 2;
+                        RETURN NULL;
+                    END $$ LANGUAGE plpgsql""")
+        # Re-creating the triggers locks out writers until commit, so the backfill below cannot miss a reading.
+        _create_calendar_triggers(cursor)
+        cursor.execute("DELETE FROM user_calendar")
+        cursor.execute(f"INSERT INTO user_calendar (user_id, day, {_CALENDAR_COLUMNS}) "
+                       f"SELECT user_id, measured_at::date, {_CALENDAR_SELECT} FROM user_input GROUP BY 1, 2")
+
+
+def _create_calendar_triggers(cursor):
+    cursor.execute("CREATE OR REPLACE TRIGGER user_calendar_insert AFTER INSERT ON user_input "
+                   "REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION user_calendar_insert()")
+    cursor.execute("CREATE OR REPLACE TRIGGER user_calendar_delete AFTER DELETE ON user_input "
+                   "REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION user_calendar_delete()")
+
+
+def rebuild_calendar():
+    # Recomputes user_calendar from user_input and returns the number of (user, day) rows that did not match.
+    # Writers are blocked for the duration, so the comparison is against a consistent snapshot.
+    with db.cursor() as cursor:
+        cursor.execute("LOCK TABLE user_input IN SHARE MODE")
+        cursor.execute(f"CREATE TEMP TABLE calendar_expected ON COMMIT DROP AS "
+                       f"SELECT user_id, measured_at::date AS day, {_CALENDAR_SELECT} FROM user_input GROUP BY 1, 2")
+        expected = ', '.join(f"e.{column}" for column, _, _ in CALENDAR_AGGREGATES)
+        stored = ', '.join(f"c.{column}" for column, _, _ in CALENDAR_AGGREGATES)
+        cursor.execute(f"SELECT count(*) FROM calendar_expected e FULL JOIN user_calendar c "
+                       f"ON c.user_id = e.user_id AND c.day = e.day "
+                       f"WHERE (e.user_id, e.day, {expected}) IS DISTINCT FROM (c.user_id, c.day, {stored})")
+        mismatched = cursor.fetchone()[0]
+        if mismatched:
+            cursor.execute("DELETE FROM user_calendar")
+            cursor.execute(f"INSERT INTO user_calendar (user_id, day, {_CALENDAR_COLUMNS}) "
+                           f"SELECT user_id, day, {_CALENDAR_COLUMNS} FROM calendar_expected")
+        cursor.execute("SELECT count(*) FROM user_calendar")
+        days = cursor.fetchone()[0]
+    logging.info(f"user_calendar verified: {days} days, {mismatched} rebuilt.")
+    return mismatched
+
+
+def add_notification_claims():
+    # last_sent is the claim that lets every instance run the notification tick: a reminder is sent by
+    # whichever instance moves last_sent to the current minute first.
+    with db.cursor() as cursor:
+        cursor.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS last_sent TIMESTAMPTZ")
+        cursor.execute("CREATE INDEX IF NOT EXISTS notifications_due_idx ON notifications (notify_time) "
+                       "WHERE enabled")
+
+
+def add_digest_claims():
+    # digest_sent is the week (its first day) of the last weekly digest, claimed like last_sent.
+    with db.cursor() as cursor:
+        cursor.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS digest_sent DATE")
+
+
+def add_notification_leases():
+    # A claim is now a lease (claimed_at, claimed_by) and last_sent is only set once the reminder has gone out, so
+    # the reminders of an instance that dies mid-dispatch are sent by another one.
+    with db.cursor() as cursor:
+        cursor.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ")
+        cursor.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS claimed_by TEXT")
+
+
+def add_user_versions():
+    # user_versions counts the writes to each user's readings. chart_cache keys charts by it, so an instance never
+    # serves a chart drawn before a write that went through another instance.
+    with db.cursor() as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS user_versions ("
+                       "user_id INTEGER PRIMARY KEY, version BIGINT NOT NULL)")
+        # In user_id order, so concurrent batches for overlapping users lock their rows in the same order.
+        cursor.execute("""CREATE OR REPLACE FUNCTION user_versions_bump() RETURNS trigger AS $$
+                    BEGIN
+                        INSERT INTO user_versions (user_id, version)
+                        SELECT DISTINCT user_id, 1 FROM changed_rows ORDER BY user_id
+                        ON CONFLICT (user_id) DO UPDATE SET version = user_versions.version + 1;
+                        RETURN NULL;
+                    END $$ LANGUAGE plpgsql""")
+        cursor.execute("CREATE OR REPLACE TRIGGER user_versions_insert AFTER INSERT ON user_input "
+                       "REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION user_versions_bump()")
+        cursor.execute("CREATE OR REPLACE TRIGGER user_versions_delete AFTER DELETE ON user_input "
+                       "REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION user_versions_bump()")
+
+
+def create_partition_function():
+    # Creates the missing monthly partitions user_input_YYYY_MM of parent covering first_at..last_at. Month boundaries
+    # are taken in the session timezone, the same one user_calendar days use, so a partition holds whole calendar days.
+    with db.cursor() as cursor:
+        # Left behind by an interrupted upgrade from before parent was a parameter; it would make calls ambiguous.
+        cursor.execute("DROP FUNCTION IF EXISTS user_input_ensure_partitions(TIMESTAMPTZ, TIMESTAMPTZ)")
+        cursor.execute("""CREATE OR REPLACE FUNCTION user_input_ensure_partitions(
+                        first_at TIMESTAMPTZ, last_at TIMESTAMPTZ, parent TEXT DEFAULT 'user_input')
+                    RETURNS INTEGER AS $$
+                    DECLARE
+                        month TIMESTAMPTZ := date_trunc('month', first_at);
+                        name TEXT;
+                        created INTEGER := 0;
+                    BEGIN
+                        PERFORM pg_advisory_xact_lock(%s);
+                        WHILE month <= last_at LOOP
+                            name := 'user_input_' || to_char(month, 'YYYY_MM');
+                            IF to_regclass(name) IS NULL THEN
+                                -- to_regclass can miss a partition committed while this call waited for the lock.
+                                BEGIN
+                                    EXECUTE format('CREATE TABLE %%I PARTITION OF %%I FOR VALUES FROM (%%L) TO (%%L)',
+                                                   name, parent, month, month + interval '1 month');
+                                    created := created + 1;
+                                EXCEPTION WHEN duplicate_table THEN
+                                    NULL;
+                                END;
+                            END IF;
+                            month := month + interval '1 month';
+                        END LOOP;
+                        RETURN created;
+                    END $$ LANGUAGE plpgsql""", (PARTITION_LOCK,))
+
+
+# Creates the partitions of user_input_partitioned that rows about to be copied or mirrored into it need. The advisory
+# lock in user_input_ensure_partitions is only taken for a month that is missing, so writers are not serialized on it.
+_ENSURE_COPY_PARTITIONS = ("SELECT user_input_ensure_partitions(month, month, 'user_input_partitioned') FROM "
+                           "(SELECT DISTINCT date_trunc('month', measured_at) AS month FROM {}) months "
+                           "WHERE to_regclass('user_input_' || to_char(month, 'YYYY_MM')) IS NULL")
+
+
+def partition_user_input(batch_size=None):
+    # Rebuilds user_input as a table range-partitioned by month on measured_at while the bot keeps running, the same
+    # way as migrate_measured_at: the new table is filled in small id ranges while triggers on the old one mirror
+    # every write into it, and only the final swap takes a strong lock, for a few renames. user_calendar is
+    # maintained by the old table's triggers until the swap and by the new table's afterwards.
+    batch_size = batch_size or config.getint('DB', 'migration_batch_size', fallback=5000)
+    create_partition_function()
+    with db.connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SET lock_timeout = '5s'")
+        cursor.execute("SET statement_timeout = 0")
+        try:
+            if not _copy_into_partitions(cursor, batch_size):
+                return
+        finally:
+            cursor.execute("RESET lock_timeout")
+            cursor.execute("RESET statement_timeout")
+    with db.cursor() as cursor:
+        cursor.execute("SET LOCAL lock_timeout = '5s'")
+        cursor.execute("LOCK TABLE user_input IN ACCESS EXCLUSIVE MODE")
+        cursor.execute("SELECT pg_get_serial_sequence('user_input', 'id')")
+        sequence = cursor.fetchone()[0]
+        cursor.execute("ALTER TABLE user_input RENAME TO user_input_legacy")
+        cursor.execute("ALTER TABLE user_input_partitioned RENAME TO user_input")
+        cursor.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY user_input.id").format(sql.SQL(sequence)))
+        cursor.execute("DROP TABLE user_input_legacy")
+        cursor.execute("DROP FUNCTION user_input_mirror_insert(), user_input_mirror_delete()")
+        cursor.execute("ALTER INDEX user_input_partitioned_pkey RENAME TO user_input_pkey")
+        cursor.execute("ALTER INDEX user_input_partitioned_user_id_measured_at_idx "
+                       "RENAME TO user_input_user_id_measured_at_idx")
+        _create_calendar_triggers(cursor)
+    logging.info("user_input switched to monthly partitions.")
+
+
+def _copy_into_partitions(cursor, batch_size):
+    # Every statement commits on its own, so an upgrade interrupted here resumes where it stopped.
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = 'user_input'::regclass")
+    if cursor.fetchone()[0]:
+        return False
+    cursor.execute("SELECT pg_get_serial_sequence('user_input', 'id')")
+    sequence = cursor.fetchone()[0]
+    cursor.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS user_input_partitioned (
+                id INTEGER NOT NULL DEFAULT nextval({}::regclass),
+                user_id INTEGER,
+                systolic INTEGER,
+                diastolic INTEGER,
+                pulse INTEGER,
+                measured_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                CONSTRAINT user_input_partitioned_pkey PRIMARY KEY (id, measured_at))
+                PARTITION BY RANGE (measured_at)""")
+                   .format(sql.Literal(sequence)))
+    cursor.execute("CREATE INDEX IF NOT EXISTS user_input_partitioned_user_id_measured_at_idx "
+                   "ON user_input_partitioned (user_id, measured_at)")
+    cursor.execute("SELECT user_input_ensure_partitions(now(), now() + interval '3 months', 'user_input_partitioned')")
+    cursor.execute(f"""CREATE OR REPLACE FUNCTION user_input_mirror_insert() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM 1 FROM ({_ENSURE_COPY_PARTITIONS.format('new_rows')}) ensured;
+                    INSERT INTO user_input_partitioned (id, user_id, systolic, diastolic, pulse, measured_at)
+                    SELECT id, user_id, systolic, diastolic, pulse, measured_at FROM new_rows
+                    ON CONFLICT DO NOTHING;
+                    RETURN NULL;
+                END $$ LANGUAGE plpgsql""")
+    cursor.execute("""CREATE OR REPLACE FUNCTION user_input_mirror_delete() RETURNS trigger AS $$
+                BEGIN
+                    DELETE FROM user_input_partitioned p USING old_rows o
+                    WHERE p.id = o.id AND p.measured_at = o.measured_at;
+                    RETURN NULL;
+                END $$ LANGUAGE plpgsql""")
+    cursor.execute("CREATE OR REPLACE TRIGGER user_input_mirror_insert AFTER INSERT ON user_input "
+                   "REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION user_input_mirror_insert()")
+    cursor.execute("CREATE OR REPLACE TRIGGER user_input_mirror_delete AFTER DELETE ON user_input "
+                   "REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION user_input_mirror_delete()")
+    # CREATE TRIGGER waited for every transaction already writing to user_input, so rows up to this id are either
+    # committed or mirrored. FOR SHARE holds back a delete of a row being copied until its copy is committed, and
+    # the mirrored delete then removes the copy as well.
+    cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM user_input")
+    low, high = cursor.fetchone()
+    logging.info(f"Copying readings {low}..{high} into monthly partitions.")
+    for start in range(low, high + 1, batch_size):
+        batch = f"(SELECT measured_at FROM user_input WHERE id >= {start} AND id < {start + batch_size}) batch"
+        cursor.execute(_ENSURE_COPY_PARTITIONS.format(batch))
+        cursor.execute("INSERT INTO user_input_partitioned (id, user_id, systolic, diastolic, pulse, measured_at) "
+                       "SELECT id, user_id, systolic, diastolic, pulse, measured_at FROM user_input "
+                       "WHERE id >= %s AND id < %s FOR SHARE ON CONFLICT DO NOTHING", (start, start + batch_size))
+    return True
+
+
+def _baseline():
+    # Everything up to version 1 was created idempotently on every start, so it is safe to replay on old databases.
+    create_table()
+    migrate_measured_at()
+    create_calendar_table()
+    create_notification_table()
+
+
+# (version, step) in order; a step runs once, when the database is below its version.
+MIGRATIONS = [
+    (1, _baseline),
+    (2, add_calendar_aggregates),
+    (3, add_notification_claims),
+    (4, partition_user_input),
+    (5, add_digest_claims),
+    (6, add_notification_leases),
+    (7, add_user_versions),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def ensure_database():
+    # The pool connects straight to [DB] database with the configured role. The maintenance database is only
+    # opened when that fails because the database does not exist yet, i.e. on the very first start.
+    try:
+        with db.connection():
+            return
+    except psycopg2.OperationalError as e:
+        if 'does not exist' not in str(e):
+            raise
+    database = config.get('DB', 'database')
+    conn = psycopg2.connect(dbname=config.get('DB', 'maintenance_database', fallback='postgres'),
+                            host=config.get('DB', 'host'), port=config.get('DB', 'port'),
+                            user=config.get('DB', 'user'), password=config.get('DB', 'password'))
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(database)))
+        logging.info(f"Created database {database}.")
+    except errors.DuplicateDatabase:
+        pass
+    finally:
+        conn.close()
+
+
+def schema_version(cursor):
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+
+def bootstrap_schema():
+    # A current schema costs one connection and two catalog lookups; DDL only runs for versions not applied yet.
+    ensure_database()
+    with db.connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        version = schema_version(cursor)
+        if version >= SCHEMA_VERSION:
+            logging.debug(f"Schema is at version {version}.")
+            return
+        cursor.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK,))
+        try:
+            # Another instance may have finished the upgrade while we waited for the lock.
+            version = schema_version(cursor)
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                           "version INTEGER PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+            for target, step in MIGRATIONS:
+                if target <= version:
+                    continue
+                logging.info(f"Upgrading schema to version {target}.")
+                step()
+                cursor.execute("INSERT INTO schema_version (version) VALUES (%s)", (target,))
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK,))
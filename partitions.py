@@ -0,0 +1,128 @@
+import gzip
+import logging
+import os
+import re
+import threading
+from datetime import date
+
+from psycopg2 import sql
+
+from bot import config
+from database import db
+from migrations import PARTITION_LOCK
+
+# user_input is partitioned by month on measured_at (see migrations.partition_user_input). This keeps
+# partitions created ahead of time and applies the retention policy to the old ones.
+
+_PARTITION_NAME = re.compile(r'user_input_(\d{4})_(\d{2})')
+
+
+def _months_before(day, months):
+    index = day.year * 12 + day.month - 1 - months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+class PartitionMaintenance:
+    # retention_months = 0 keeps every partition. Otherwise partitions that ended more than retention_months
+    # ago are detached, their user_calendar days removed, and the table is either moved to archive_schema
+    # (archive = schema) or written to archive_dir as gzipped CSV and dropped (archive = csv).
+    def __init__(self, ahead_months, retention_months, archive, archive_schema, archive_dir, interval):
+        self.ahead_months = ahead_months
+        self.retention_months = retention_months
+        self.archive = archive
+        self.archive_schema = archive_schema
+        self.archive_dir = archive_dir
+        self.interval = interval
+
+    def ensure(self, first_at, last_at):
+        # There is no default partition, so rows outside the existing months (seeded or backdated ones) need their
+        # partitions created before they are written.
+        with db.cursor() as cursor:
+            cursor.execute("SELECT user_input_ensure_partitions(%s, %s)", (first_at, last_at))
+            created = cursor.fetchone()[0]
+        if created:
+            logging.info(f"Created {created} user_input partitions for {first_at:%Y-%m}..{last_at:%Y-%m}.")
+        return created
+
+    def ensure_ahead(self):
+        with db.cursor() as cursor:
+            cursor.execute("SELECT user_input_ensure_partitions(now(), now() + make_interval(months => %s))",
+                           (self.ahead_months,))
+            created = cursor.fetchone()[0]
+        if created:
+            logging.info(f"Created {created} user_input partitions ahead.")
+        return created
+
+    def partitions(self):
+        # Attached monthly partitions as (name, first day of month), oldest first.
+        with db.cursor() as cursor:
+            cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                           "WHERE i.inhparent = 'user_input'::regclass")
+            names = [row[0] for row in cursor.fetchall()]
+        months = []
+        for name in names:
+            match = _PARTITION_NAME.fullmatch(name)
+            if match:
+                months.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+        return sorted(months, key=lambda item: item[1])
+
+    def expired(self, today=None):
+        if not self.retention_months:
+            return []
+        cutoff = _months_before(today or date.today(), self.retention_months)
+        return [(name, month) for name, month in self.partitions() if month < cutoff]
+
+    def archive_partition(self, name, month):
+        # One transaction: the partition is locked against late writes (e.g. an import of old readings) while
+        # it is archived, and user_calendar loses its days in the same commit that detaches the rows.
+        next_month = _months_before(month, -1)
+        table = sql.Identifier(name)
+        with db.cursor() as cursor:
+            # Another instance may have archived it while we were listing.
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK,))
+            cursor.execute("SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s) "
+                           "AND inhparent = 'user_input'::regclass", (name,))
+            if cursor.fetchone() is None:
+                return
+            cursor.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(table))
+            if self.archive == 'csv':
+                os.makedirs(self.archive_dir, exist_ok=True)
+                path = os.path.join(self.archive_dir, f"{name}.csv.gz")
+                with gzip.open(path, 'wt', newline='') as file:
+                    cursor.copy_expert(sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(table), file)
+            cursor.execute(sql.SQL("ALTER TABLE user_input DETACH PARTITION {}").format(table))
+            # Detaching fires no delete triggers, so the users' chart versions are raised here.
+            cursor.execute("WITH gone AS (DELETE FROM user_calendar WHERE day >= %s AND day < %s RETURNING user_id) "
+                           "UPDATE user_versions SET version = version + 1 "
+                           "WHERE user_id IN (SELECT user_id FROM gone)", (month, next_month))
+            if self.archive == 'csv':
+                cursor.execute(sql.SQL("DROP TABLE {}").format(table))
+            else:
+                schema = sql.Identifier(self.archive_schema)
+                cursor.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(schema))
+                cursor.execute(sql.SQL("ALTER TABLE {} SET SCHEMA {}").format(table, schema))
+        logging.info(f"Archived partition {name} ({self.archive}).")
+
+    def run_once(self):
+        self.ensure_ahead()
+        for name, month in self.expired():
+            self.archive_partition(name, month)
+
+    def run(self, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception("Partition maintenance failed.")
+            stop_event.wait(self.interval)
+
+
+partition_maintenance = PartitionMaintenance(
+    ahead_months=config.getint('PARTITIONS', 'ahead_months', fallback=3),
+    retention_months=config.getint('PARTITIONS', 'retention_months', fallback=0),
+    archive=config.get('PARTITIONS', 'archive', fallback='schema'),
+    archive_schema=config.get('PARTITIONS', 'archive_schema', fallback='archive'),
+    archive_dir=config.get('PARTITIONS', 'archive_dir', fallback='archive'),
+    interval=config.getfloat('PARTITIONS', 'maintenance_interval', fallback=21600),
+)
@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+import analytics
+import charts
+import views
+from bot import bot, config
+from chart_cache import chart_cache
+from dispatcher import notify_dispatcher
+from functions import day_range, get_aggregated_data, get_reading_columns, month_chart, summary_chart
+from metrics import metrics, timed
+from render import render_engine, RenderError
+from scheduler import local_minute, run_every_minute
+from storage import storage
+from throttle import throttle
+
+# Share of the chart cache a run may fill, so precomputed charts never push out what live users just viewed.
+CACHE_FILL = 0.8
+
+
+def _hours(value):
+    start, end = (int(hour) for hour in value.split('-'))
+    return start, end
+
+
+class Precompute:
+    # During quiet hours, renders the charts active users are most likely to open (this month, this year, all
+    # time) into chart_cache, a few users at a time. A run stops as soon as live updates pass max_live_rate per
+    # minute and carries on at the next quiet minute; users whose charts are still cached are skipped.
+    # With digest on, the same run also renders last week's chart and summary, which are sent on digest_weekday
+    # at digest_hour to users with reminders enabled.
+    def __init__(self, enabled, quiet_hours, concurrency, active_days, max_live_rate, digest, digest_weekday,
+                 digest_hour, digest_max_bytes):
+        self.enabled = enabled
+        self.quiet_hours = quiet_hours
+        self.concurrency = concurrency
+        self.active_days = active_days
+        self.max_live_rate = max_live_rate
+        self.digest = digest
+        self.digest_weekday = digest_weekday
+        self.digest_hour = digest_hour
+        self.digest_max_bytes = digest_max_bytes
+        # user_id -> (week start, png, caption) for the next digest.
+        self._digests = OrderedDict()
+        self._digest_bytes = 0
+        self._lock = threading.Lock()
+        self._completed = None
+        self._sample = (time.monotonic(), throttle.allowed)
+        self.live_rate = 0.0
+        self.users = 0
+        self.charts = 0
+        self.stopped = 0
+        self.digests_sent = 0
+
+    def quiet(self, hour):
+        start, end = self.quiet_hours
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def busy(self):
+        # Live updates per minute, from the throttle's admitted count sampled at most every 10 seconds.
+        with self._lock:
+            now, allowed = time.monotonic(), throttle.allowed
+            elapsed = now - self._sample[0]
+            if elapsed >= 10:
+                self.live_rate = (allowed - self._sample[1]) / elapsed * 60
+                self._sample = (now, allowed)
+            return self.live_rate > self.max_live_rate
+
+    @timed('query')
+    def active_users(self, today):
+        # Most recently active first, so a run cut short has covered the likeliest requests.
+        return storage.active_users(today - timedelta(days=self.active_days))
+
+    def _render(self, user_id, scope, chart, build, version):
+        if chart_cache.contains(user_id, scope, version):
+            return
+        args = build()
+        if args is None:
+            return
+        chart_cache.put(user_id, scope, version, png=render_engine.render(chart, *args))
+        with self._lock:
+            self.charts += 1
+
+    def precompute_user(self, user_id, today):
+        # Same scopes and arguments as the chart handlers, so their send_cached_chart finds these.
+        version = chart_cache.version(user_id)
+        self._render(user_id, f"month:{today.month:02d}-{today.year}", charts.line_chart,
+                     lambda: month_chart(user_id, today.year, today.month), version)
+        self._render(user_id, f"year:{today.year}", charts.range_chart,
+                     lambda: summary_chart(user_id, today.year), version)
+        self._render(user_id, 'all', charts.range_chart, lambda: summary_chart(user_id), version)
+        if self.digest and today.weekday() == self.digest_weekday:
+            self.precompute_digest(user_id, today)
+
+    def precompute_digest(self, user_id, today):
+        start, end = today - timedelta(days=7), today - timedelta(days=1)
+        with self._lock:
+            entry = self._digests.get(user_id)
+            if entry is not None and entry[0] == start:
+                return
+            if self._digest_bytes >= self.digest_max_bytes:
+                return
+        stats = analytics.summarize(*get_reading_columns(user_id, day_range(start)[0], day_range(end)[1]))
+        if stats is None:
+            return
+        rows = get_aggregated_data(user_id, 'day', start, end)
+        x = [row[0].replace(tzinfo=None) for row in rows]
+        png = render_engine.render(charts.range_chart, f'Week of {start:%d %b}', 'Day', x, views.range_series(rows))
+        with self._lock:
+            old = self._digests.pop(user_id, None)
+            if old is not None:
+                self._digest_bytes -= len(old[1])
+            self._digests[user_id] = (start, png, views.digest_text(stats))
+            self._digest_bytes += len(png)
+
+    def run(self, today):
+        # Returns True once every active user has been covered, False when stopped early.
+        if not self.enabled:
+            return True
+        if chart_cache.stats()['bytes'] >= chart_cache.max_bytes * CACHE_FILL:
+            return False
+        if self.digest and today.weekday() == self.digest_weekday:
+            # Digests nobody claimed last week (reminders off, or sent by another instance) are dropped here.
+            week_start = today - timedelta(days=7)
+            with self._lock:
+                for user_id in [user_id for user_id, entry in self._digests.items() if entry[0] != week_start]:
+                    self._digest_bytes -= len(self._digests.pop(user_id)[1])
+        users = iter(self.active_users(today))
+        users_lock = threading.Lock()
+        finished = []
+
+        def worker():
+            while not self.busy() and chart_cache.stats()['bytes'] < chart_cache.max_bytes * CACHE_FILL:
+                with users_lock:
+                    user_id = next(users, None)
+                if user_id is None:
+                    finished.append(True)
+                    return
+                try:
+                    self.precompute_user(user_id, today)
+                except RenderError as e:
+                    logging.warning(f"Precompute for {user_id} skipped: {e}")
+                except Exception:
+                    logging.exception(f"Precompute for {user_id} failed.")
+                with self._lock:
+                    self.users += 1
+
+        threads = [threading.Thread(target=worker, name=f"precompute-{i}") for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not finished:
+            with self._lock:
+                self.stopped += 1
+            logging.info(f"Precompute paused: {self.live_rate:.0f} live updates/min, "
+                         f"chart cache at {chart_cache.stats()['bytes']} bytes.")
+        return bool(finished)
+
+    @timed('query')
+    def claim_digests(self, week_start, user_ids):
+        # Same claim as the reminders: whichever instance moves digest_sent to this week first sends it.
+        return storage.claim_digests(week_start, user_ids)
+
+    def send_digest(self, user_id):
+        # Dropped only once sent, so the dispatcher's retries still find it.
+        entry = self._digests.get(user_id)
+        if entry is None:
+            return
+        bot.send_photo(user_id, entry[1], caption=entry[2], parse_mode="Markdown")
+        with self._lock:
+            if self._digests.get(user_id) is entry:
+                del self._digests[user_id]
+                self._digest_bytes -= len(entry[1])
+            self.digests_sent += 1
+
+    def send_digests(self, today):
+        week_start = today - timedelta(days=7)
+        with self._lock:
+            user_ids = [user_id for user_id, entry in self._digests.items() if entry[0] == week_start]
+        if user_ids:
+            notify_dispatcher.dispatch(self.claim_digests(week_start, user_ids), self.send_digest)
+
+    def tick(self, epoch_minute):
+        now = local_minute(epoch_minute)
+        # Sampled every minute, so a run starts from the live rate of the last minute rather than of the day.
+        busy = self.busy()
+        if self.digest and now.weekday() == self.digest_weekday and now.hour == self.digest_hour:
+            self.send_digests(now.date())
+        if not busy and self.quiet(now.hour) and self._completed != now.date() and self.run(now.date()):
+            self._completed = now.date()
+
+    def run_loop(self, stop_event=None):
+        if self.enabled:
+            run_every_minute(self.tick, stop_event)
+
+    def stats(self):
+        with self._lock:
+            return {'users': self.users, 'charts': self.charts, 'stopped': self.stopped,
+                    'live_rate': self.live_rate, 'digests': len(self._digests), 'digest_bytes': self._digest_bytes,
+                    'digests_sent': self.digests_sent}
+
+
+precompute = Precompute(
+    enabled=config.getboolean('PRECOMPUTE', 'enabled', fallback=False),
+    quiet_hours=_hours(config.get('PRECOMPUTE', 'quiet_hours', fallback='2-6')),
+    concurrency=config.getint('PRECOMPUTE', 'concurrency', fallback=2),
+    active_days=config.getint('PRECOMPUTE', 'active_days', fallback=30),
+    max_live_rate=config.getfloat('PRECOMPUTE', 'max_live_rate', fallback=30),
+    digest=config.getboolean('PRECOMPUTE', 'digest', fallback=False),
+    digest_weekday=config.getint('PRECOMPUTE', 'digest_weekday', fallback=0),
+    digest_hour=config.getint('PRECOMPUTE', 'digest_hour', fallback=9),
+    digest_max_bytes=config.getint('PRECOMPUTE', 'digest_max_bytes', fallback=64 * 1024 * 1024),
+)
+metrics.gauge('bot_precompute', "Off-peak chart precomputation and weekly digests.", precompute.stats)
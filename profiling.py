@@ -0,0 +1,171 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import resource
+import threading
+import tracemalloc
+from concurrent.futures import TimeoutError
+from datetime import datetime
+
+import charts
+from bot import config
+from metrics import metrics
+from render import render_engine, RenderError
+
+
+class Profiler:
+    # Off unless [PROFILE] enabled is set or an admin sends /profile on. While on, a sample_rate share of sync
+    # handler calls runs under cProfile (in the asyncio runtime that is the replies.py bodies, which run in worker
+    # threads; coroutines are not sampled, a profile there would also catch every task that ran during the await),
+    # tracemalloc traces allocations, and every `interval` seconds a report is written to report_dir. Off, the only
+    # cost is one attribute check per handler call.
+    def __init__(self, sample_rate, interval, report_dir, top, frames, admins):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.report_dir = report_dir
+        self.top = top
+        self.frames = frames
+        self.admins = admins
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._snapshot = None
+        self._stop = None
+
+    @property
+    def enabled(self):
+        return self._stop is not None
+
+    def enable(self):
+        with self._lock:
+            if self._stop is not None:
+                return
+            self._stop = threading.Event()
+            stop = self._stop
+        tracemalloc.start(self.frames)
+        metrics.profile = self.sample
+        threading.Thread(target=self._run, args=(stop,), name="profiler", daemon=True).start()
+        logging.info(f"Profiling on, reports every {self.interval:.0f}s in {self.report_dir}.")
+
+    def disable(self):
+        with self._lock:
+            if self._stop is None:
+                return
+            self._stop.set()
+            self._stop = None
+            self._stats = {}
+            self._snapshot = None
+        metrics.profile = None
+        tracemalloc.stop()
+        logging.info("Profiling off.")
+
+    def sample(self, label, fn, *args, **kwargs):
+        if random.random() >= self.sample_rate:
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                entry = self._stats.get(label)
+                if entry is None:
+                    self._stats[label] = [pstats.Stats(profile), 1]
+                else:
+                    entry[0].add(profile)
+                    entry[1] += 1
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            try:
+                self.write_report()
+            except Exception:
+                logging.exception("Profiling report failed.")
+
+    def live_figures(self):
+        # One probe per render worker; a busy worker may answer twice and another not at all, hence the pid.
+        futures = []
+        for _ in range(render_engine.workers):
+            try:
+                futures.append(render_engine.submit(charts.live_figures))
+            except RenderError:
+                break
+        figures = {}
+        for future in futures:
+            try:
+                pid, count = future.result(timeout=render_engine.timeout)
+            except (TimeoutError, RenderError):
+                continue
+            figures[pid] = count
+        return figures
+
+    def report(self):
+        # Plain text with stable ordering, so consecutive reports can be compared with diff.
+        out = io.StringIO()
+        out.write(f"# Profile report {datetime.now().astimezone().isoformat(timespec='seconds')}\n\n")
+        out.write("## Process\n")
+        out.write(f"max_rss_kb {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}\n")
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        out.write(f"traced_bytes {current}\ntraced_peak_bytes {peak}\nthreads {threading.active_count()}\n\n")
+        out.write("## Live figures per render worker\n")
+        for pid, count in sorted(self.live_figures().items()):
+            out.write(f"worker {pid} {count}\n")
+        out.write("\n## Gauges (connection pools, queues, caches)\n")
+        for metric, _, value in metrics.read_gauges():
+            if isinstance(value, dict):
+                out.writelines(f"{metric} {label} {number}\n" for label, number in sorted(value.items()))
+            else:
+                out.write(f"{metric} {value}\n")
+        if tracemalloc.is_tracing():
+            # The profiler's own allocations (held pstats, earlier snapshots) would otherwise top every report.
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, path) for path in (tracemalloc.__file__, pstats.__file__,
+                                                             cProfile.__file__, __file__)
+            ] + [tracemalloc.Filter(False, "<frozen importlib._bootstrap>")])
+            out.write(f"\n## Top {self.top} allocations by line\n")
+            out.writelines(f"{stat}\n" for stat in snapshot.statistics('lineno')[:self.top])
+            with self._lock:
+                previous, self._snapshot = self._snapshot, snapshot
+            if previous is not None:
+                out.write(f"\n## Top {self.top} growth since the previous report\n")
+                out.writelines(f"{stat}\n" for stat in snapshot.compare_to(previous, 'lineno')[:self.top])
+        with self._lock:
+            handler_stats, self._stats = self._stats, {}
+        for label, (stats, samples) in sorted(handler_stats.items()):
+            out.write(f"\n## Handler {label}: {samples} calls profiled\n")
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
+
+    def write_report(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt")
+        with open(path, 'w') as file:
+            file.write(self.report())
+        logging.info(f"Profiling report written to {path}.")
+        return path
+
+    def command(self, action):
+        # Text reply for the /profile admin command.
+        if action == 'on':
+            self.enable()
+        elif action == 'off':
+            self.disable()
+        elif action == 'report':
+            if not self.enabled:
+                return "Profiling is off."
+            return f"Report written to {self.write_report()}."
+        return f"Profiling is {'on' if self.enabled else 'off'}. Use /profile on, off or report."
+
+
+profiler = Profiler(
+    sample_rate=config.getfloat('PROFILE', 'sample_rate', fallback=0.1),
+    interval=config.getfloat('PROFILE', 'interval', fallback=300),
+    report_dir=config.get('PROFILE', 'report_dir', fallback='profiles'),
+    top=config.getint('PROFILE', 'top', fallback=25),
+    frames=config.getint('PROFILE', 'frames', fallback=10),
+    admins={int(user_id) for user_id in config.get('PROFILE', 'admins', fallback='').split(',') if user_id.strip()},
+)
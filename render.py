@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import charts
+from bot import config
+from metrics import metrics
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderEngine:
+    def __init__(self, workers, max_queue, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.renders = 0
+        self.failures = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.render_seconds = 0.0
+        self.render_seconds_max = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # forkserver children start from a clean interpreter instead of forking our threads and sockets.
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('forkserver'),
+                                                     initializer=charts.init_worker)
+            return self._executor
+
+    def _replace(self, executor):
+        # A worker that died (OOM kill, segfault) breaks the whole pool: every pending and later submit fails. The
+        # next render starts a fresh pool; only the first caller to notice replaces it.
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self.restarts += 1
+        logging.error("Render pool is broken, starting a new one.")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, fn, *args):
+        return self._submit(fn, *args)[1]
+
+    def _submit(self, fn, *args):
+        # Returns the executor along with the future, so a caller seeing BrokenProcessPool replaces that pool only.
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise RenderError("Render queue is full.")
+        with self._lock:
+            self.in_flight += 1
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._replace(executor)
+                executor = self._get_executor()
+                future = executor.submit(fn, *args)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return executor, future
+
+    def _release(self, future):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def _record(self, fn, started, failed=False):
+        elapsed = time.monotonic() - started
+        metrics.observe('render', fn.__name__, elapsed)
+        if failed:
+            metrics.error('render', fn.__name__)
+        with self._lock:
+            if failed:
+                self.failures += 1
+                return
+            self.renders += 1
+            self.render_seconds += elapsed
+            self.render_seconds_max = max(self.render_seconds_max, elapsed)
+
+    def render(self, fn, *args):
+        started = time.monotonic()
+        executor, future = self._submit(fn, *args)
+        try:
+            png = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            self._record(fn, started, failed=True)
+            raise RenderError("Rendering timed out.")
+        except BrokenProcessPool as e:
+            self._replace(executor)
+            self._record(fn, started, failed=True)
+            raise RenderError(str(e))
+        except Exception as e:
+            logging.exception("Rendering failed.")
+            self._record(fn, started, failed=True)
+            raise RenderError(str(e))
+        self._record(fn, started)
+        return png
+
+    async def render_async(self, fn, *args):
+        # Awaitable render() for the asyncio runtime; the event loop is never blocked on the worker.
+        started = time.monotonic()
+        executor, future = self._submit(fn, *args)
+        try:
+            png = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self._record(fn, started, failed=True)
+            raise RenderError("Rendering timed out.")
+        except BrokenProcessPool as e:
+            self._replace(executor)
+            self._record(fn, started, failed=True)
+            raise RenderError(str(e))
+        except Exception as e:
+            logging.exception("Rendering failed.")
+            self._record(fn, started, failed=True)
+            raise RenderError(str(e))
+        self._record(fn, started)
+        return png
+
+    def warm_up(self):
+        # Starts every worker and has it draw once in the background, so the first chart a user asks for does not
+        # pay for interpreter start-up and matplotlib's font cache.
+        def run():
+            try:
+                futures = [self.submit(charts.warm_up) for _ in range(self.workers)]
+                for future in futures:
+                    future.result()
+            except Exception:
+                logging.exception("Render pool warm-up failed.")
+                return
+            metrics.startup('render_warm')
+
+        threading.Thread(target=run, name="render-warm-up", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'renders': self.renders,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'restarts': self.restarts,
+                'in_flight': self.in_flight,
+                'max_queue': self.max_queue,
+                'render_seconds_avg': self.render_seconds / self.renders if self.renders else 0.0,
+                'render_seconds_max': self.render_seconds_max,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+
+render_engine = RenderEngine(
+    workers=config.getint('RENDER', 'workers', fallback=2),
+    max_queue=config.getint('RENDER', 'max_queue', fallback=32),
+    timeout=config.getfloat('RENDER', 'timeout', fallback=10),
+)
+metrics.gauge('bot_render_queue', "Charts queued or rendering in the worker pool.",
+              lambda: {'in_flight': render_engine.in_flight, 'max_queue': render_engine.max_queue,
+                       'rejected': render_engine.rejected})
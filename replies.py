@@ -0,0 +1,294 @@
+import logging
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+
+import analytics
+import charts
+from bot import config
+from chart_cache import chart_cache
+from functions import has_saved_data, get_saved_years, get_saved_months, get_saved_days, get_saved_data, \
+    get_data_span, get_reading_columns, delete_data_by_user_id, delete_last_data_by_user_id, get_notify_value, \
+    set_notify_value, set_notify_time_db, export_readings, import_readings, day_range, day_chart, month_chart, \
+    summary_chart
+from metrics import timed
+from profiling import profiler
+from router import CallbackRouter, YEAR, MONTH, DAY
+import views
+from views import Ask, Chart, Document, Text
+
+# Handler bodies shared by the threaded (handlers.py) and asyncio (aio_handlers.py) bots. A body does the reads and
+# writes for one update and returns the replies to send; it never calls the Bot API, so the threaded bot runs it on
+# its handler thread and the asyncio bot in a worker thread, and each sends the replies with its own deliver().
+
+EXPORT_SPOOL_BYTES = config.getint('EXPORT', 'spool_bytes', fallback=1048576)
+IMPORT_MAX_BYTES = config.getint('EXPORT', 'import_max_bytes', fallback=5242880)
+# Steps a views.Ask can wait for.
+NOTIFY_TIME = 'notify_time'
+IMPORT_FILE = 'import_file'
+
+callback_router = CallbackRouter()
+
+
+def reload():
+    return [Text("Input information or click on buttons.", views.main_keyboard())]
+
+
+def chart(user_id, scope, kind, build):
+    # The cache lookup and the queries happen here, in the body; rendering and sending are left to deliver().
+    version = chart_cache.version(user_id)
+    cached = chart_cache.get(user_id, scope, version)
+    args = None
+    if cached is None:
+        args = build()
+        if args is None:
+            return [Text(views.NO_DATA_FOR_DATE)]
+    return [Chart(scope, kind, build, version, cached, args)]
+
+
+@timed('handler')
+def start(message):
+    set_notify_value(message.chat.id, False)
+    logging.debug(f"User {message.chat.id} activated bot.")
+    return [Text(views.HELP_TEXT)] + reload()
+
+
+@timed('handler')
+def delete(message):
+    return [Text("Delete all information or last record?", views.delete_keyboard())]
+
+
+@timed('handler')
+def help_message(message):
+    return [Text(views.HELP_TEXT)] + reload()
+
+
+@timed('handler')
+def reset(message):
+    return reload()
+
+
+@timed('handler')
+def export_handler(message):
+    # Rows stream straight into the spool, which moves to disk past spool_bytes, so a long history never sits
+    # in memory.
+    spool = SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        count = export_readings(message.chat.id, spool)
+    except Exception:
+        spool.close()
+        raise
+    if count <= 0:
+        spool.close()
+        return [Text(views.NO_DATA)]
+    spool.seek(0)
+    return [Document(spool, 'readings.csv', f"{count} readings.")]
+
+
+@timed('handler')
+def import_handler(message):
+    return [Text(views.IMPORT_PROMPT), Ask(IMPORT_FILE)]
+
+
+def import_refused(message):
+    # Replies for an answer to the import prompt that is not worth downloading, or None.
+    if message.content_type != 'document':
+        return [Text("Import canceled.")]
+    if message.document.file_size and message.document.file_size > IMPORT_MAX_BYTES:
+        return [Text(f"File is too large, the limit is {IMPORT_MAX_BYTES // 1048576} MB.")]
+    return None
+
+
+@timed('handler')
+def import_file_handler(message, data):
+    rows, error = views.parse_readings_csv(data)
+    if error:
+        return [Text(error)]
+    import_readings(message.chat.id, rows)
+    return [Text(f"Imported {len(rows)} readings.")]
+
+
+def years_menu(user_id, action):
+    years = get_saved_years(user_id)
+    if not years:
+        return [Text(views.NO_DATA)]
+    return [Text("Select year:", views.years_keyboard(years, action))]
+
+
+@timed('handler')
+def get_command_handler(message):
+    return years_menu(message.from_user.id, "year_text_")
+
+
+@timed('handler')
+def graph_command_handler(message):
+    return years_menu(message.from_user.id, "year_")
+
+
+@timed('handler')
+def stats_handler(message):
+    # Same span lookup as the long-range charts, so the scan is bounded by the calendar.
+    user_id = message.chat.id
+    first_day, last_day = get_data_span(user_id)
+    stats = None
+    if first_day is not None:
+        stats = analytics.summarize(*get_reading_columns(user_id, day_range(first_day)[0], day_range(last_day)[1]))
+    if stats is None:
+        return [Text(views.NO_DATA)]
+    return [Text(views.stats_text(stats), parse_mode="Markdown")]
+
+
+@timed('handler')
+def profile_handler(message):
+    # /profile on|off|report, only for the user ids in [PROFILE] admins.
+    args = message.text.split()
+    return [Text(profiler.command(args[1] if len(args) > 1 else None))]
+
+
+@timed('handler')
+def notify_handler(message):
+    replies = []
+    ntf_time = get_notify_value(message.chat.id)
+    if ntf_time:
+        replies.append(Text(f"Notification is enabled at: {str(ntf_time)[:5]}"))
+    replies.append(Text("Enable or disable notifications:", views.notify_keyboard()))
+    return replies
+
+
+@timed('handler')
+def notify_time_handler(message):
+    try:
+        notify_time = datetime.strptime(message.text or '', "%H:%M").time()
+    except ValueError:
+        return [Text("Incorrect time format, try again."), Ask(NOTIFY_TIME)]
+    set_notify_time_db(message.chat.id, notify_time)
+    return [Text("Notifications enabled at: " + message.text)]
+
+
+@callback_router.route('delete_all')
+@timed('handler')
+def delete_all_handler(call):
+    if not has_saved_data(call.from_user.id):
+        return [Text(views.NO_DATA)]
+    return [Text("Are you sure? \nALL saved information will be lost!", views.confirm_delete_keyboard())]
+
+
+@callback_router.route('delete_all_yes')
+@timed('handler')
+def delete_all_confirmed_handler(call):
+    delete_data_by_user_id(user_id=call.message.chat.id)
+    return [Text("Data cleared.")]
+
+
+@callback_router.route('delete_all_no')
+@timed('handler')
+def delete_all_canceled_handler(call):
+    return [Text("Deletion canceled.")]
+
+
+@callback_router.route('delete_last')
+@timed('handler')
+def delete_last_handler(call):
+    if not has_saved_data(call.from_user.id):
+        return [Text(views.NO_DATA)]
+    delete_last_data_by_user_id(user_id=call.message.chat.id)
+    return [Text("Last record removed.")]
+
+
+@callback_router.route('year_text_', YEAR, coalesce=True)
+@timed('handler')
+def year_text_handler(call, year):
+    months = get_saved_months(call.message.chat.id, year)
+    return [Text("Select a month:", views.months_keyboard(months, "month_text_", year))]
+
+
+@callback_router.route('draw_year_', YEAR, coalesce=True)
+@timed('handler')
+def year_graph_months_handler(call, year):
+    months = get_saved_months(call.message.chat.id, year)
+    return [Text("Select a month:", views.months_keyboard(months, "month_", year))]
+
+
+@callback_router.route('month_text_', MONTH, coalesce=True)
+@timed('handler')
+def month_text_handler(call, month):
+    days = get_saved_days(call.message.chat.id, month[1], month[0])
+    return [Text("Select a day:", views.days_keyboard(days, "text_"))]
+
+
+@callback_router.route('draw_days_', MONTH, coalesce=True)
+@timed('handler')
+def month_graph_days_handler(call, month):
+    days = get_saved_days(call.message.chat.id, month[1], month[0])
+    return [Text("Select a day:", views.days_keyboard(days, "pict_"))]
+
+
+@callback_router.route('day_', DAY, coalesce=True)
+@timed('handler')
+def day_menu_handler(call, day):
+    return [Text("Text or Graph", views.day_menu_keyboard(day))]
+
+
+@callback_router.route('month_', MONTH, coalesce=True)
+@timed('handler')
+def month_menu_handler(call, month):
+    return [Text("Select day or Monthly graph", views.month_menu_keyboard(month))]
+
+
+@callback_router.route('year_', YEAR, coalesce=True)
+@timed('handler')
+def year_menu_handler(call, year):
+    return [Text("Select month or Graph for the year", views.year_menu_keyboard(year))]
+
+
+@callback_router.route('text_', DAY, coalesce=True)
+@callback_router.route('date_', DAY, coalesce=True)
+@timed('handler')
+def day_text_handler(call, day):
+    data = get_saved_data(call.message.chat.id, day)
+    if not data:
+        return [Text(views.NO_DATA_FOR_DATE)]
+    return [Text(views.readings_text(f"{day:%d-%m-%Y}", data), parse_mode="Markdown")]
+
+
+@callback_router.route('graph_sum_', YEAR, coalesce=True)
+@timed('handler')
+def year_graph_handler(call, year):
+    user_id = call.message.chat.id
+    return chart(user_id, f"year:{year}", charts.range_chart, lambda: summary_chart(user_id, year))
+
+
+@callback_router.route('graph_sum', coalesce=True)
+@timed('handler')
+def all_time_graph_handler(call):
+    # Buttons sent before the year was added to the payload still ask for the all-time chart.
+    user_id = call.message.chat.id
+    return chart(user_id, 'all', charts.range_chart, lambda: summary_chart(user_id))
+
+
+@callback_router.route('pict_', DAY, coalesce=True)
+@timed('handler')
+def day_graph_handler(call, day):
+    user_id = call.message.chat.id
+    return chart(user_id, f"day:{day:%d-%m-%Y}", charts.line_chart, lambda: day_chart(user_id, day))
+
+
+@callback_router.route('draw_month_', MONTH, coalesce=True)
+@timed('handler')
+def month_graph_handler(call, month):
+    user_id = call.message.chat.id
+    return chart(user_id, f"month:{month[0]:02d}-{month[1]}", charts.line_chart,
+                 lambda: month_chart(user_id, month[1], month[0]))
+
+
+@callback_router.route('enable')
+@timed('handler')
+def enable_handler(call):
+    set_notify_value(call.message.chat.id, True)
+    return [Text("Enter time in format \"HH:MM\""), Ask(NOTIFY_TIME)]
+
+
+@callback_router.route('disable')
+@timed('handler')
+def disable_handler(call):
+    set_notify_value(call.message.chat.id, False)
+    return [Text("Notification disabled.")]
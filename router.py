@@ -0,0 +1,94 @@
+import re
+from datetime import datetime
+
+# Telegram rejects inline buttons whose callback_data is longer than this.
+MAX_CALLBACK_BYTES = 64
+
+
+class RouteError(ValueError):
+    pass
+
+
+class Codec:
+    # Converts one callback argument between its value and its text form in callback_data.
+    def __init__(self, pattern, decode, encode):
+        self._pattern = re.compile(pattern)
+        self._decode = decode
+        self.encode = encode
+
+    def decode(self, text):
+        if not self._pattern.fullmatch(text):
+            raise RouteError(f"Malformed callback argument {text!r}.")
+        try:
+            return self._decode(text)
+        except ValueError as e:
+            raise RouteError(str(e))
+
+
+def _month(text):
+    month, year = map(int, text.split('-'))
+    if not 1 <= month <= 12:
+        raise ValueError(f"Invalid month {month}.")
+    return month, year
+
+
+YEAR = Codec(r'\d{4}', int, str)
+# (month, year)
+MONTH = Codec(r'\d{2}-\d{4}', _month, lambda value: f"{value[0]:02d}-{value[1]}")
+DAY = Codec(r'\d{2}-\d{2}-\d{4}', lambda text: datetime.strptime(text, '%d-%m-%Y').date(),
+            lambda value: value.strftime('%d-%m-%Y'))
+
+
+def callback_data(action, codec=None, value=None):
+    data = action if codec is None else action + codec.encode(value)
+    if len(data.encode()) > MAX_CALLBACK_BYTES:
+        raise ValueError(f"callback_data {data!r} is longer than {MAX_CALLBACK_BYTES} bytes.")
+    return data
+
+
+class CallbackRouter:
+    # Maps callback_data to a handler by the longest registered action prefix, walking a character trie once,
+    # so routing cost depends on the payload length (at most 64 bytes) and not on the number of handlers.
+    # Handlers are called as handler(call) or handler(call, value) with the argument decoded by the route's codec.
+    # coalesce=True marks a handler that only reads and renders, so a repeated tap may share a running call;
+    # handlers that change data are left off and run once per tap.
+    def __init__(self):
+        self._root = {}
+        self._coalesced = set()
+        self.routes = {}
+
+    def route(self, action, codec=None, coalesce=False):
+        def decorator(fn):
+            if action in self.routes:
+                raise ValueError(f"Callback action {action!r} is already routed.")
+            self.routes[action] = (fn, codec)
+            if coalesce:
+                self._coalesced.add(fn)
+            node = self._root
+            for char in action:
+                node = node.setdefault(char, {})
+            node[None] = action
+            return fn
+        return decorator
+
+    def coalesces(self, handler):
+        return handler in self._coalesced
+
+    def resolve(self, data):
+        if not data or len(data.encode()) > MAX_CALLBACK_BYTES:
+            raise RouteError(f"Invalid callback_data {data!r}.")
+        node, action = self._root, None
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            action = node.get(None, action)
+        if action is None:
+            raise RouteError(f"No route for {data!r}.")
+        fn, codec = self.routes[action]
+        argument = data[len(action):]
+        if codec is None:
+            if argument:
+                raise RouteError(f"Unexpected argument in {data!r}.")
+            return fn, ()
+        return fn, (codec.decode(argument),)
@@ -0,0 +1,47 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+# Minutes the loop is allowed to catch up on after a late wakeup (suspend, long GC, clock jump).
+MAX_CATCH_UP = 5
+
+
+def minute_of_day(value):
+    return value.hour * 60 + value.minute
+
+
+def current_epoch_minute():
+    return int(time.time() // 60)
+
+
+def seconds_until(epoch_minute):
+    return max(0.0, epoch_minute * 60 - time.time())
+
+
+def local_minute(epoch_minute):
+    # Start of the epoch minute as an aware local datetime; notify_time is compared with its wall-clock time.
+    return datetime.fromtimestamp(epoch_minute * 60).astimezone()
+
+
+def minutes_to_run(last, current):
+    # Epoch minutes after `last` up to `current`, capped at MAX_CATCH_UP.
+    return range(max(last + 1, current - MAX_CATCH_UP + 1), current + 1)
+
+
+def run_every_minute(callback, stop_event=None):
+    # Wakeups are computed from the wall clock, so the loop never drifts; minutes missed by a late
+    # wakeup are replayed (up to MAX_CATCH_UP) instead of being skipped.
+    stop_event = stop_event or threading.Event()
+    last = current_epoch_minute()
+    while not stop_event.is_set():
+        stop_event.wait(seconds_until(last + 1))
+        current = current_epoch_minute()
+        if current <= last:
+            continue
+        for minute in minutes_to_run(last, current):
+            try:
+                callback(minute)
+            except Exception:
+                logging.exception("Notification tick failed.")
+        last = current
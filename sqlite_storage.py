@@ -0,0 +1,469 @@
+import csv
+import io
+import json
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from contextlib import contextmanager
+from datetime import date, datetime, time as day_time
+from zoneinfo import ZoneInfo
+
+from metrics import metrics
+from storage import Storage
+
+# Embedded storage for single-node deployments: one SQLite file in WAL mode, so readers never wait for the writer.
+# measured_at is stored as local wall-clock text ([DB] timezone) with microseconds, which sorts like the time itself
+# and works with SQLite's date functions. user_calendar and user_versions mirror the Postgres tables and are kept by
+# triggers.
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS user_input (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        systolic INTEGER NOT NULL,
+        diastolic INTEGER NOT NULL,
+        pulse INTEGER NOT NULL,
+        measured_at TEXT NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS user_input_user_id_measured_at_idx ON user_input (user_id, measured_at)",
+    """CREATE TABLE IF NOT EXISTS user_calendar (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        reading_count INTEGER NOT NULL,
+        systolic_sum INTEGER NOT NULL,
+        diastolic_sum INTEGER NOT NULL,
+        pulse_sum INTEGER NOT NULL,
+        systolic_min INTEGER NOT NULL,
+        systolic_max INTEGER NOT NULL,
+        diastolic_min INTEGER NOT NULL,
+        diastolic_max INTEGER NOT NULL,
+        pulse_min INTEGER NOT NULL,
+        pulse_max INTEGER NOT NULL,
+        systolic_squares INTEGER NOT NULL,
+        diastolic_squares INTEGER NOT NULL,
+        pulse_squares INTEGER NOT NULL,
+        PRIMARY KEY (user_id, day)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS user_calendar_day_idx ON user_calendar (day)",
+    "CREATE TABLE IF NOT EXISTS user_versions (user_id INTEGER PRIMARY KEY, version INTEGER NOT NULL)",
+    """CREATE TABLE IF NOT EXISTS notifications (
+        user_id INTEGER PRIMARY KEY,
+        notify_time TEXT,
+        enabled INTEGER NOT NULL,
+        last_sent TEXT,
+        digest_sent TEXT,
+        claimed_at REAL,
+        claimed_by TEXT)""",
+    "CREATE INDEX IF NOT EXISTS notifications_notify_time_idx ON notifications (notify_time) WHERE enabled",
+]
+# Columns added after their table was first created; bootstrap adds the ones an older file does not have yet.
+# The DEFAULT only lets NOT NULL columns be added; a new user_calendar column is filled by rebuilding the calendar.
+COLUMNS = [
+    ('notifications', 'claimed_at', 'REAL'),
+    ('notifications', 'claimed_by', 'TEXT'),
+    ('user_calendar', 'systolic_squares', 'INTEGER NOT NULL DEFAULT 0'),
+    ('user_calendar', 'diastolic_squares', 'INTEGER NOT NULL DEFAULT 0'),
+    ('user_calendar', 'pulse_squares', 'INTEGER NOT NULL DEFAULT 0'),
+]
+CALENDAR_COLUMNS = ('user_id, day, reading_count, systolic_sum, diastolic_sum, pulse_sum, systolic_min, systolic_max, '
+                    'diastolic_min, diastolic_max, pulse_min, pulse_max, systolic_squares, diastolic_squares, '
+                    'pulse_squares')
+CALENDAR_SELECT = ('SELECT user_id, date(measured_at), count(*), sum(systolic), sum(diastolic), sum(pulse), '
+                   'min(systolic), max(systolic), min(diastolic), max(diastolic), min(pulse), max(pulse), '
+                   'sum(systolic * systolic), sum(diastolic * diastolic), sum(pulse * pulse) FROM user_input')
+# Dropped and created again on every bootstrap, so a file from an older version gets the current bodies.
+TRIGGERS = [
+    ('user_calendar_insert', f"""AFTER INSERT ON user_input BEGIN
+        INSERT INTO user_calendar ({CALENDAR_COLUMNS}) VALUES (NEW.user_id, date(NEW.measured_at), 1,
+            NEW.systolic, NEW.diastolic, NEW.pulse, NEW.systolic, NEW.systolic,
+            NEW.diastolic, NEW.diastolic, NEW.pulse, NEW.pulse,
+            NEW.systolic * NEW.systolic, NEW.diastolic * NEW.diastolic, NEW.pulse * NEW.pulse)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            reading_count = reading_count + 1,
+            systolic_sum = systolic_sum + excluded.systolic_sum,
+            diastolic_sum = diastolic_sum + excluded.diastolic_sum,
+            pulse_sum = pulse_sum + excluded.pulse_sum,
+            systolic_min = min(systolic_min, excluded.systolic_min),
+            systolic_max = max(systolic_max, excluded.systolic_max),
+            diastolic_min = min(diastolic_min, excluded.diastolic_min),
+            diastolic_max = max(diastolic_max, excluded.diastolic_max),
+            pulse_min = min(pulse_min, excluded.pulse_min),
+            pulse_max = max(pulse_max, excluded.pulse_max),
+            systolic_squares = systolic_squares + excluded.systolic_squares,
+            diastolic_squares = diastolic_squares + excluded.diastolic_squares,
+            pulse_squares = pulse_squares + excluded.pulse_squares;
+    END"""),
+    # Minimums and maximums cannot be taken back, so a delete recomputes its day from the remaining readings.
+    ('user_calendar_delete', f"""AFTER DELETE ON user_input BEGIN
+        DELETE FROM user_calendar WHERE user_id = OLD.user_id AND day = date(OLD.measured_at);
+        INSERT INTO user_calendar ({CALENDAR_COLUMNS})
+        {CALENDAR_SELECT}
+        WHERE user_id = OLD.user_id AND measured_at >= date(OLD.measured_at)
+            AND measured_at < date(OLD.measured_at, '+1 day')
+        GROUP BY 1, 2;
+    END"""),
+    ('user_versions_insert', """AFTER INSERT ON user_input BEGIN
+        INSERT INTO user_versions VALUES (NEW.user_id, 1) ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+    END"""),
+    ('user_versions_delete', """AFTER DELETE ON user_input BEGIN
+        INSERT INTO user_versions VALUES (OLD.user_id, 1) ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+    END"""),
+]
+# min, mean, max and the variance of each metric over a bucket, from the per-day sums in user_calendar.
+AGGREGATES = ', '.join(f"min({metric}_min), CAST(sum({metric}_sum) AS REAL) / sum(reading_count), max({metric}_max), "
+                       f"CAST(sum({metric}_squares) AS REAL) / sum(reading_count) "
+                       f"- (CAST(sum({metric}_sum) AS REAL) / sum(reading_count)) "
+                       f"* (CAST(sum({metric}_sum) AS REAL) / sum(reading_count))"
+                       for metric in ('systolic', 'diastolic', 'pulse'))
+
+# Monday of the day's week, first of its month, or the day itself; the same buckets as Postgres date_trunc.
+BUCKET = ("CASE ? WHEN 'week' THEN date(day, '-' || ((strftime('%w', day) + 6) % 7) || ' days') "
+          "WHEN 'month' THEN date(day, 'start of month') ELSE day END")
+STORED_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class WriterError(Exception):
+    pass
+
+
+class SqliteStorage(Storage):
+    # Reads check out one of at most max_readers pooled connections, so threads that come and go (the asyncio bot's
+    # worker threads) do not each leave a connection open. All writes go through one writer thread, which takes up to
+    # max_batch queued writes into a single transaction (each in its own savepoint, so one failing write does not
+    # undo the others) and commits them together; callers block until their write has committed.
+    name = 'sqlite'
+
+    def __init__(self, path, timezone, max_batch, busy_timeout_ms, write_timeout, max_readers):
+        self.path = path
+        self.zone = ZoneInfo(timezone)
+        self.max_batch = max_batch
+        self.busy_timeout_ms = busy_timeout_ms
+        self.write_timeout = write_timeout
+        self._reader_slots = threading.BoundedSemaphore(max_readers)
+        self._idle = []
+        self._writes = queue.Queue()
+        self._lock = threading.Lock()
+        self._writer = None
+        self._connections = []
+        self.queries = 0
+        self.commits = 0
+        self.writes = 0
+        self.failed = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        # With WAL, NORMAL only syncs at checkpoints: a power loss can drop the last commits, never corrupt the file.
+        conn.execute("PRAGMA synchronous = NORMAL")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        # Waits for a free slot when max_readers are checked out; a slot reuses an idle connection or opens one.
+        with self._reader_slots:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+                conn.execute("PRAGMA query_only = ON")
+            try:
+                yield conn
+            finally:
+                with self._lock:
+                    self._idle.append(conn)
+
+    def _count(self, statements=1):
+        with self._lock:
+            self.queries += statements
+
+    def _read(self, query, params=()):
+        self._count()
+        with self._reader() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def _write(self, fn, *args):
+        future = Future()
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer, name="sqlite-writer", daemon=True)
+                self._writer.start()
+            elif not self._writer.is_alive():
+                raise WriterError("SQLite writer thread has stopped.")
+        self._writes.put((fn, args, future))
+        try:
+            return future.result(timeout=self.write_timeout)
+        except TimeoutError:
+            # A write the writer has not started yet is cancelled, so it can no longer run after the caller gave up.
+            if future.cancel():
+                raise WriterError(f"Write was not started within {self.write_timeout}s.")
+            raise WriterError(f"Write was not committed within {self.write_timeout}s.")
+
+    def _run_writer(self):
+        conn = self._connect()
+        while True:
+            batch = [self._writes.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            closing = any(item is None for item in batch)
+            batch = [item for item in batch if item is not None and item[2].set_running_or_notify_cancel()]
+            if batch:
+                self._commit(conn, batch)
+            if closing:
+                conn.close()
+                return
+
+    def _commit(self, conn, batch):
+        started = time.monotonic()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, _ in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((fn(conn, *args), None))
+                    conn.execute("RELEASE write")
+                except sqlite3.Error as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            logging.exception(f"Failed to commit {len(batch)} writes.")
+            metrics.error('query', 'sqlite_commit')
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            with self._lock:
+                self.failed += len(batch)
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self.commits += 1
+            self.writes += len(batch)
+            self.failed += sum(1 for _, error in results if error is not None)
+        for (_, _, future), (result, error) in zip(batch, results):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        metrics.observe('query', 'sqlite_commit', time.monotonic() - started)
+
+    def _stored(self, value):
+        # Aware datetimes are converted to the local timezone; naive ones already are local wall-clock time.
+        # None is left for the NOT NULL constraint to reject, as Postgres does.
+        if value is None:
+            return None
+        if value.tzinfo is not None:
+            value = value.astimezone(self.zone)
+        return value.strftime(STORED_FORMAT)
+
+    def _loaded(self, value):
+        return datetime.strptime(value, STORED_FORMAT).replace(tzinfo=self.zone)
+
+    def bootstrap(self):
+        def create(conn):
+            for statement in SCHEMA:
+                conn.execute(statement)
+            added = set()
+            for table, column, kind in COLUMNS:
+                if column not in [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+                    added.add(table)
+            for name, body in TRIGGERS:
+                conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+                conn.execute(f"CREATE TRIGGER {name} {body}")
+            if 'user_calendar' in added:
+                conn.execute("DELETE FROM user_calendar")
+                conn.execute(f"INSERT INTO user_calendar ({CALENDAR_COLUMNS}) {CALENDAR_SELECT} GROUP BY 1, 2")
+            return len(SCHEMA) + len(COLUMNS) + 2 * len(TRIGGERS)
+        self._count(self._write(create))
+
+    def add_readings(self, rows):
+        def insert(conn, rows):
+            conn.executemany('INSERT INTO user_input (user_id, systolic, diastolic, pulse, measured_at) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+        self._count()
+        self._write(insert, [(*row[:4], self._stored(row[4])) for row in rows])
+
+    def import_readings(self, user_id, rows):
+        def insert(conn, rows):
+            conn.executemany('INSERT INTO user_input (user_id, measured_at, systolic, diastolic, pulse) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+        self._count()
+        self._write(insert, [(user_id, self._stored(row[0]), *row[1:]) for row in rows])
+
+    def delete_readings(self, user_id):
+        self._count()
+        self._write(lambda conn: conn.execute('DELETE FROM user_input WHERE user_id = ?', (user_id,)))
+
+    def delete_last_reading(self, user_id):
+        self._count()
+        self._write(lambda conn: conn.execute(
+            'DELETE FROM user_input WHERE id = (SELECT id FROM user_input WHERE user_id = ? '
+            'ORDER BY measured_at DESC, id DESC LIMIT 1)', (user_id,)))
+
+    def delete_user(self, user_id):
+        def delete(conn):
+            conn.execute('DELETE FROM user_input WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM notifications WHERE user_id = ?', (user_id,))
+        self._count(2)
+        self._write(delete)
+
+    def delete_users(self, first_id, stop_id):
+        def delete(conn):
+            conn.execute('DELETE FROM user_input WHERE user_id >= ? AND user_id < ?', (first_id, stop_id))
+            conn.execute('DELETE FROM notifications WHERE user_id >= ? AND user_id < ?', (first_id, stop_id))
+        self._count(2)
+        self._write(delete)
+
+    def has_readings(self, user_id):
+        return bool(self._read('SELECT EXISTS (SELECT 1 FROM user_calendar WHERE user_id = ?)', (user_id,))[0][0])
+
+    def years(self, user_id):
+        rows = self._read("SELECT DISTINCT CAST(strftime('%Y', day) AS INTEGER) FROM user_calendar "
+                          "WHERE user_id = ? ORDER BY 1", (user_id,))
+        return [row[0] for row in rows]
+
+    def months(self, user_id, year):
+        rows = self._read("SELECT DISTINCT CAST(strftime('%m', day) AS INTEGER) FROM user_calendar "
+                          "WHERE user_id = ? AND day >= ? AND day < ? ORDER BY 1",
+                          (user_id, date(year, 1, 1).isoformat(), date(year + 1, 1, 1).isoformat()))
+        return [row[0] for row in rows]
+
+    def days(self, user_id, start, end):
+        rows = self._read('SELECT day FROM user_calendar WHERE user_id = ? AND day >= ? AND day < ? ORDER BY day',
+                          (user_id, start.isoformat(), end.isoformat()))
+        return [date.fromisoformat(row[0]) for row in rows]
+
+    def span(self, user_id, year=None):
+        if year is None:
+            row = self._read('SELECT min(day), max(day) FROM user_calendar WHERE user_id = ?', (user_id,))[0]
+        else:
+            row = self._read('SELECT min(day), max(day) FROM user_calendar WHERE user_id = ? AND day >= ? AND day < ?',
+                             (user_id, date(year, 1, 1).isoformat(), date(year + 1, 1, 1).isoformat()))[0]
+        return tuple(None if day is None else date.fromisoformat(day) for day in row)
+
+    def data_version(self, user_id):
+        rows = self._read('SELECT version FROM user_versions WHERE user_id = ?', (user_id,))
+        return rows[0][0] if rows else 0
+
+    def aggregated(self, user_id, bucket, first_day, last_day):
+        rows = self._read(f'SELECT {BUCKET} AS bucket, {AGGREGATES}, sum(reading_count) '
+                          'FROM user_calendar WHERE user_id = ? AND day >= ? AND day <= ? '
+                          'GROUP BY 1 ORDER BY 1', (bucket, user_id, first_day.isoformat(), last_day.isoformat()))
+        # The variances become standard deviations here: sqrt() is missing from SQLite builds without the math
+        # functions. Rounding can leave a variance just below zero.
+        return [(datetime.fromisoformat(row[0]).replace(tzinfo=self.zone),
+                 *(math.sqrt(max(value, 0)) if i % 4 == 3 else value for i, value in enumerate(row[1:13])), row[13])
+                for row in rows]
+
+    def readings(self, user_id, start, end):
+        rows = self._read('SELECT systolic, diastolic, pulse, measured_at FROM user_input '
+                          'WHERE user_id = ? AND measured_at >= ? AND measured_at < ? ORDER BY measured_at',
+                          (user_id, self._stored(start), self._stored(end)))
+        return [(*row[:3], self._loaded(row[3])) for row in rows]
+
+    def reading_columns(self, user_id, start, end):
+        rows = self._read("SELECT systolic, diastolic, pulse, (julianday(measured_at) - 2440587.5) * 86400.0 "
+                          "FROM user_input WHERE user_id = ? AND measured_at >= ? AND measured_at < ? "
+                          "ORDER BY measured_at", (user_id, self._stored(start), self._stored(end)))
+        return [list(column) for column in zip(*rows)] if rows else [[], [], [], []]
+
+    def export_csv(self, user_id, file):
+        self._count()
+        out = io.TextIOWrapper(file, encoding='utf-8', newline='', write_through=True)
+        writer = csv.writer(out)
+        writer.writerow(('measured_at', 'systolic', 'diastolic', 'pulse'))
+        count = 0
+        with self._reader() as conn:
+            cursor = conn.execute('SELECT measured_at, systolic, diastolic, pulse FROM user_input '
+                                  'WHERE user_id = ? ORDER BY measured_at', (user_id,))
+            for measured_at, systolic, diastolic, pulse in cursor:
+                writer.writerow((self._loaded(measured_at).isoformat(sep=' '), systolic, diastolic, pulse))
+                count += 1
+        # The caller keeps using the binary file.
+        out.detach()
+        return count
+
+    def notify_setting(self, user_id):
+        rows = self._read('SELECT notify_time, enabled FROM notifications WHERE user_id = ?', (user_id,))
+        if not rows:
+            return None
+        notify_time, enabled = rows[0]
+        return (None if notify_time is None else day_time.fromisoformat(notify_time)), bool(enabled)
+
+    def set_notify(self, user_id, notify_time, enabled):
+        self._count()
+        self._write(lambda conn: conn.execute(
+            'INSERT INTO notifications (user_id, notify_time, enabled) VALUES (?, ?, ?) ON CONFLICT (user_id) '
+            'DO UPDATE SET notify_time = excluded.notify_time, enabled = excluded.enabled',
+            (user_id, notify_time, enabled)))
+
+    def claim_notifications(self, due_ats, owner, lease_seconds, limit):
+        # There is a single writer, so a claim never races another one; the lease still hands the reminders of an
+        # instance that died mid-dispatch to the next one. claimed_at is epoch seconds.
+        due = {due_at.strftime('%H:%M'): due_at for due_at in due_ats}
+
+        def claim(conn):
+            now = time.time()
+            rows = conn.execute(
+                'SELECT user_id, notify_time FROM notifications, json_each(?) AS due '
+                'WHERE notify_time = due.key AND enabled AND (last_sent IS NULL OR last_sent < due.value) '
+                'AND (claimed_at IS NULL OR claimed_at <= ?) ORDER BY due.value, user_id LIMIT ?',
+                (json.dumps({key: due_at.strftime('%Y-%m-%d %H:%M') for key, due_at in due.items()}),
+                 now - lease_seconds, limit)).fetchall()
+            conn.executemany('UPDATE notifications SET claimed_at = ?, claimed_by = ? WHERE user_id = ?',
+                             [(now, owner, user_id) for user_id, _ in rows])
+            return [(user_id, due[notify_time]) for user_id, notify_time in rows]
+        self._count(2)
+        return self._write(claim)
+
+    def notification_sent(self, user_id, due_at):
+        sent = due_at.strftime('%Y-%m-%d %H:%M')
+        self._count()
+        self._write(lambda conn: conn.execute(
+            'UPDATE notifications SET last_sent = ?, claimed_at = NULL, claimed_by = NULL '
+            'WHERE user_id = ? AND (last_sent IS NULL OR last_sent < ?)', (sent, user_id, sent)))
+
+    def active_users(self, since):
+        rows = self._read('SELECT user_id FROM user_calendar WHERE day >= ? GROUP BY user_id '
+                          'ORDER BY max(day) DESC, user_id', (since.isoformat(),))
+        return [row[0] for row in rows]
+
+    def claim_digests(self, week_start, user_ids):
+        week = week_start.isoformat()
+        self._count()
+        return self._write(lambda conn: [row[0] for row in conn.execute(
+            'UPDATE notifications SET digest_sent = ? WHERE enabled AND user_id IN (SELECT value FROM json_each(?)) '
+            'AND (digest_sent IS NULL OR digest_sent < ?) RETURNING user_id',
+            (week, json.dumps(list(user_ids)), week)).fetchall()])
+
+    def stats(self):
+        with self._lock:
+            return {'queries': self.queries, 'commits': self.commits, 'writes': self.writes, 'failed': self.failed,
+                    'queued': self._writes.qsize(), 'writes_per_commit': self.writes / self.commits
+                    if self.commits else 0.0}
+
+    def close(self):
+        # Lets the writer commit what is queued, then closes every connection.
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._writes.put(None)
+            writer.join()
+        with self._lock:
+            connections, self._connections, self._idle = self._connections, [], []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
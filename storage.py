@@ -0,0 +1,403 @@
+import csv
+import os
+from abc import ABC, abstractmethod
+from datetime import date
+from tempfile import SpooledTemporaryFile
+from zoneinfo import ZoneInfo
+
+from psycopg2.errors import CheckViolation
+from psycopg2.extras import execute_values
+
+from bot import config
+from metrics import metrics
+
+# Everything the bot keeps: readings, the per-day calendar lookups over them, and notification settings.
+# functions.py, ingest.py and precompute.py go through `storage`; which backend that is comes from [STORAGE].
+# Timestamps passed in are aware datetimes or naive local wall-clock time ([DB] timezone); the ones handed back are
+# aware, in that timezone.
+
+SPOOL_BYTES = config.getint('EXPORT', 'spool_bytes', fallback=1048576)
+IMPORT_STAGING = ('CREATE TEMP TABLE import_staging (user_id INTEGER, measured_at TIMESTAMPTZ, systolic INTEGER, '
+                  'diastolic INTEGER, pulse INTEGER) ON COMMIT DROP')
+IMPORT_PARTITIONS = ("SELECT user_input_ensure_partitions(month, month) FROM "
+                     "(SELECT DISTINCT date_trunc('month', measured_at) AS month FROM import_staging) months")
+IMPORT_INSERT = ('INSERT INTO user_input (user_id, measured_at, systolic, diastolic, pulse) '
+                 'SELECT user_id, measured_at, systolic, diastolic, pulse FROM import_staging')
+
+# min, mean, max and standard deviation of each metric over a bucket, from the per-day sums in user_calendar. The
+# variance is clamped at zero, where rounding can leave it just below.
+AGGREGATES = ', '.join(f"min({metric}_min), sum({metric}_sum)::float / sum(reading_count), max({metric}_max), "
+                       f"sqrt(greatest(sum({metric}_squares)::float / sum(reading_count) "
+                       f"- (sum({metric}_sum)::float / sum(reading_count)) ^ 2, 0))"
+                       for metric in ('systolic', 'diastolic', 'pulse'))
+
+
+class Storage(ABC):
+    name = None
+
+    @abstractmethod
+    def bootstrap(self):
+        pass
+
+    @abstractmethod
+    def add_readings(self, rows):
+        # rows are (user_id, systolic, diastolic, pulse, measured_at), committed together.
+        pass
+
+    @abstractmethod
+    def import_readings(self, user_id, rows):
+        # rows are (measured_at, systolic, diastolic, pulse); either all of them are stored or none.
+        pass
+
+    @abstractmethod
+    def delete_readings(self, user_id):
+        pass
+
+    @abstractmethod
+    def delete_last_reading(self, user_id):
+        pass
+
+    @abstractmethod
+    def delete_user(self, user_id):
+        # Readings and notification settings.
+        pass
+
+    @abstractmethod
+    def delete_users(self, first_id, stop_id):
+        # delete_user for every user_id in [first_id, stop_id), in one transaction.
+        pass
+
+    @abstractmethod
+    def has_readings(self, user_id):
+        pass
+
+    @abstractmethod
+    def years(self, user_id):
+        pass
+
+    @abstractmethod
+    def months(self, user_id, year):
+        pass
+
+    @abstractmethod
+    def days(self, user_id, start, end):
+        # Dates with readings in [start, end).
+        pass
+
+    @abstractmethod
+    def span(self, user_id, year=None):
+        # (first day, last day) with readings, (None, None) without any.
+        pass
+
+    @abstractmethod
+    def data_version(self, user_id):
+        # A counter raised by every write to the user's readings, 0 before the first one.
+        pass
+
+    @abstractmethod
+    def aggregated(self, user_id, bucket, first_day, last_day):
+        # Per bucket ('day', 'week' or 'month'), first_day..last_day inclusive: bucket start, then min, mean, max and
+        # standard deviation of systolic, diastolic and pulse, then the reading count.
+        pass
+
+    @abstractmethod
+    def readings(self, user_id, start, end):
+        # (systolic, diastolic, pulse, measured_at) in [start, end), oldest first.
+        pass
+
+    @abstractmethod
+    def reading_columns(self, user_id, start, end):
+        # [systolic], [diastolic], [pulse], [local wall-clock seconds since the epoch] in [start, end), oldest first.
+        pass
+
+    @abstractmethod
+    def export_csv(self, user_id, file):
+        # Writes measured_at, systolic, diastolic, pulse as CSV with a header to a binary file; returns the row count.
+        pass
+
+    @abstractmethod
+    def notify_setting(self, user_id):
+        # (notify_time, enabled), or None for a user who never set one.
+        pass
+
+    @abstractmethod
+    def set_notify(self, user_id, notify_time, enabled):
+        # notify_time is "HH:MM" or None.
+        pass
+
+    @abstractmethod
+    def claim_notifications(self, due_ats, owner, lease_seconds, limit):
+        # Leases up to `limit` unsent reminders due at one of the minutes in due_ats to `owner` and returns their
+        # (user_id, due_at). A lease older than lease_seconds is taken over: its owner is assumed dead.
+        pass
+
+    @abstractmethod
+    def notification_sent(self, user_id, due_at):
+        # Records the reminder due at due_at as sent and releases its lease.
+        pass
+
+    @abstractmethod
+    def active_users(self, since):
+        # Users with readings on or after the day `since`, most recently active first.
+        pass
+
+    @abstractmethod
+    def claim_digests(self, week_start, user_ids):
+        # Of user_ids, those with reminders on whose digest for week_start has not been sent; marks it sent.
+        pass
+
+    @abstractmethod
+    def stats(self):
+        # A dict with at least 'queries', the statements sent so far.
+        pass
+
+    def close(self):
+        pass
+
+
+class PostgresStorage(Storage):
+    # Reads of a user's own data go through database.reads, so they use the replica when there is one.
+    name = 'postgres'
+
+    def __init__(self):
+        from database import db, reads, replica
+        self.db = db
+        self.reads = reads
+        self.replica = replica
+        self.zone = ZoneInfo(config.get('DB', 'timezone', fallback=os.environ.get('TZ', 'UTC')))
+        # (first_at, last_at) that add_readings has already created partitions for.
+        self._partitioned = None
+
+    def bootstrap(self):
+        from migrations import bootstrap_schema
+        bootstrap_schema()
+
+    def _partition_range(self, cursor, rows):
+        # There is no default partition, so months a batch reaches outside the range already covered are created
+        # in the same transaction, the way the import staging path does. Live readings all fall in the covered
+        # range after the first batch and skip the call (and the advisory lock it takes).
+        times = [at if at.tzinfo else at.replace(tzinfo=self.zone) for at in (row[4] for row in rows)]
+        first_at, last_at = min(times), max(times)
+        covered = self._partitioned
+        if covered and covered[0] <= first_at and last_at <= covered[1]:
+            return covered
+        cursor.execute("SELECT user_input_ensure_partitions(%s, %s)", (first_at, last_at))
+        if covered and first_at <= covered[1] and last_at >= covered[0]:
+            return min(first_at, covered[0]), max(last_at, covered[1])
+        return first_at, last_at
+
+    def add_readings(self, rows):
+        try:
+            with self.db.cursor() as cursor:
+                partitioned = self._partition_range(cursor, rows)
+                execute_values(cursor, 'INSERT INTO user_input (user_id, systolic, diastolic, pulse, measured_at) '
+                                       'VALUES %s', rows, page_size=len(rows))
+        except CheckViolation:
+            # A month in the covered range was archived since; check again on the next batch.
+            self._partitioned = None
+            raise
+        self._partitioned = partitioned
+        for user_id in {row[0] for row in rows}:
+            self.reads.wrote(user_id)
+
+    def import_readings(self, user_id, rows):
+        # One transaction. Readings go through a staging table so that partitions for months the file reaches back
+        # to can be created before they are inserted.
+        with SpooledTemporaryFile(max_size=SPOOL_BYTES, mode='w+', newline='') as spool:
+            writer = csv.writer(spool)
+            for measured_at, systolic, diastolic, pulse in rows:
+                writer.writerow((user_id, measured_at.isoformat(), systolic, diastolic, pulse))
+            spool.seek(0)
+            with self.db.cursor() as cursor:
+                cursor.execute(IMPORT_STAGING)
+                cursor.copy_expert('COPY import_staging (user_id, measured_at, systolic, diastolic, pulse) '
+                                   'FROM STDIN WITH (FORMAT csv)', spool)
+                cursor.execute(IMPORT_PARTITIONS)
+                cursor.execute(IMPORT_INSERT)
+        self.reads.wrote(user_id)
+
+    def delete_readings(self, user_id):
+        with self.db.cursor() as cursor:
+            cursor.execute('DELETE FROM user_input WHERE user_id = %s', (user_id,))
+        self.reads.wrote(user_id)
+
+    def delete_last_reading(self, user_id):
+        # measured_at is in the match so only the partition holding the reading is touched.
+        with self.db.cursor() as cursor:
+            cursor.execute('DELETE FROM user_input WHERE (id, measured_at) = ('
+                           'SELECT id, measured_at FROM user_input WHERE user_id = %s '
+                           'ORDER BY measured_at DESC, id DESC LIMIT 1) AND user_id = %s', (user_id, user_id))
+        self.reads.wrote(user_id)
+
+    def delete_user(self, user_id):
+        with self.db.cursor() as cursor:
+            cursor.execute('DELETE FROM user_input WHERE user_id = %s', (user_id,))
+            cursor.execute('DELETE FROM notifications WHERE user_id = %s', (user_id,))
+        self.reads.wrote(user_id)
+
+    def delete_users(self, first_id, stop_id):
+        # Only used for synthetic users, so no read-your-writes marks.
+        with self.db.cursor() as cursor:
+            cursor.execute('DELETE FROM user_input WHERE user_id >= %s AND user_id < %s', (first_id, stop_id))
+            cursor.execute('DELETE FROM notifications WHERE user_id >= %s AND user_id < %s', (first_id, stop_id))
+
+    def has_readings(self, user_id):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM user_calendar WHERE user_id = %s)', (user_id,))
+            return cursor.fetchone()[0]
+
+    def years(self, user_id):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute('SELECT DISTINCT extract(year FROM day)::int FROM user_calendar WHERE user_id = %s '
+                           'ORDER BY 1', (user_id,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def months(self, user_id, year):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute('SELECT DISTINCT extract(month FROM day)::int FROM user_calendar '
+                           'WHERE user_id = %s AND day >= %s AND day < %s ORDER BY 1',
+                           (user_id, date(year, 1, 1), date(year + 1, 1, 1)))
+            return [row[0] for row in cursor.fetchall()]
+
+    def days(self, user_id, start, end):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute('SELECT day FROM user_calendar WHERE user_id = %s AND day >= %s AND day < %s ORDER BY day',
+                           (user_id, start, end))
+            return [row[0] for row in cursor.fetchall()]
+
+    def span(self, user_id, year=None):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            if year is None:
+                cursor.execute('SELECT min(day), max(day) FROM user_calendar WHERE user_id = %s', (user_id,))
+            else:
+                cursor.execute('SELECT min(day), max(day) FROM user_calendar WHERE user_id = %s '
+                               'AND day >= %s AND day < %s', (user_id, date(year, 1, 1), date(year + 1, 1, 1)))
+            return cursor.fetchone()
+
+    def data_version(self, user_id):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute('SELECT version FROM user_versions WHERE user_id = %s', (user_id,))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+    def aggregated(self, user_id, bucket, first_day, last_day):
+        # bucket is bound as a parameter, never formatted into the SQL. Served from the per-day aggregates in
+        # user_calendar, so the cost grows with days, not readings.
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute(f'SELECT date_trunc(%s, day::timestamp)::timestamptz AS bucket, {AGGREGATES}, '
+                           'sum(reading_count) '
+                           'FROM user_calendar WHERE user_id = %s AND day >= %s AND day <= %s '
+                           'GROUP BY 1 ORDER BY 1', (bucket, user_id, first_day, last_day))
+            return cursor.fetchall()
+
+    def readings(self, user_id, start, end):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute('SELECT systolic, diastolic, pulse, measured_at FROM user_input '
+                           'WHERE user_id = %s AND measured_at >= %s AND measured_at < %s ORDER BY measured_at',
+                           (user_id, start, end))
+            return cursor.fetchall()
+
+    def reading_columns(self, user_id, start, end):
+        # One row of arrays instead of one row per reading.
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute('SELECT array_agg(systolic), array_agg(diastolic), array_agg(pulse), '
+                           'array_agg(extract(epoch FROM measured_at::timestamp)::float8) '
+                           'FROM (SELECT systolic, diastolic, pulse, measured_at FROM user_input '
+                           'WHERE user_id = %s AND measured_at >= %s AND measured_at < %s ORDER BY measured_at) r',
+                           (user_id, start, end))
+            return [column or [] for column in cursor.fetchone()]
+
+    def export_csv(self, user_id, file):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            query = cursor.mogrify('COPY (SELECT measured_at, systolic, diastolic, pulse FROM user_input '
+                                   'WHERE user_id = %s ORDER BY measured_at) TO STDOUT WITH (FORMAT csv, HEADER)',
+                                   (user_id,))
+            cursor.copy_expert(query, file)
+            return max(cursor.rowcount, 0)
+
+    def notify_setting(self, user_id):
+        with self.reads.for_user(user_id).cursor() as cursor:
+            cursor.execute('SELECT notify_time, enabled FROM notifications WHERE user_id = %s', (user_id,))
+            return cursor.fetchone()
+
+    def set_notify(self, user_id, notify_time, enabled):
+        with self.db.cursor() as cursor:
+            cursor.execute('INSERT INTO notifications (user_id, notify_time, enabled) VALUES (%s, %s, %s) '
+                           'ON CONFLICT (user_id) '
+                           'DO UPDATE SET notify_time = EXCLUDED.notify_time, enabled = EXCLUDED.enabled',
+                           (user_id, notify_time, enabled))
+        self.reads.wrote(user_id)
+
+    def claim_notifications(self, due_ats, owner, lease_seconds, limit):
+        # Rows another instance is claiming right now are skipped rather than waited for. The lease, not the claim,
+        # stops a second instance: last_sent only moves once the reminder has gone out, so a reminder claimed by an
+        # instance that died before sending it is claimed again once its lease has expired.
+        with self.db.cursor() as cursor:
+            cursor.execute('UPDATE notifications n SET claimed_at = now(), claimed_by = %s FROM ('
+                           'SELECT n.user_id, due.at '
+                           'FROM unnest(%s::time[], %s::timestamptz[]) AS due(notify_time, at) '
+                           'JOIN notifications n ON n.notify_time = due.notify_time '
+                           'WHERE n.enabled AND (n.last_sent IS NULL OR n.last_sent < due.at) '
+                           'AND (n.claimed_at IS NULL OR n.claimed_at <= now() - make_interval(secs => %s)) '
+                           'ORDER BY due.at, n.user_id LIMIT %s FOR UPDATE OF n SKIP LOCKED) due '
+                           'WHERE n.user_id = due.user_id RETURNING n.user_id, due.at',
+                           (owner, [due_at.time() for due_at in due_ats], list(due_ats), lease_seconds, limit))
+            return cursor.fetchall()
+
+    def notification_sent(self, user_id, due_at):
+        with self.db.cursor() as cursor:
+            cursor.execute('UPDATE notifications SET last_sent = %s, claimed_at = NULL, claimed_by = NULL '
+                           'WHERE user_id = %s AND (last_sent IS NULL OR last_sent < %s)', (due_at, user_id, due_at))
+
+    def active_users(self, since):
+        with self.db.cursor() as cursor:
+            cursor.execute('SELECT user_id FROM user_calendar WHERE day >= %s GROUP BY user_id '
+                           'ORDER BY max(day) DESC, user_id', (since,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def claim_digests(self, week_start, user_ids):
+        with self.db.cursor() as cursor:
+            cursor.execute('UPDATE notifications n SET digest_sent = %s FROM ('
+                           'SELECT user_id FROM notifications '
+                           'WHERE enabled AND user_id = ANY(%s) AND (digest_sent IS NULL OR digest_sent < %s) '
+                           'ORDER BY user_id FOR UPDATE SKIP LOCKED) due '
+                           'WHERE n.user_id = due.user_id RETURNING n.user_id',
+                           (week_start, list(user_ids), week_start))
+            return [row[0] for row in cursor.fetchall()]
+
+    def stats(self):
+        stats = {'queries': self.db.stats()['queries'], 'pool': self.db.stats()}
+        if self.replica is not None:
+            stats['queries'] += self.replica.stats()['queries']
+            stats['replica_pool'] = self.replica.stats()
+            stats['reads'] = self.reads.stats()
+        return stats
+
+    def close(self):
+        self.db.close()
+
+
+BACKEND = config.get('STORAGE', 'backend', fallback='postgres')
+
+
+def storage_from_config():
+    if BACKEND == 'sqlite':
+        # Imported here so a Postgres deployment never loads it.
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage(
+            path=config.get('STORAGE', 'path', fallback='bot.sqlite3'),
+            timezone=config.get('DB', 'timezone', fallback=os.environ.get('TZ', 'UTC')),
+            max_batch=config.getint('STORAGE', 'max_batch', fallback=500),
+            busy_timeout_ms=config.getint('STORAGE', 'busy_timeout_ms', fallback=5000),
+            write_timeout=config.getint('DB', 'statement_timeout_ms', fallback=15000) / 1000,
+            max_readers=config.getint('STORAGE', 'max_readers', fallback=8),
+        )
+    if BACKEND != 'postgres':
+        raise ValueError(f"Unknown [STORAGE] backend: {BACKEND}")
+    return PostgresStorage()
+
+
+storage = storage_from_config()
+if storage.name == 'sqlite':
+    # The Postgres pools have their own gauges in database.py.
+    metrics.gauge('bot_storage', "SQLite statements, group commits and queued writes.", storage.stats)
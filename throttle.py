@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from bot import config
+from dispatcher import TokenBucket
+from metrics import metrics
+
+
+class Throttle:
+    # One token bucket per user, kept in an LRU of at most max_users entries; a user evicted from it simply
+    # starts again with a full bucket. Shed requests get at most one reply per notice_interval, so a flood
+    # is not answered with a flood.
+    def __init__(self, rate, burst, max_users, notice_interval):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.notice_interval = notice_interval
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.shed = 0
+
+    def admit(self, user_id):
+        # Returns (allowed, notify): notify is True when a shed request should be told to slow down.
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = [TokenBucket(self.rate, self.burst), 0.0]
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+            if entry[0].try_acquire():
+                self.allowed += 1
+                return True, False
+            self.shed += 1
+            now = time.monotonic()
+            if now - entry[1] < self.notice_interval:
+                return False, False
+            entry[1] = now
+            return False, True
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._users), 'allowed': self.allowed, 'shed': self.shed}
+
+
+class Coalescer:
+    # Runs fn once per key at a time: callers that arrive with the same key while it runs wait for that call
+    # and get its result (or its exception) instead of running fn again.
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def run(self, key, fn, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            owner = future is None
+            if owner:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+class AsyncCoalescer:
+    # Coalescer for coroutines on one event loop.
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def run(self, key, fn, *args):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shielded, so a caller that is cancelled does not cancel the call the others are waiting for.
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+throttle = Throttle(
+    rate=config.getfloat('THROTTLE', 'rate', fallback=1),
+    burst=config.getfloat('THROTTLE', 'burst', fallback=5),
+    max_users=config.getint('THROTTLE', 'max_users', fallback=10000),
+    notice_interval=config.getfloat('THROTTLE', 'notice_interval', fallback=10),
+)
+# Identical callbacks from the same user share one handler run; see handlers.handle_callback.
+coalescer = Coalescer()
+async_coalescer = AsyncCoalescer()
+metrics.gauge('bot_throttle', "Per-user rate limiting and coalescing of identical in-flight callbacks.",
+              lambda: dict(throttle.stats(), coalesced=coalescer.coalesced + async_coalescer.coalesced,
+                           coalescing=coalescer.in_flight() + async_coalescer.in_flight()))
@@ -0,0 +1,261 @@
+import csv
+import io
+from datetime import datetime
+
+from telebot import types
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from router import callback_data, YEAR, MONTH, DAY
+
+# Texts, keyboards, chart series and the reply types shared by the threaded (handlers.py) and asyncio
+# (aio_handlers.py) bots.
+
+HELP_TEXT = ("Arterial Pressure Monitoring.\nTo start please enter three values separated by spaces. "
+             "\nSystolic | Diastolic | Pulse. "
+             "\nExample: \"120 80 60\" \n--- "
+             "\nAvailable commands:"
+             "\n/help -- view help information"
+             "\n/get -- get information by date"
+             "\n/graph -- get graph based on your information"
+             "\n/stats -- averages, variability and trend of your readings"
+             "\n/notify -- configure notification"
+             "\n/reset -- click this "
+             "if you need to reload keyboard buttons"
+             "\n/delete -- clear your data"
+             "\n/export -- download your data as CSV"
+             "\n/import -- upload data from a CSV file")
+NO_DATA = "No saved data found."
+NO_DATA_FOR_DATE = "No data found for the selected date."
+OUTDATED_BUTTON = "This button is outdated, please use the menu again."
+CHART_UNAVAILABLE = "Chart is not available right now, please try again later."
+NOTIFICATION = "Check your arterial pressure!"
+SAVED = 'Information saved successfully.'
+NOT_SAVED = 'Information was not saved. \nPlease, try again.'
+SAVE_PENDING = ("Saving is taking longer than usual, so this reading may or may not have been stored. "
+                "Check today's readings with /get in a minute and send it again only if it is missing.")
+SLOW_DOWN = "You are sending requests too fast, please wait a few seconds."
+IMPORT_PROMPT = "Send a CSV file with columns: measured_at, systolic, diastolic, pulse."
+CSV_HEADER = ('measured_at', 'systolic', 'diastolic', 'pulse')
+
+
+# What a replies.py body asks its bot to send; handlers.deliver and aio_handlers.deliver send them in order.
+class Text:
+    def __init__(self, text, reply_markup=None, parse_mode=None):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+
+
+class Chart:
+    # A chart in chart_cache under `scope`. `cached` is the entry the body found there; without one, `args` are the
+    # (title, xlabel, x, series) to render with `chart`. build() gives the args again if the cached file_id is
+    # rejected, or None when there is no data left.
+    def __init__(self, scope, chart, build, version, cached=None, args=None):
+        self.scope = scope
+        self.chart = chart
+        self.build = build
+        self.version = version
+        self.cached = cached
+        self.args = args
+
+
+class Document:
+    # Sent as a file named `name`; `file` is closed once sent.
+    def __init__(self, file, name, caption):
+        self.file = file
+        self.name = name
+        self.caption = caption
+
+
+class Ask:
+    # The user's next message answers `step` (replies.NOTIFY_TIME or replies.IMPORT_FILE).
+    def __init__(self, step):
+        self.step = step
+
+
+def parse_reading(text):
+    # Returns ((systolic, diastolic, pulse), None) or (None, error message).
+    input_values = text.split()
+    if len(input_values) != 3:
+        return None, ('Please enter 3 values separated by spaces. '
+                      '\nSystolic | Diastolic | Pulse. '
+                      '\nExample: "120 80 60"')
+    try:
+        systolic, diastolic, pulse = map(int, input_values)
+    except ValueError:
+        return None, 'Invalid input. \nPlease enter numeric values.'
+    if 0 <= systolic <= 300 and 0 <= diastolic <= 300 and 0 <= pulse <= 300:
+        return (systolic, diastolic, pulse), None
+    return None, 'Incorrect values. \nPlease, try again.'
+
+
+def parse_readings_csv(data):
+    # Returns ([(measured_at, systolic, diastolic, pulse), ...], None) or (None, error message) for an uploaded
+    # file in the /export format. measured_at without an offset is left naive for the caller to localize.
+    try:
+        reader = csv.reader(io.StringIO(data.decode('utf-8-sig')))
+    except UnicodeDecodeError:
+        return None, 'File must be UTF-8 encoded CSV.'
+    rows = []
+    for line, record in enumerate(reader, start=1):
+        if not record or line == 1 and tuple(cell.strip() for cell in record) == CSV_HEADER:
+            continue
+        if len(record) != 4:
+            return None, f'Line {line}: expected 4 columns.'
+        try:
+            measured_at = datetime.fromisoformat(record[0].strip())
+            values = tuple(int(cell) for cell in record[1:])
+        except ValueError:
+            return None, f'Line {line}: invalid date or value.'
+        if not all(0 <= value <= 300 for value in values):
+            return None, f'Line {line}: values out of range.'
+        rows.append((measured_at, *values))
+    if not rows:
+        return None, 'File has no readings.'
+    return rows, None
+
+
+def main_keyboard():
+    btn_get = types.KeyboardButton('/get')
+    btn_graph = types.KeyboardButton('/graph')
+    btn_ntf = types.KeyboardButton('/notify')
+    btn_del = types.KeyboardButton('/delete')
+    keyboard = types.ReplyKeyboardMarkup(row_width=2)
+    keyboard.add(btn_ntf, btn_del, btn_get, btn_graph)
+    return keyboard
+
+
+def delete_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("Clear data", callback_data=callback_data('delete_all')),
+                 InlineKeyboardButton("Delete last record", callback_data=callback_data('delete_last')))
+    return keyboard
+
+
+def confirm_delete_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("Yes", callback_data=callback_data('delete_all_yes')),
+                 InlineKeyboardButton("No", callback_data=callback_data('delete_all_no')))
+    return keyboard
+
+
+def notify_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton('Enable', callback_data=callback_data('enable')),
+                 InlineKeyboardButton('Disable', callback_data=callback_data('disable')))
+    return keyboard
+
+
+def years_keyboard(years, action):
+    keyboard = InlineKeyboardMarkup()
+    for year in years:
+        keyboard.add(InlineKeyboardButton(text=year, callback_data=callback_data(action, YEAR, year)))
+    return keyboard
+
+
+def months_keyboard(months, action, year):
+    keyboard = InlineKeyboardMarkup()
+    for month in months:
+        keyboard.add(InlineKeyboardButton(text=f"{month:02d}",
+                                          callback_data=callback_data(action, MONTH, (month, year))))
+    return keyboard
+
+
+def days_keyboard(days, action):
+    keyboard = InlineKeyboardMarkup(row_width=4)
+    for i in range(0, len(days), 5):
+        keyboard.row(*[InlineKeyboardButton(text=day.strftime('%d'), callback_data=callback_data(action, DAY, day))
+                       for day in days[i:i + 5]])
+    return keyboard
+
+
+def day_menu_keyboard(day):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("Text", callback_data=callback_data('text_', DAY, day)),
+                 InlineKeyboardButton("Graph", callback_data=callback_data('pict_', DAY, day)))
+    return keyboard
+
+
+def month_menu_keyboard(month):
+    # month is (month, year)
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("Select day", callback_data=callback_data('draw_days_', MONTH, month)),
+                 InlineKeyboardButton("Graph ", callback_data=callback_data('draw_month_', MONTH, month)))
+    return keyboard
+
+
+def year_menu_keyboard(year):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("Select month", callback_data=callback_data('draw_year_', YEAR, year)),
+                 InlineKeyboardButton("Graph", callback_data=callback_data('graph_sum_', YEAR, year)))
+    return keyboard
+
+
+def readings_text(title, rows):
+    # rows are (systolic, diastolic, pulse, measured_at) in local time.
+    response = f"Data saved on {title}:\n"
+    for row in rows:
+        response += f"Time: *{row[3]:%H:%M}* | SBP: *{row[0]}* | DBP: *{row[1]}* | P: *{row[2]}*\n"
+    return response
+
+
+def _pressure(systolic, diastolic):
+    return f"*{systolic:.0f}/{diastolic:.0f}*"
+
+
+def stats_text(stats):
+    # stats is analytics.summarize() output.
+    systolic, diastolic, pulse = stats['mean']
+    lines = [f"Statistics for {stats['count']} readings:",
+             f"Average: {_pressure(systolic, diastolic)}, pulse *{pulse:.0f}*"]
+    for window in (7, 30):
+        systolic, diastolic, pulse = stats[f'rolling_{window}']
+        lines.append(f"Last {window} days: {_pressure(systolic, diastolic)}, pulse *{pulse:.0f}*")
+    for name in ('morning', 'evening'):
+        systolic, diastolic, count = stats[name]
+        if count:
+            lines.append(f"{name.capitalize()}: {_pressure(systolic, diastolic)} ({count} readings)")
+    lines.append(f"Pulse pressure: *{stats['pulse_pressure']:.0f}*")
+    if 'sd' in stats:
+        lines.append(f"Variability SD: *{stats['sd'][0]:.1f}/{stats['sd'][1]:.1f}*, "
+                     f"ARV: *{stats['arv'][0]:.1f}/{stats['arv'][1]:.1f}*")
+    if 'slope' in stats:
+        lines.append(f"Trend: *{stats['slope'][0] * 30:+.1f}/{stats['slope'][1] * 30:+.1f}* per 30 days")
+    lines.append(" | ".join(f"{name} {share:.0%}" for name, share in stats['categories'].items() if share))
+    return "\n".join(lines)
+
+
+def digest_text(stats):
+    # Photo caption for the weekly digest; stats is analytics.summarize() output for that week.
+    systolic, diastolic, pulse = stats['mean']
+    lines = [f"Your week: {stats['count']} readings",
+             f"Average: {_pressure(systolic, diastolic)}, pulse *{pulse:.0f}*"]
+    for name in ('morning', 'evening'):
+        systolic, diastolic, count = stats[name]
+        if count:
+            lines.append(f"{name.capitalize()}: {_pressure(systolic, diastolic)}")
+    lines.append(" | ".join(f"{name} {share:.0%}" for name, share in stats['categories'].items() if share))
+    return "\n".join(lines)
+
+
+def reading_series(rows):
+    return [('SBP', 'red', [row[0] for row in rows]),
+            ('DBP', 'blue', [row[1] for row in rows]),
+            ('Pulse', 'green', [row[2] for row in rows])]
+
+
+def range_series(rows):
+    # rows are get_aggregated_data() results: bucket, then min/mean/max/standard deviation for each metric.
+    def columns(first):
+        return [[row[i] for row in rows] for i in range(first, first + 4)]
+    return [('Systolic', 'red', *columns(1)), ('Diastolic', 'blue', *columns(5)), ('pulse', 'green', *columns(9))]
+
+
+def pick_bucket(first_day, last_day):
+    # Keeps long-range charts at roughly 200 points or fewer whatever the span.
+    span = (last_day - first_day).days
+    if span <= 180:
+        return 'day'
+    if span <= 4 * 366:
+        return 'week'
+    return 'month'
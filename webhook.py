@@ -0,0 +1,154 @@
+import hmac
+import json
+import logging
+import queue
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+from bot import bot, config
+from metrics import metrics
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# What Telegram accepts as a webhook secret_token.
+SECRET_FORMAT = re.compile(r'[A-Za-z0-9_-]{1,256}')
+
+
+class WebhookServer:
+    # Accepts updates over HTTP and hands them to a fixed set of workers through a bounded queue. When the queue
+    # is full the update is refused with 503 so Telegram retries it later instead of us buffering without limit.
+    def __init__(self, host, port, path, secret_token, workers, max_queue, max_body):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self.max_body = max_body
+        self._queue = queue.Queue(max_queue)
+        self._threads = []
+        self._server = None
+        self.accepted = 0
+        self.rejected = 0
+        self.unauthorized = 0
+        self.failed = 0
+
+    def has_secret(self):
+        return SECRET_FORMAT.fullmatch(self.secret_token or '') is not None
+
+    def authorized(self, header):
+        # Without a secret every request is refused: anyone who can reach the port could otherwise post updates as
+        # any user. main.py does not start webhook mode without one.
+        if not self.has_secret():
+            return False
+        return header is not None and hmac.compare_digest(header, self.secret_token)
+
+    def offer(self, update):
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    def _work(self):
+        while True:
+            update = self._queue.get()
+            if update is None:
+                return
+            try:
+                bot.process_new_updates([update])
+            except Exception:
+                self.failed += 1
+                logging.exception(f"Failed to process update {update.update_id}.")
+            finally:
+                self._queue.task_done()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, headers=()):
+                self.send_response(code)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                if self.path != server.path:
+                    return self._reply(404)
+                if not server.authorized(self.headers.get(SECRET_HEADER)):
+                    server.unauthorized += 1
+                    return self._reply(401)
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > server.max_body:
+                    return self._reply(413)
+                try:
+                    update = types.Update.de_json(json.loads(self.rfile.read(length)))
+                except (ValueError, KeyError, TypeError):
+                    return self._reply(400)
+                if not server.offer(update):
+                    return self._reply(503, [('Retry-After', '1')])
+                self._reply(200)
+
+            def log_message(self, format, *args):
+                logging.debug(f"webhook {self.address_string()} {format % args}")
+
+        return Handler
+
+    def start(self):
+        # Handlers run on our workers, not on TeleBot's own unbounded pool, so the queue bound holds end to end.
+        bot.threaded = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"webhook-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._server = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self._server.daemon_threads = True
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'max_queue': self._queue.maxsize,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'unauthorized': self.unauthorized,
+            'failed': self.failed,
+        }
+
+
+def register_webhook():
+    # Without [WEBHOOK] url the webhook is assumed to be registered elsewhere (e.g. behind a load balancer).
+    url = config.get('WEBHOOK', 'url', fallback=None)
+    if url:
+        bot.set_webhook(url=url, secret_token=webhook_server.secret_token,
+                        max_connections=config.getint('WEBHOOK', 'max_connections', fallback=40))
+
+
+webhook_server = WebhookServer(
+    host=config.get('WEBHOOK', 'host', fallback='0.0.0.0'),
+    port=config.getint('WEBHOOK', 'port', fallback=8443),
+    path=config.get('WEBHOOK', 'path', fallback='/webhook'),
+    secret_token=config.get('WEBHOOK', 'secret_token', fallback=''),
+    workers=config.getint('WEBHOOK', 'workers', fallback=8),
+    max_queue=config.getint('WEBHOOK', 'max_queue', fallback=256),
+    max_body=config.getint('WEBHOOK', 'max_body', fallback=1048576),
+)
+metrics.gauge('bot_webhook', "Webhook update queue.", webhook_server.stats)